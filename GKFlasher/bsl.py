@@ -1,3 +1,4 @@
+import io
 import os
 import serial
 import serial.tools
@@ -6,6 +7,9 @@ import time
 import sys
 import traceback
 import logging
+import queue
+import threading
+from flasher.lineswap import forward_table
 
 # Logger configuration
 logger = logging.getLogger("bsl")
@@ -45,15 +49,21 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 def ResetAdapter(ser):
-    ser.setDTR(1)
-    time.sleep(0.1)
-    ser.setDTR(0)
-    time.sleep(0.1)
+    try:
+        ser.setDTR(1)
+        time.sleep(0.1)
+        ser.setDTR(0)
+        time.sleep(0.1)
+    except OSError: # no modem control lines, e.g. the emulator's pty
+        pass
 
 def SetAdapterKKL(ser):
-    ser.setDTR(0)
-    ser.setRTS(0)
-    time.sleep(0.1)
+    try:
+        ser.setDTR(0)
+        ser.setRTS(0)
+        time.sleep(0.1)
+    except OSError:
+        pass
 
 
 def SendCharwEcho(ser, data):
@@ -73,10 +83,18 @@ def SendCharwEcho(ser, data):
         logger.error("got no echo")
     return ret
 
+def FindMismatch(sent, received):
+    # Position of the first byte that differs, only looked for once a comparison failed
+    for position, (a, b) in enumerate(zip(sent, received)):
+        if a != b:
+            return position
+    return min(len(sent), len(received))
+
 def SendDatawEcho(ser, data):
 #    for d in data:
 #        #logger.info("sendDatawEcho char: ", hex(d))
 #        SendCharwEcho(ser,[d])
+    data = bytes(data)
     ser.write(data)
     echo = ser.read(len(data))
 
@@ -84,12 +102,11 @@ def SendDatawEcho(ser, data):
         logger.error("got wrong echo length")
         return False
 
-    counter = 0
-    while counter < len(data):
-        if(data[counter] != echo[counter]):
-            logger.error(f"Echo error sent: {hex(data[counter])}, received: {hex(echo[counter])}, at data pos: {hex(counter)}")
-            ret = False
-        counter += 1
+    if(echo != data):
+        position = FindMismatch(data, echo)
+        errors = sum([a != b for a, b in zip(data, echo)])
+        logger.error(f"Echo error sent: {hex(data[position])}, received: {hex(echo[position])}, at data pos: {hex(position)} ({errors} bytes differ)")
+        return False
 
     return True
 
@@ -189,6 +206,7 @@ def TestComm(ser):
         return -1
 
     logger.info(f"Got kernel acknowledgment: {hex(A_ACK1)}, {hex(A_ACK2)}")
+    return True
 
 def SetWordAtAddress(ser, addr, data):
     ret = SendCommand(ser, [C_WRITE_WORD])
@@ -205,40 +223,8 @@ def SetWordAtAddress(ser, addr, data):
     return True
 
 def GetBackCrossedWord(inputData):
-    # Define reversed SIMK41/3 mapping (AD -> DQ pins)
-    reverse_mapping = {
-        15: 0,  # AD15 -> DQ0
-        13: 1,  # AD13 -> DQ1
-        11: 2,  # AD11 -> DQ2
-        9: 3,   # AD9 -> DQ3
-        0: 4,   # AD0 -> DQ4
-        2: 5,   # AD2 -> DQ5
-        4: 6,   # AD4 -> DQ6
-        6: 7,   # AD6 -> DQ7
-        14: 8,  # AD14 -> DQ8
-        12: 9,  # AD12 -> DQ9
-        10: 10, # AD10 -> DQ10
-        8: 11,  # AD8 -> DQ11
-        1: 12,  # AD1 -> DQ12
-        3: 13,  # AD3 -> DQ13
-        5: 14,  # AD5 -> DQ14
-        7: 15   # AD7 -> DQ15
-    }
-
-    # Convert value to binary (16-bit)
-    binary_value = f"{inputData:016b}"
-
-    # Initialize raw binary as a list
-    raw_binary = ['0'] * 16
-
-    # Apply the reverse line swap
-    for ad_pin, dq_pin in reverse_mapping.items():
-        raw_binary[15 - dq_pin] = binary_value[15 - ad_pin]
-
-    # Convert raw binary back to an integer
-    out = int(''.join(raw_binary), 2)
-
-    return out
+    # Reversed SIMK41/3 mapping (AD -> DQ pins), precomputed for all 16-bit words
+    return forward_table[inputData]
 
 
 def GetBlockChecksum(ser):
@@ -253,12 +239,15 @@ def GetBlockChecksum(ser):
     return True,[echo[1]]
 
 def CalcBlockChecksum(data):
-    checksum = 0
-
-    for d in data:
-        checksum = (checksum ^ (d))&0xFF
+    # XOR of all bytes: the block is read as one integer and folded in halves down to a single byte
+    checksum = int.from_bytes(bytes(data), 'little')
+    width = len(data)
+    while width > 1:
+        half = (width + 1) // 2
+        checksum = (checksum >> (half * 8)) ^ (checksum & ((1 << (half * 8)) - 1))
+        width = half
 
-    return checksum
+    return checksum & 0xFF
 
 def SetBlockAtAddress(ser, addr, data):
     ret = SendCommand(ser, [C_WRITE_BLOCK])
@@ -274,26 +263,162 @@ def SetBlockAtAddress(ser, addr, data):
         return False,[]
     return True
 
-def GetBlockAtAddress(ser, addr, size):
+def ReadBlockAtAddress(ser, addr, size, report=True):
+    # Read a block and the kernel's checksum of it, the host side checksum is left to the caller
     ret = SendCommand(ser, [C_READ_BLOCK])
     SendDatawEcho(ser,  GetAddressAsLittleEndian(addr)+GetWordAsLittleEndian(size))
     echo = ser.read(size+1)
     if(len(echo) != size+1):
-        logger.error(f"GetBlockAtAddress got no acknowledgment: {echo}")
-        return False, []
+        if report:
+            logger.error(f"GetBlockAtAddress got no acknowledgment: {echo[:16]}")
+        return False, [], None
     if(echo[size] != A_ACK2):
-        logger.error(f"GetBlockAtAddress got different response than ackn2: {hex(echo[size])}")
-        return False, []
+        if report:
+            logger.error(f"GetBlockAtAddress got different response than ackn2: {hex(echo[size])}")
+        return False, [], None
 
     ret , checksum = GetBlockChecksum(ser)
-    calcChecksum = CalcBlockChecksum(echo[:size])
     if(ret == False):
         logger.error("Get Block not successful, got no checksum ")
+        return False, [], None
+    return True, echo[:size], checksum[0]
+
+def GetBlockAtAddress(ser, addr, size):
+    ret, data, checksum = ReadBlockAtAddress(ser, addr, size)
+    if(ret == False):
+        return False, []
+    calcChecksum = CalcBlockChecksum(data)
+    if(calcChecksum != checksum):
+        logger.error(f"Get block at: {hex(addr)} Wrong Checksum: {ret}, got checksum: {hex(checksum)}, calculated checksum: {hex(calcChecksum)}")
         return False,[]
-    if(calcChecksum != checksum[0]):
-        logger.error(f"Get block at: {hex(addr)} Wrong Checksum: {ret}, got checksum: {hex(checksum[0])}, calculated checksum: {hex(calcChecksum)}")
-        return False,[]
-    return True, echo[:size]
+    return True, data
+
+# Block lengths tried for reads, largest first. The length field is 16 bit, the kernel streams the block straight from memory
+ReadBlockLengths = [0x4000, 0x2000, 0x1000, 0x800, 0x400, 0x200]
+ReadRetries = 3
+# Share of the port's read timeout a block may spend on the wire, the rest is left for USB latency
+ReadTimeoutShare = 0.5
+
+def Resync(ser):
+    # Let the kernel finish whatever it was sending and drop it
+    time.sleep(0.2)
+    ser.reset_input_buffer()
+
+def FitsReadTimeout(ser, length):
+    # Block and its ACK at 10 bits per byte (8N1), well within the time a single read may block
+    return ser.timeout is None or (length + 1) * 10 / ser.baudrate <= ser.timeout * ReadTimeoutShare
+
+def ProbeBlockLength(ser, addr, size):
+    # Largest block length the kernel answers with a correct block, short enough for the port's timeout at its baudrate
+    for length in ReadBlockLengths:
+        if (length > size or not FitsReadTimeout(ser, length)) and length != ReadBlockLengths[-1]:
+            continue
+        success, data, checksum = ReadBlockAtAddress(ser, addr, min(length, size), report=False)
+        if success and CalcBlockChecksum(data) == checksum:
+            return length
+        logger.info(f"Block length {hex(length)} not accepted, trying a smaller one")
+        Resync(ser)
+    return ReadBlockLengths[-1]
+
+class BlockWriter(threading.Thread):
+    """
+    Checks, saves and reports blocks on its own thread while the next block is read.
+    Stops at the first checksum mismatch and remembers where it happened
+    """
+    def __init__(self, file, size, offset, progress_callback=None, log_callback2=None):
+        super().__init__(daemon=True)
+        self.file = file
+        self.size = size
+        self.offset = offset
+        self.progress_callback = progress_callback
+        self.log_callback2 = log_callback2
+        self.blocks = queue.Queue(maxsize=16)
+        self.failedOffset = None
+
+    def run(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            if self.failedOffset is not None:
+                continue
+
+            offset, data, checksum = block
+            calcChecksum = CalcBlockChecksum(data)
+            if(calcChecksum != checksum):
+                logger.error(f"Get block at offset: {hex(offset)} Wrong Checksum, got checksum: {hex(checksum)}, calculated checksum: {hex(calcChecksum)}")
+                self.failedOffset = offset
+                continue
+
+            self.file.write(bytes(data))
+            self.offset = offset + len(data)
+            self.report()
+
+    def report(self):
+        percentage = int(self.offset * 100 / self.size)
+        if self.progress_callback:
+            self.progress_callback(percentage)
+
+        # Construct the message to send back to the GUI
+        message = f"read at {hex(self.offset)} finished {percentage} %"
+        if self.log_callback2:
+            self.log_callback2.emit(message)
+
+        # CLI Progress
+        else:
+            sys.stdout.write(f"\r  read at {hex(self.offset)} finished {percentage} % ")
+
+    def finish(self):
+        self.blocks.put(None)
+        self.join()
+
+def ReadMemory(ser, address, size, file, progress_callback=None, log_callback2=None):
+    """
+    Read size bytes starting at address into file. Uses the largest block length the kernel
+    accepts and overlaps checksum verification, file writes and progress with the next block's
+    serial I/O. A failed block is read again (up to ReadRetries times) from where it failed.
+    Returns True on success
+    """
+    blockLength = ProbeBlockLength(ser, address, size)
+    logger.info(f"Using block length {hex(blockLength)}")
+
+    offset = 0
+    retries = 0
+    started = time.time()
+    while offset < size:
+        writer = BlockWriter(file, size, offset, progress_callback, log_callback2)
+        writer.start()
+        readOk = True
+        try:
+            while offset < size and writer.failedOffset is None:
+                readsize = min(blockLength, size - offset)
+                success, blockData, checksum = ReadBlockAtAddress(ser, address + offset, readsize)
+                if not success:
+                    readOk = False
+                    break
+                writer.blocks.put((offset, blockData, checksum))
+                offset += readsize
+        finally:
+            writer.finish()
+
+        if readOk and writer.failedOffset is None:
+            break
+
+        retries += 1
+        if retries > ReadRetries:
+            logger.error(f"Giving up at {hex(address + writer.offset)} after {ReadRetries} retries")
+            return False
+        # everything before writer.offset is saved, blocks read after it are dropped
+        offset = writer.offset
+        logger.warning(f"Reading again from {hex(address + offset)} ({retries}/{ReadRetries})")
+        Resync(ser)
+
+    elapsed = time.time() - started
+    rate = size / elapsed if elapsed > 0 else 0
+    lineRate = ser.baudrate / 10 # 8N1, 10 bits per byte
+    logger.info("", extra={"suppress_format": True}) #blank line
+    logger.info(f"Read {size} bytes in {elapsed:.1f}s, {rate:.0f} B/s ({rate * 100 / lineRate:.0f}% of the {lineRate:.0f} B/s line rate)")
+    return True
 
 def CallAtAddress(ser, addr, register):     # 8 register words on r8-r15
     ret = SendCommand(ser, [C_CALL_FUNCTION])
@@ -322,250 +447,429 @@ def CallAtAddress(ser, addr, register):     # 8 register words on r8-r15
 ##        logger.info(hex(r))
     return True, retreg
 
-def RunFunc(exit, ser, file, job, size, eetype, portAddr4, directionPortAddress4, pinnum, progress_callback=None, log_callback2=None):
-    ResetAdapter(ser)
-    SetAdapterKKL(ser)
+# Rates tried after the kernel is running, fastest first. The bootstrap loader itself always runs at the rate given on the command line
+BslBaudrates = [125000, 115200, 62500]
 
+def SetKernelBaudrate(ser, newBaud):
+    # C_AUTOBAUD makes the kernel measure the following zero byte and switch to its rate
+    if not SendCommand(ser, [C_AUTOBAUD]):
+        return False
+    ser.flush()
+    ser.baudrate = newBaud
+    time.sleep(0.05)
     ser.reset_input_buffer()
 
-    SYSCON_Addr         = 0x00ff12
-    SYSCON_Data_ext     = 0xe204        # from 15 -0: 3b stksz, 1b ROMS1, 1b SGTDIS, 1b ROMEN, 1b BYTDIS, 1b CLKEN, 1b WRCFG, 1b CSCFG, 1b reserved, 
-                                        # 1b OWDDIS, 1b BDRSTEN, 1b XPEN, 1b VISIBLE, 1b SPER-SHARE
-                                        # e -> rom mapped at >0x0 0000 and a Stacksize = ???, 2 -> Romen = 0 & BytDis = 1
-
-    SYSCON_Data_int     = 0xf604        # from 15 -0: 3b stksz, 1b ROMS1, 1b SGTDIS, 1b ROMEN, 1b BYTDIS, 1b CLKEN, 1b WRCFG, 1b CSCFG, 1b reserved, 
-                                        # 1b OWDDIS, 1b BDRSTEN, 1b XPEN, 1b VISIBLE, 1b SPER-SHARE
-                                        # f -> rom mapped at >0x01 0000 and a Stacksize = ???, 6 -> Romen = 1 & BytDis = 1
-    BUSCON0_Addr    = 0x00ff0c
-    BUSCON0_Data    = 0x04ad            # d = 2 memory cycle wait state, a = 16bit demultiplexed bus - no tristate wait state - 1 read/write delay,
-                                        # 4= external bus active, c chipSelect read/write enable
-
-    ADDRSEL1_Addr   = 0x00fe18   
-    ADDRSEL1_SIMK4X_Data = 0x4008       # 1024kByte window starting at 0x40 0000 ??
-    
-    BUSCON1_Addr = 0x00ff14
-    BUSCON1_SIMK4X_Data = 0x848e        #  d = 2 memory cycle wait state, 0 = 8bit demultiplexed bus - 1 tristate wait state - 1 read/write delay, 0= external bus inactive
-
-    driverAddress = 0x00F600
-    FlashDriverEntryPoint = 0x00F640
-    
-    #driver commands
-    C_GETSTATE = 0x0093
-    C_READSPI = 0x0036
-    C_WRITESPI = 0x0037
-
-    #flash driver commands
-    FC_PROG                     =	0x00     #Program Flash
-    FC_ERASE                    =	0x01	 #Erase Flash
-    FC_SETTIMING                =	0x03	 #Set Timing
-    FC_GETSTATE                 =	0x06	 #Get State
-    FC_GETSTATE_ADDR_MANUFID    =   0x00    
-    FC_GETSTATE_ADDR_DEVICEID   =   0x01    
-    FC_LOCK                     =	0x10	 #Lock Flash bank
-    FC_UNLOCK                   =	0x11	 #Unlock Flash bank
-    FC_PROTECT                  =	0x20	 #Protect entire Flash
-    FC_UNPROTECT                =	0x21	 #Unprotect Flash
-    FC_BLANKCHECK               =	0x34	 #OTP/ Flash blankcheck
-    FC_GETID		            =	0x35     #Get Manufacturer ID/ Device ID ->not implemented
-
-
-#    --------------------- Error Values -----------------------------
-    E_NOERROR               =	0x00	 #No error
-    E_UNKNOWN_FC            =	0x01	 #Unknown function code
-
-    E_PROG_NO_VPP           =	0x10	 #No VPP while programming
-    E_PROG_FAILED           =	0x11	 #Programming failed
-    E_PROG_VPP_NOT_CONST	=	0x12	 #VPP not constant while programming
-
-    E_INVALID_BLOCKSIZE     =	0x1B	 #Invalid blocksize
-    E_INVALID_DEST_ADDR     =	0x1C	 #Invalid destination address
-
-    E_ERASE_NO_VPP          =	0x30	 #No VPP while erasing
-    E_ERASE_FAILED          =	0x31	 #Erasing failed
-    E_ERASE_VPP_NOT_CONST	=	0x32	 #VPP not constant while erasing
+    SendDatawEcho(ser, [0])
+    byte = ser.read(1)
+    if(len(byte) != 1) or (byte[0] != I_AUTOBAUD_ACKNOWLEDGE):
+        logger.warning(f"No autobaud acknowledgment at {newBaud}: {byte.hex()}")
+        return False
+    return TestComm(ser) == True
+
+def EscalateBaudrate(ser, maxBaud):
+    """
+    Switch the kernel to the fastest rate in BslBaudrates up to maxBaud. Every rate is checked
+    with TestComm and a block read, on errors the kernel is taken back to the starting rate
+    """
+    baseBaud = ser.baudrate
+    for newBaud in [rate for rate in BslBaudrates if baseBaud < rate <= maxBaud]:
+        logger.info(f"Switching to {newBaud} baud...")
+        if SetKernelBaudrate(ser, newBaud) and GetBlockAtAddress(ser, 0x0, 0x100)[0]:
+            logger.info(f"Running at {newBaud} baud")
+            return newBaud
+
+        logger.warning(f"{newBaud} baud not usable, falling back to {baseBaud}")
+        Resync(ser)
+        ser.baudrate = baseBaud
+        time.sleep(0.05)
+        ser.reset_input_buffer()
+        # the kernel waits for a zero byte to measure, or runs at newBaud already and needs another C_AUTOBAUD
+        SendDatawEcho(ser, [0])
+        byte = ser.read(1)
+        if(len(byte) != 1) or (byte[0] != I_AUTOBAUD_ACKNOWLEDGE):
+            Resync(ser)
+            if not SetKernelBaudrate(ser, baseBaud):
+                Resync(ser)
+        if TestComm(ser) != True:
+            logger.error(f"Lost the kernel while falling back to {baseBaud} baud")
+            return None
+    return ser.baudrate
+
+def GetSectorMap(size, flashSize, botBootSector):
+    # Sectors (number, offset, size) of the AM29F/M29F chips covering the first size bytes
+    sectors = []
+    offset = 0x0
+    sector = 0
+    while (offset < size):
+        if(botBootSector == False): # Top boot sector
+            if(flashSize ==  (1<<20)): #size f800 1024kB
+                if(sector == 18):
+                    sectorSize = 0x4000
+                elif(sector == 17) | (sector == 16):
+                    sectorSize = 0x2000
+                elif(sector == 15):
+                    sectorSize = 0x8000
+                else:
+                    sectorSize = 0x10000
 
-    E_INVALID_SECTOR        =	0x33	 #Invalid sector number
-    E_Sector_LOCKED         =	0x34	 #Sector locked
-    E_FLASH_PROTECTED       =	0x35	 #Flash protected
-    
-    IntRomAddress = 0x010000
-    ExtFlashAddress = 0x800000
-    DriverCopyAddress = 0xFC00
-    BlockLength = 0x200
+            else: #size f400 512kB
+                if(sector == 10):
+                    sectorSize = 0x4000
+                elif(sector == 9) | (sector == 8):
+                    sectorSize = 0x2000
+                elif(sector == 7):
+                    sectorSize = 0x8000
+                else:
+                    sectorSize = 0x10000
 
-## Upload Kernel
-    SendDatawEcho(ser,[0])  #say hello, how ya doin'?
-    byte = ser.read(1)
-    if(len(byte) != 1):
-        logger.error(f"No response from ECU, set device into bootmode: {byte}")
-        return -1
-    if(byte[0] != 0xaa):
-        
-        if byte[0] == variantByteC167Old:
-            variant_info = "variantByteC167Old, tell dmg what cpu you have?"
-        elif byte[0] == variantByteC167:
-            variant_info = "SAK-C167CR-LM"
-        elif byte[0] == variantByteC167WithID:
-            variant_info = "SAK-C167CS-LM"
+        else:# BOT boot sector
+            if(sector == 0):
+                sectorSize = 0x4000
+            elif(sector == 1) | (sector == 2):
+                sectorSize = 0x2000
+            elif(sector == 3):
+                sectorSize = 0x8000
+            else:
+                sectorSize = 0x10000
+
+        sectors.append((sector, offset, sectorSize))
+        offset += sectorSize
+        sector += 1
+    return sectors
+
+def PlanSectors(writeData, sectors, current):
+    # Only sectors whose new content differs from what's in flash need to be erased and programmed
+    changed = []
+    for sector, offset, sectorSize in sectors:
+        newData = writeData[offset:offset+sectorSize]
+        if current[offset:offset+len(newData)] != newData:
+            changed.append((sector, offset, sectorSize))
+    return changed
+
+def SectorRuns(sectors, size):
+    # Adjacent sectors merged into (offset, length) runs within the first size bytes, each read in one go
+    runs = []
+    for sector, offset, sectorSize in sectors:
+        length = min(sectorSize, size - offset)
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1] = (runs[-1][0], runs[-1][1] + length)
         else:
-            variant_info = "no C16x Variant detected, tell dmg what cpu you have?"
-
-        logger.info("", extra={"suppress_format": True}) #blank line
-        logger.info(f"Got CPU Version: {variant_info} (ID: {hex(byte[0])})")
+            runs.append((offset, length))
+    return runs
+
+def CompareFlash(ser, expected, sectors, progress_callback=None, log_callback2=None):
+    """
+    Read sectors of the external flash back and compare them with expected.
+    Returns the offset of the first byte that differs, None if they all match, False if a read failed
+    """
+    for offset, length in SectorRuns(sectors, len(expected)):
+        readBack = io.BytesIO()
+        if not ReadMemory(ser, ExtFlashAddress + offset, length, readBack, progress_callback, log_callback2):
+            return False
+        if readBack.getvalue() != expected[offset:offset+length]:
+            return offset + FindMismatch(expected[offset:offset+length], readBack.getvalue())
+    return None
+
+def ReadCurrentFlash(ser, diffSource, address, size, progress_callback=None, log_callback2=None):
+    # Current flash content, from a reference dump of this ECU or read back through the kernel
+    if diffSource:
+        logger.info(f"Comparing against {diffSource}")
+        with open(diffSource, 'rb') as referenceFile:
+            return referenceFile.read(size)
+
+    logger.info("Reading back external flash to find changed sectors...")
+    current = io.BytesIO()
+    if not ReadMemory(ser, address, size, current, progress_callback, log_callback2):
+        logger.error("Read back not successful!!")
+        return None
+    return current.getvalue()
+
+# C167 registers, flash driver commands and addresses used by the SIMK4x kernel and driver
+SYSCON_Addr         = 0x00ff12
+SYSCON_Data_ext     = 0xe204        # from 15 -0: 3b stksz, 1b ROMS1, 1b SGTDIS, 1b ROMEN, 1b BYTDIS, 1b CLKEN, 1b WRCFG, 1b CSCFG, 1b reserved, 
+                                    # 1b OWDDIS, 1b BDRSTEN, 1b XPEN, 1b VISIBLE, 1b SPER-SHARE
+                                    # e -> rom mapped at >0x0 0000 and a Stacksize = ???, 2 -> Romen = 0 & BytDis = 1
+
+SYSCON_Data_int     = 0xf604        # from 15 -0: 3b stksz, 1b ROMS1, 1b SGTDIS, 1b ROMEN, 1b BYTDIS, 1b CLKEN, 1b WRCFG, 1b CSCFG, 1b reserved, 
+                                    # 1b OWDDIS, 1b BDRSTEN, 1b XPEN, 1b VISIBLE, 1b SPER-SHARE
+                                    # f -> rom mapped at >0x01 0000 and a Stacksize = ???, 6 -> Romen = 1 & BytDis = 1
+BUSCON0_Addr    = 0x00ff0c
+BUSCON0_Data    = 0x04ad            # d = 2 memory cycle wait state, a = 16bit demultiplexed bus - no tristate wait state - 1 read/write delay,
+                                    # 4= external bus active, c chipSelect read/write enable
+
+ADDRSEL1_Addr   = 0x00fe18   
+ADDRSEL1_SIMK4X_Data = 0x4008       # 1024kByte window starting at 0x40 0000 ??
+
+BUSCON1_Addr = 0x00ff14
+BUSCON1_SIMK4X_Data = 0x848e        #  d = 2 memory cycle wait state, 0 = 8bit demultiplexed bus - 1 tristate wait state - 1 read/write delay, 0= external bus inactive
+
+driverAddress = 0x00F600
+FlashDriverEntryPoint = 0x00F640
+
+#driver commands
+C_GETSTATE = 0x0093
+C_READSPI = 0x0036
+C_WRITESPI = 0x0037
+
+#flash driver commands
+FC_PROG                     =	0x00     #Program Flash
+FC_ERASE                    =	0x01	 #Erase Flash
+FC_SETTIMING                =	0x03	 #Set Timing
+FC_GETSTATE                 =	0x06	 #Get State
+FC_GETSTATE_ADDR_MANUFID    =   0x00    
+FC_GETSTATE_ADDR_DEVICEID   =   0x01    
+FC_LOCK                     =	0x10	 #Lock Flash bank
+FC_UNLOCK                   =	0x11	 #Unlock Flash bank
+FC_PROTECT                  =	0x20	 #Protect entire Flash
+FC_UNPROTECT                =	0x21	 #Unprotect Flash
+FC_BLANKCHECK               =	0x34	 #OTP/ Flash blankcheck
+FC_GETID		            =	0x35     #Get Manufacturer ID/ Device ID ->not implemented
 
-        logger.info("Sending SIMK4x Bootstrap")
 
-        path = resource_path("assets/simk4x_bootstrap.bin")
-        
-        loaderfile = open(path, 'rb')
-        loader = loaderfile.read()
-        loaderfile.close()
+#    --------------------- Error Values -----------------------------
+E_NOERROR               =	0x00	 #No error
+E_UNKNOWN_FC            =	0x01	 #Unknown function code
+
+E_PROG_NO_VPP           =	0x10	 #No VPP while programming
+E_PROG_FAILED           =	0x11	 #Programming failed
+E_PROG_VPP_NOT_CONST	=	0x12	 #VPP not constant while programming
+
+E_INVALID_BLOCKSIZE     =	0x1B	 #Invalid blocksize
+E_INVALID_DEST_ADDR     =	0x1C	 #Invalid destination address
+
+E_ERASE_NO_VPP          =	0x30	 #No VPP while erasing
+E_ERASE_FAILED          =	0x31	 #Erasing failed
+E_ERASE_VPP_NOT_CONST	=	0x32	 #VPP not constant while erasing
+
+E_INVALID_SECTOR        =	0x33	 #Invalid sector number
+E_Sector_LOCKED         =	0x34	 #Sector locked
+E_FLASH_PROTECTED       =	0x35	 #Flash protected
+
+IntRomAddress = 0x010000
+ExtFlashAddress = 0x800000
+DriverCopyAddress = 0xFC00
+BlockLength = 0x200
+
+# Lookup table for manufacturer IDs
+manufacturerDetails = {
+    0x01: "AMD",
+    0x20: "ST"
+}
+
+# Lookup table for device IDs (using only the last 2 digits)
+chipDetails = {
+    # AMD chips
+    0x57: ("AM29F200BB", 1 << 18, "Bottom"),
+    0xAB: ("AM29F400BB", 1 << 19, "Bottom"),
+    0x58: ("AM29F800BB", 1 << 20, "Bottom"),
+    0x51: ("AM29F200BT", 1 << 18, "Top"),
+    0x23: ("AM29F400BT", 1 << 19, "Top"),
+    0xD6: ("AM29F800BT", 1 << 20, "Top"),
+    # ST chips
+    0xD4: ("M29F200BB", 1 << 18, "Bottom"),
+    0xD6: ("M29F400BB", 1 << 19, "Bottom"),
+    0xD5: ("M29F200BT", 1 << 18, "Top"),
+    0xD3: ("M29F400BT", 1 << 19, "Top"),
+}
+
+class BslSession:
+    """
+    One ECU in bootstrap mode on one adapter. Holds the serial port and everything detected
+    on the way (CPU variant, kernel state, baudrate, flash chip, sector map), so several jobs
+    can run on the same ECU without uploading the loader, kernel and driver again.
+    Sessions don't share state, several of them can run in parallel threads or processes.
+
+    Either pass an open serial port (ser) or a port name to open.
+    """
+    def __init__(self, port=None, baud=57600, ser=None, maxBaud=BslBaudrates[0], progress_callback=None, log_callback2=None):
+        self.port = port
+        self.baud = baud
+        self.ser = ser
+        self.maxBaud = maxBaud
+        self.progress_callback = progress_callback
+        self.log_callback2 = log_callback2
+
+        self.variant = None             # CPU variant byte, None if the kernel was already running
+        self.kernelRunning = False
+        self.busConfig = None           # "int" or "ext", which SYSCON/BUSCON setup is active
+        self.eetype = None
+        self.driverType = None
+        self.applyReverse = False
+        self.manId = None
+        self.devId = None
+        self.chipType = None
+        self.flashSize = 0
+        self.bootSectorType = None
+        self.botBootSector = False
+        self.writeAddressBase = ExtFlashAddress
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def sectors(self):
+        return GetSectorMap(self.flashSize, self.flashSize, self.botBootSector)
+
+    def open(self):
+        if self.ser is None:
+            logger.info(f"Using {self.port}, baudrate {self.baud}")
+            self.ser = serial.Serial(self.port, self.baud, timeout=3)
+        return self.ser
+
+    def close(self):
+        if self.ser is not None and self.kernelRunning and self.ser.baudrate != self.baud:
+            # the kernel keeps running, the next session says hello at the starting rate again
+            logger.info(f"Switching back to {self.baud} baud...")
+            try:
+                if not SetKernelBaudrate(self.ser, self.baud):
+                    logger.warning(f"Kernel didn't switch back to {self.baud} baud, power cycle the ECU before the next job")
+            except (serial.SerialException, OSError) as e:
+                logger.warning(f"Couldn't switch the kernel back to {self.baud} baud: {e}")
+        if self.ser is not None and self.port is not None:
+            self.ser.close()
+            self.ser = None
+        self.kernelRunning = False
+        self.busConfig = None
+
+    def connect(self):
+        """Upload loader and kernel (unless already running), then switch to a faster baudrate. Returns False on errors"""
+        if self.kernelRunning:
+            return True
+
+        ser = self.open()
+        ResetAdapter(ser)
+        SetAdapterKKL(ser)
+
+        ser.reset_input_buffer()
 
-        SendDatawEcho(ser,loader)
+## Upload Kernel
+        SendDatawEcho(ser,[0])  #say hello, how ya doin'?
         byte = ser.read(1)
         if(len(byte) != 1):
-            logger.info("", extra={"suppress_format": True}) #blank line
-            logger.error("no response from ecu after sending loader")
-            return -1
-        if(byte[0] != I_LOADER_STARTED):
-            logger.error(f"Wrong response from ECU after sending loader, got: {hex(byte[0])} instead of 0x01")
-            return -1
-
-        logger.info(f"Got loader acknowledgment: {I_LOADER_STARTED}")
-
-        logger.info("Sending SIMK4x Kernel")
-
-        path = resource_path("assets/simk4x_kernel.bin")
-        
-        kernelfile = open(path, 'rb')
-        kernel = kernelfile.read()
-        kernelfile.close()
+            logger.error(f"No response from ECU, set device into bootmode: {byte}")
+            return False
+        if(byte[0] != 0xaa):
+            self.variant = byte[0]
+            
+            if byte[0] == variantByteC167Old:
+                variant_info = "variantByteC167Old, tell dmg what cpu you have?"
+            elif byte[0] == variantByteC167:
+                variant_info = "SAK-C167CR-LM"
+            elif byte[0] == variantByteC167WithID:
+                variant_info = "SAK-C167CS-LM"
+            else:
+                variant_info = "no C16x Variant detected, tell dmg what cpu you have?"
 
-        SendDatawEcho(ser,kernel)
-        byte = ser.read(1)
-        if(len(byte) != 1):
             logger.info("", extra={"suppress_format": True}) #blank line
-            logger.error("no response from ecu after sending loader")
-            return -1
-        if(byte[0] != I_APPLICATION_STARTED):
-            logger.error(f"Wrong response from ECU after sending loader, got: {hex(byte[0])} instead of 0x01")
-            return -1
-
-        logger.info(f"Got kernel acknowledgment: {I_APPLICATION_STARTED}")
+            logger.info(f"Got CPU Version: {variant_info} (ID: {hex(byte[0])})")
 
-    else:
-        logger.info("Kernel already running...\n")
-
-    TestComm(ser)
+            logger.info("Sending SIMK4x Bootstrap")
 
-    if(job == jobReadIntRom):
-        logger.info("\n*************  start read IntRom  *************\n", extra={"suppress_format": True})
+            path = resource_path("assets/simk4x_bootstrap.bin")
+            
+            loaderfile = open(path, 'rb')
+            loader = loaderfile.read()
+            loaderfile.close()
 
-        SetWordAtAddress(ser, SYSCON_Addr, SYSCON_Data_int)
+            SendDatawEcho(ser,loader)
+            byte = ser.read(1)
+            if(len(byte) != 1):
+                logger.info("", extra={"suppress_format": True}) #blank line
+                logger.error("no response from ecu after sending loader")
+                return False
+            if(byte[0] != I_LOADER_STARTED):
+                logger.error(f"Wrong response from ECU after sending loader, got: {hex(byte[0])} instead of 0x01")
+                return False
 
-        offset = 0x0
-        readsize = BlockLength
+            logger.info(f"Got loader acknowledgment: {I_LOADER_STARTED}")
 
-        logger.info(f"Reading internal ROM of size {size}kb...")
-        try:
-            while (offset < size):
-                if((size - offset) < BlockLength):
-                    readsize = (size - offset)
-                success, blockData = GetBlockAtAddress(ser, IntRomAddress+offset, readsize)
-                if(success == True):
-                    file.write(bytes(blockData))
-                else:
-                    logger.error("read IntRom not successful!!")
-                    return 1
+            logger.info("Sending SIMK4x Kernel")
 
-                offset += readsize
+            path = resource_path("assets/simk4x_kernel.bin")
+            
+            kernelfile = open(path, 'rb')
+            kernel = kernelfile.read()
+            kernelfile.close()
+
+            SendDatawEcho(ser,kernel)
+            byte = ser.read(1)
+            if(len(byte) != 1):
+                logger.info("", extra={"suppress_format": True}) #blank line
+                logger.error("no response from ecu after sending loader")
+                return False
+            if(byte[0] != I_APPLICATION_STARTED):
+                logger.error(f"Wrong response from ECU after sending loader, got: {hex(byte[0])} instead of 0x01")
+                return False
+
+            logger.info(f"Got kernel acknowledgment: {I_APPLICATION_STARTED}")
 
-                percentage = int(offset * 100 / size)
-                
-                # GUI Progress Update
-                if progress_callback:
-                    progress_callback(percentage)
-                 # Construct the message to send back to the gui
-                message = f"read at {hex(offset)}  finished {int(offset * 100 / size)} %"
+        else:
+            logger.info("Kernel already running...\n")
 
-                if log_callback2:
-                    log_callback2.emit(message)
+        TestComm(ser)
+        if EscalateBaudrate(ser, self.maxBaud) is None:
+            return False
 
-                # CLI Progress
-                else:
-                    sys.stdout.write("\r  read at "+ str(hex(offset)) +"  finished " + str(int(offset *100 / size)) +" % ")
-        except Exception as e:
-            logger.error(f"An error occurred during read: {str(e)}")
-            raise
-        finally:
-            logger.info("", extra={"suppress_format": True}) #blank line
-            logger.info(f"File has been saved to: {filename}")
-            logger.info("\n*************  finish read IntRom  *************\n", extra={"suppress_format": True})
+        self.kernelRunning = True
+        return True
 
+    def configure_bus(self, busConfig):
+        if self.busConfig == busConfig:
+            return
+        if busConfig == "int":
+            SetWordAtAddress(self.ser, SYSCON_Addr, SYSCON_Data_int)
+        else:
+            SetWordAtAddress(self.ser, SYSCON_Addr, SYSCON_Data_ext)
+            SetWordAtAddress(self.ser, BUSCON0_Addr, BUSCON0_Data)
 
+            SetWordAtAddress(self.ser, ADDRSEL1_Addr, ADDRSEL1_SIMK4X_Data)
+            SetWordAtAddress(self.ser, BUSCON1_Addr, BUSCON1_SIMK4X_Data)
+        self.busConfig = busConfig
 
-    def detect_ecu_type_and_configure(ser):
+    def read_eeprom_ids(self, apply_reverse=False):
+        """
+        Reads Manufacturer and Device IDs from EEPROM.
+        Optionally applies reverse mapping for the 2.0L ECU.
+        """
+        # Retrieve Manufacturer ID
+        writeAddressHigh = (self.writeAddressBase >> 16) & 0xFFFF
+        readAddressHigh = (ExtFlashAddress >> 16) & 0xFFFF
+        register = [FC_GETSTATE, 0x0000, writeAddressHigh, readAddressHigh, 0x000, 0x000, FC_GETSTATE_ADDR_MANUFID, 0x0001]
+        success, retRegister = CallAtAddress(self.ser, FlashDriverEntryPoint, register)
+        if not success or len(retRegister) < 2:
+            logger.warning("Failed to retrieve Manufacturer ID.")
+            return None, None
+        manId = GetBackCrossedWord(retRegister[1]) if apply_reverse else retRegister[1]
+
+        # Retrieve Device ID
+        register = [FC_GETSTATE, 0x0000, writeAddressHigh, readAddressHigh, 0x000, 0x000, FC_GETSTATE_ADDR_DEVICEID, 0x0001]
+        success, retRegister = CallAtAddress(self.ser, FlashDriverEntryPoint, register)
+        if not success or len(retRegister) < 2:
+            logger.warning("Failed to retrieve Device ID.")
+            return None, None
+        devId = GetBackCrossedWord(retRegister[1]) & 0xFF if apply_reverse else retRegister[1] & 0xFF
+
+        return manId, devId
+
+    def detect(self, eetype=None, confirm_unknown=None):
         """
         Detects the ECU type or uses the provided `eetype` override, sends the appropriate driver,
         retrieves EEPROM IDs (with reverse mapping for 2.0L), determines flash size, and identifies boot sector type.
+        Done once per session, later calls return what was detected.
+
+        confirm_unknown is called when the IDs can't be read, e.g. to ask the user whether to go on,
+        and returns False to abort.
         """
-        global writeAddressBase, botBootSector, manId, devId, flashSize
-
-        # Lookup table for manufacturer IDs
-        manufacturerDetails = {
-            0x01: "AMD",
-            0x20: "ST"
-        }
-
-        # Lookup table for device IDs (using only the last 2 digits)
-        chipDetails = {
-            # AMD chips
-            0x57: ("AM29F200BB", 1 << 18, "Bottom"),
-            0xAB: ("AM29F400BB", 1 << 19, "Bottom"),
-            0x58: ("AM29F800BB", 1 << 20, "Bottom"),
-            0x51: ("AM29F200BT", 1 << 18, "Top"),
-            0x23: ("AM29F400BT", 1 << 19, "Top"),
-            0xD6: ("AM29F800BT", 1 << 20, "Top"),
-            # ST chips
-            0xD4: ("M29F200BB", 1 << 18, "Bottom"),
-            0xD6: ("M29F400BB", 1 << 19, "Bottom"),
-            0xD5: ("M29F200BT", 1 << 18, "Top"),
-            0xD3: ("M29F400BT", 1 << 19, "Top"),
-        }
+        self.configure_bus("ext")
+        if self.chipType is not None and eetype in (None, self.eetype):
+            return self.chipType, self.flashSize, self.bootSectorType
 
+        ser = self.ser
         # Always initialize writeAddressBase
-        writeAddressBase = ExtFlashAddress
-
-        SetWordAtAddress(ser, SYSCON_Addr, SYSCON_Data_ext)
-        SetWordAtAddress(ser, BUSCON0_Addr, BUSCON0_Data)
-
-        SetWordAtAddress(ser, ADDRSEL1_Addr, ADDRSEL1_SIMK4X_Data)
-        SetWordAtAddress(ser, BUSCON1_Addr, BUSCON1_SIMK4X_Data)
-
-        def read_eeprom_ids(apply_reverse=False):
-            """
-            Reads Manufacturer and Device IDs from EEPROM.
-            Optionally applies reverse mapping for the 2.0L ECU.
-            """
-            # Retrieve Manufacturer ID
-            writeAddressHigh = (writeAddressBase >> 16) & 0xFFFF
-            readAddressHigh = (ExtFlashAddress >> 16) & 0xFFFF
-            register = [FC_GETSTATE, 0x0000, writeAddressHigh, readAddressHigh, 0x000, 0x000, FC_GETSTATE_ADDR_MANUFID, 0x0001]
-            success, retRegister = CallAtAddress(ser, FlashDriverEntryPoint, register)
-            if not success or len(retRegister) < 2:
-                logger.warning("Failed to retrieve Manufacturer ID.")
-                return None, None
-            manId = GetBackCrossedWord(retRegister[1]) if apply_reverse else retRegister[1]
-
-            # Retrieve Device ID
-            register = [FC_GETSTATE, 0x0000, writeAddressHigh, readAddressHigh, 0x000, 0x000, FC_GETSTATE_ADDR_DEVICEID, 0x0001]
-            success, retRegister = CallAtAddress(ser, FlashDriverEntryPoint, register)
-            if not success or len(retRegister) < 2:
-                logger.warning("Failed to retrieve Device ID.")
-                return None, None
-            devId = GetBackCrossedWord(retRegister[1]) & 0xFF if apply_reverse else retRegister[1] & 0xFF
-
-            return manId, devId
+        self.writeAddressBase = ExtFlashAddress
 
         # Determine the driver path and reverse mapping upfront
         if eetype == "T_29FX00B_SIMK4X_V6":
@@ -588,11 +892,11 @@ def RunFunc(exit, ser, file, job, size, eetype, portAddr4, directionPortAddress4
             with open(driver_path, 'rb') as driverFile:
                 eepromDriver = list(driverFile.read())
             SetBlockAtAddress(ser, driverAddress, eepromDriver)
-            manId, devId = read_eeprom_ids()
+            manId, devId = self.read_eeprom_ids()
 
             # Switch to 2.0L driver if Manufacturer ID is not for V6
             if manId != 0x01 and manId != 0x20:
-                logger.warning(f"Unexpected Manufacturer ID: {hex(manId)}. Switching to 2.0L driver.\n")
+                logger.warning(f"Unexpected Manufacturer ID: {hex(manId) if manId is not None else None}. Switching to 2.0L driver.\n")
                 driver_path = resource_path("assets/simk4x_driver_i4_a29fx00bx.bin")
                 apply_reverse = True
                 driver_type = "2.0L"
@@ -602,13 +906,16 @@ def RunFunc(exit, ser, file, job, size, eetype, portAddr4, directionPortAddress4
         with open(driver_path, 'rb') as driverFile:
             eepromDriver = list(driverFile.read())
         SetBlockAtAddress(ser, driverAddress, eepromDriver)
+        self.eetype, self.driverType, self.applyReverse = eetype, driver_type, apply_reverse
 
         # Read Manufacturer and Device IDs
-        manId, devId = read_eeprom_ids(apply_reverse)
+        manId, devId = self.read_eeprom_ids(apply_reverse)
         if manId is None or devId is None:
             logger.warning("Failed to detect EEPROM IDs.")
-            input("\n Warning: EEPROM ID not recognized, press ENTER to proceed manually or CTRL + C to abort.\n")
+            if confirm_unknown and not confirm_unknown():
+                raise RuntimeError("EEPROM ID not recognized, aborted")
             return "Unknown", 0, "Unknown"
+        self.manId, self.devId = manId, devId
 
         # Log manufacturer name if available
         manufacturerName = manufacturerDetails.get(manId, "Unknown Manufacturer")
@@ -622,81 +929,110 @@ def RunFunc(exit, ser, file, job, size, eetype, portAddr4, directionPortAddress4
         logger.info(f"Detected Chip: {chipType}, Size: {hex(flashSize)}, Boot Sector: {bootSectorType}")
 
         # Set boot sector flag
-        botBootSector = bootSectorType == "Bottom"
+        self.chipType, self.flashSize, self.bootSectorType = chipType, flashSize, bootSectorType
+        self.botBootSector = bootSectorType == "Bottom"
 
         return chipType, flashSize, bootSectorType
 
-
-    if(job == jobHwInfo):
+    def hwinfo(self, confirm_unknown=None):
         logger.info("\n*************  start hwinfo  *************\n", extra={"suppress_format": True})
 
         # Detect ECU type and configure
-        chipType, flashSize, bootSectorType = detect_ecu_type_and_configure(ser)
+        chipType, flashSize, bootSectorType = self.detect(self.eetype, confirm_unknown)
 
         # Progress bar simulation for display purposes
-        if progress_callback:
+        if self.progress_callback:
             for percentage in range(0, 101, 10):
-                progress_callback(percentage)
+                self.progress_callback(percentage)
                 time.sleep(0.1)  # Simulate processing delay
 
         logger.info("\n*************  end hwinfo  *************\n", extra={"suppress_format": True})
+        return True
 
-        return 1
+    def read_int_rom(self, file, size):
+        logger.info("\n*************  start read IntRom  *************\n", extra={"suppress_format": True})
 
+        self.configure_bus("int")
 
+        logger.info(f"Reading internal ROM of size {size}kb...")
+        try:
+            if not ReadMemory(self.ser, IntRomAddress, size, file, self.progress_callback, self.log_callback2):
+                logger.error("read IntRom not successful!!")
+                return False
+        except Exception as e:
+            logger.error(f"An error occurred during read: {str(e)}")
+            raise
+        finally:
+            logger.info("", extra={"suppress_format": True}) #blank line
+            logger.info(f"File has been saved to: {getattr(file, 'name', file)}")
+            logger.info("\n*************  finish read IntRom  *************\n", extra={"suppress_format": True})
+        return True
 
-    if(job == jobWriteExtFlash):    
-        logger.info("\n*************  start write extFlash  *************\n", extra={"suppress_format": True})
+    def read_ext_flash(self, file, size=None, eetype=None, confirm_unknown=None):
+        logger.info("\n*************  start read extFlash  *************\n", extra={"suppress_format": True})
 
-##        logger.info("\n *************  write reset to read (f0)  *************\n", extra={"suppress_format": True})
-##        SetWordAtAddress(ser, 0x400000, 0xf0)
+        # Detect ECU type and configure
+        chipType, flashSize, bootSectorType = self.detect(eetype, confirm_unknown)
+
+        # Use auto-detected flash size
+        flashSize = flashSize or size or 0
+        logger.info(f"Reading external flash of size {flashSize}kb...")
+        if not ReadMemory(self.ser, ExtFlashAddress, flashSize, file, self.progress_callback, self.log_callback2):
+            logger.error("Read extFlash not successful!!")
+            return False
+
+        logger.info("", extra={"suppress_format": True}) #blank line
+        logger.info(f"File has been saved to: {getattr(file, 'name', file)}")
+        logger.info("\n*************  finish read extFlash  *************\n", extra={"suppress_format": True})
+        return True
+
+    def write_ext_flash(self, writeData, eetype=None, diffSource=None, confirm_unknown=None):
+        """
+        Erase and program the external flash with writeData. With diffSource (path of a dump
+        of this ECU, or "" to read the flash back) only sectors that differ are touched - sectors a
+        reference dump leaves out are checked against the chip first, and the programmed ones are read back
+        """
+        logger.info("\n*************  start write extFlash  *************\n", extra={"suppress_format": True})
 
-##        GetFlashManufacturerID(ser)
-        
         # Detect ECU type and configure
-        chipType, flashSize, bootSectorType = detect_ecu_type_and_configure(ser)
+        chipType, flashSize, bootSectorType = self.detect(eetype, confirm_unknown)
 
-        offset = 0x0
+        ser, writeAddressBase = self.ser, self.writeAddressBase
+        progress_callback, log_callback2 = self.progress_callback, self.log_callback2
 
-        # read data to know size
-        writeData = file.read()
         size = len(writeData)
 
-#************* Erase*********
-        sector = 0
-        sectorSize = 0
-        while (offset < size):
-            if(botBootSector == False): # Top boot sector
-                if(flashSize ==  (1<<20)): #size f800 1024kB
-                    if(sector == 18):
-                        sectorSize = 0x4000
-                    elif(sector == 17) | (sector == 16):
-                        sectorSize = 0x2000
-                    elif(sector == 15):
-                        sectorSize = 0x8000
-                    else:
-                        sectorSize = 0x10000
-
-                else: #size f400 512kB
-                    if(sector == 10):
-                        sectorSize = 0x4000
-                    elif(sector == 9) | (sector == 8):
-                        sectorSize = 0x2000
-                    elif(sector == 7):
-                        sectorSize = 0x8000
-                    else:
-                        sectorSize = 0x10000
-
-            else:# BOT boot sector
-                if(sector == 0):
-                    sectorSize = 0x4000
-                elif(sector == 1) | (sector == 2):
-                    sectorSize = 0x2000
-                elif(sector == 3):
-                    sectorSize = 0x8000
-                else:
-                    sectorSize = 0x10000
+        allSectors = GetSectorMap(size, self.flashSize, self.botBootSector)
+        sectors = allSectors
+        if diffSource is not None:
+            current = ReadCurrentFlash(ser, diffSource, ExtFlashAddress, size, progress_callback, log_callback2)
+            if current is None:
+                return False
+            sectors = PlanSectors(writeData, allSectors, current)
+
+            if diffSource:
+                # A stale or wrong reference would leave the flash holding a mix of two images,
+                # so the sectors it says can be skipped are read back from the chip first
+                logger.info("Checking the reference against the sectors it leaves out...")
+                mismatch = CompareFlash(ser, current, [sector for sector in allSectors if sector not in sectors], progress_callback, log_callback2)
+                if mismatch is False:
+                    logger.error("Read back not successful!!")
+                    return False
+                if mismatch is not None:
+                    logger.warning(f"{diffSource} differs from the flash at {hex(mismatch)}, reading the whole flash back instead")
+                    current = ReadCurrentFlash(ser, "", ExtFlashAddress, size, progress_callback, log_callback2)
+                    if current is None:
+                        return False
+                    sectors = PlanSectors(writeData, allSectors, current)
+
+            logger.info(f"{len(sectors)} sectors differ: {', '.join([str(sector) for sector, offset, sectorSize in sectors]) or 'none'}")
+            if not sectors:
+                logger.info("\n********** flash already up to date ***********\n", extra={"suppress_format": True})
+                return True
 
+#************* Erase*********
+        retRegister = [0]*8
+        for sector, offset, sectorSize in sectors:
             writeAddressHigh = ((writeAddressBase + offset) >>16) & 0xFFFF
             writeAddressLow = (writeAddressBase + offset) & 0xFFFF
             readAddressHigh = ((ExtFlashAddress + offset) >>16) & 0xFFFF
@@ -708,7 +1044,7 @@ def RunFunc(exit, ser, file, job, size, eetype, portAddr4, directionPortAddress4
             success , retRegister = CallAtAddress(ser, FlashDriverEntryPoint,register)
             if(success == False):   # | (retRegister[7] != 0x0): prevent list index out of range, when running this on 2.0L python .\bsl.py 57600 -writeextflash .\blank_with_1234.bin simk4x_v6
                 logger.error("Call FC_ERASE failed\n")
-                return -1
+                return False
             
             #logger.info(f"Call FC_ERASE Sector {sector} successful: {retRegister[7] == 0x0}, return sector address: {hex(retRegister[5])}, timeout counter: {hex(retRegister[6])}")
 
@@ -728,128 +1064,108 @@ def RunFunc(exit, ser, file, job, size, eetype, portAddr4, directionPortAddress4
             else:
                 sys.stdout.write("\rCall FC_ERASE Sector "+ str(sector) +" successful: "  + str(retRegister[7]== 0x0))
 
-            offset += sectorSize
-            sector += 1
-
         logger.info("", extra={"suppress_format": True}) #blank line
-        logger.info("Successfully Erased %s Sectors: %s", sector-1, retRegister[7] == 0x0)
+        logger.info("Successfully Erased %s Sectors: %s", len(sectors), retRegister[7] == 0x0)
 
 #************* Write*********
-        offset = 0x0
-        writesize = BlockLength
-
         logger.info(f"Writing external flash of size {size}kb...")
-        while (offset < size):
-            if((size - offset) < BlockLength):
-                writesize = (size - offset)
-            blockData = writeData[offset:(offset+writesize)]
-            write = False
-            for e in blockData:
-                if(e != 0xff):
-                    write = True
-            if (write == True):
-                success = SetBlockAtAddress(ser, DriverCopyAddress, list(writeData[offset:(offset+writesize)]))
-
-                if(success != True):
-                    logger.error("Write not successful!!")
-                    return -1
-
-                writeAddress = writeAddressBase + offset
-                writeAddressHigh = writeAddress >>16
-                writeAddressLow = writeAddress & 0xFFFF
-                
-                readAddressHigh = ((ExtFlashAddress + offset) >>16) & 0xFFFF
-                
-                register = [FC_PROG, writesize, DriverCopyAddress, 0x0000, readAddressHigh, writeAddressLow, writeAddressHigh, 0x0001]
-
-    ##            for i in register:
-    ##                logger.info(hex(i))
-    ##            logger.info("", extra={"suppress_format": True}) #blank line
-                success , retRegister = CallAtAddress(ser, FlashDriverEntryPoint,register)
-                if(success == False) | (retRegister[7] != 0x0):
-                    logger.error("Call FC_PROGRAM failed")
-                    logger.info("Debug Registers")
-                    for r in retRegister:
-                        logger.info(hex(r))
-                    logger.info("", extra={"suppress_format": True}) #blank line
-                    return -1
-                
-                offset += writesize
-
-                # GUI Progress Bar Update
-                percentage = int(offset * 100 / size)
-
-                if progress_callback:
-                    progress_callback(percentage)
-
-                # Construct the message to send back to the gui
-                message = f"Call FC_PROGRAM BLOCK {str(hex(offset))}  successful: {str(retRegister[7] == 0x0)} finished {str(int(offset *100 / size))} %"
-
-                if log_callback2:
-                    log_callback2.emit(message)
-
-                # CLI Progress
-                else:
-                    sys.stdout.write("\rCall FC_PROGRAM BLOCK "+ str(hex(offset)) +" successful: "  + str(retRegister[7]== 0x0)+"  finished " + str(int(offset *100 / size)) +" %")
-
-            else:
-                offset += writesize
-                # Construct the message to send back to the gui
-                message = f"only 0xff in block -> nothing to write. Finished {str(int(offset *100 / size))} %"
-
-                if log_callback2:
-                    log_callback2.emit(message)
+        for sector, sectorOffset, sectorSize in sectors:
+            offset = sectorOffset
+            sectorEnd = min(sectorOffset + sectorSize, size)
+            while (offset < sectorEnd):
+                writesize = min(BlockLength, sectorEnd - offset)
+                blockData = writeData[offset:(offset+writesize)]
+                write = blockData != b'\xff' * writesize
+                if (write == True):
+                    success = SetBlockAtAddress(ser, DriverCopyAddress, list(writeData[offset:(offset+writesize)]))
+
+                    if(success != True):
+                        logger.error("Write not successful!!")
+                        return False
+
+                    writeAddress = writeAddressBase + offset
+                    writeAddressHigh = writeAddress >>16
+                    writeAddressLow = writeAddress & 0xFFFF
                     
-                # CLI Progress
-                else:
-                    sys.stdout.write("\r only 0xff in block -> nothing to write "+"  finished " + str(int(offset *100 / size)) +" % ")
+                    readAddressHigh = ((ExtFlashAddress + offset) >>16) & 0xFFFF
+                    
+                    register = [FC_PROG, writesize, DriverCopyAddress, 0x0000, readAddressHigh, writeAddressLow, writeAddressHigh, 0x0001]
+
+        ##            for i in register:
+        ##                logger.info(hex(i))
+        ##            logger.info("", extra={"suppress_format": True}) #blank line
+                    success , retRegister = CallAtAddress(ser, FlashDriverEntryPoint,register)
+                    if(success == False) | (retRegister[7] != 0x0):
+                        logger.error("Call FC_PROGRAM failed")
+                        logger.info("Debug Registers")
+                        for r in retRegister:
+                            logger.info(hex(r))
+                        logger.info("", extra={"suppress_format": True}) #blank line
+                        return False
+                    
+                    offset += writesize
 
-        logger.info("Successfully Programmed %s :%s",hex(offset),retRegister[7] == 0x0)
+                    # GUI Progress Bar Update
+                    percentage = int(offset * 100 / size)
 
-        logger.info("\n********** write extFlash successful!! ***********\n", extra={"suppress_format": True})
-        return 1
+                    if progress_callback:
+                        progress_callback(percentage)
 
-    if job == jobReadExtFlash:
-        logger.info("\n*************  start read extFlash  *************\n", extra={"suppress_format": True})
+                    # Construct the message to send back to the gui
+                    message = f"Call FC_PROGRAM BLOCK {str(hex(offset))}  successful: {str(retRegister[7] == 0x0)} finished {str(int(offset *100 / size))} %"
 
-        # Detect ECU type and configure
-        chipType, flashSize, bootSectorType = detect_ecu_type_and_configure(ser)
+                    if log_callback2:
+                        log_callback2.emit(message)
 
-        offset = 0x0
-        readsize = BlockLength
+                    # CLI Progress
+                    else:
+                        sys.stdout.write("\rCall FC_PROGRAM BLOCK "+ str(hex(offset)) +" successful: "  + str(retRegister[7]== 0x0)+"  finished " + str(int(offset *100 / size)) +" %")
 
-        logger.info(f"Reading external flash of size {flashSize}kb...")
-        # Use auto-detected flash size
-        while offset < flashSize:
-            if (flashSize - offset) < BlockLength:
-                readsize = (flashSize - offset)
-            
-            success, blockData = GetBlockAtAddress(ser, ExtFlashAddress + offset, readsize)
-            if success:
-                file.write(bytes(blockData))
-            else:
-                logger.error("Read extFlash not successful!!")
-                return 1
+                else:
+                    offset += writesize
+                    # Construct the message to send back to the gui
+                    message = f"only 0xff in block -> nothing to write. Finished {str(int(offset *100 / size))} %"
+
+                    if log_callback2:
+                        log_callback2.emit(message)
+                        
+                    # CLI Progress
+                    else:
+                        sys.stdout.write("\r only 0xff in block -> nothing to write "+"  finished " + str(int(offset *100 / size)) +" % ")
 
-            offset += readsize
+        logger.info("Successfully Programmed %s :%s",hex(offset),retRegister[7] == 0x0)
 
-            # GUI Progress Bar Update
-            percentage = int(offset * 100 / flashSize)
-            if progress_callback:
-                progress_callback(percentage)
+        if diffSource is not None:
+            # skipped sectors were only planned, make sure the written ones ended up as intended
+            logger.info("Reading back the programmed sectors...")
+            mismatch = CompareFlash(ser, writeData, sectors, progress_callback, log_callback2)
+            if mismatch is not None:
+                logger.error("Verification not successful!!" if mismatch is False else f"Programmed flash differs from the file at {hex(mismatch)}!!")
+                return False
 
-            # Construct the message to send back to the GUI
-            message = f"read at {hex(offset)} finished {percentage} %"
-            if log_callback2:
-                log_callback2.emit(message)
+        logger.info("\n********** write extFlash successful!! ***********\n", extra={"suppress_format": True})
+        return True
 
-            # CLI Progress
-            else:
-                sys.stdout.write(f"\r  read at {hex(offset)} finished {percentage} % ")
+def RunFunc(exit, ser, file, job, size, eetype, portAddr4, directionPortAddress4, pinnum, progress_callback=None, log_callback2=None, diffSource=None, maxBaud=BslBaudrates[0]):
+    # Single job on an already open port, kept for callers of the old interface
+    session = BslSession(ser=ser, maxBaud=maxBaud, progress_callback=progress_callback, log_callback2=log_callback2)
+    return RunJob(session, job, file, size, eetype, diffSource)
 
-        logger.info("", extra={"suppress_format": True}) #blank line
-        logger.info(f"File has been saved to: {filename}")
-        logger.info("\n*************  finish read extFlash  *************\n", extra={"suppress_format": True})
+def RunJob(session, job, file, size=None, eetype=None, diffSource=None, confirm_unknown=None):
+    # 1 when done (also after a failed read, like before), -1 on errors
+    if not session.connect():
+        return -1
+
+    if(job == jobHwInfo):
+        session.hwinfo(confirm_unknown)
+        return 1
+    if(job == jobReadIntRom):
+        session.read_int_rom(file, size)
+        return 1
+    if(job == jobWriteExtFlash):
+        return 1 if session.write_ext_flash(file.read(), eetype, diffSource, confirm_unknown) else -1
+    if(job == jobReadExtFlash):
+        session.read_ext_flash(file, size, eetype, confirm_unknown)
         return 1
     return 1   # != 0 ... exit
 
@@ -876,158 +1192,163 @@ def PrintUsage():
           "     bsl.py  baudrate  -writeextflash   filename       Ecu Type  \n"+
           "eg:  bsl.py  57600     -writeextflash   ca663045.bin   simk4x_i4\n"+
           "eg:  bsl.py  57600     -writeextflash   ca664019.bin   simk4x_v6\n"+
+          "\n     only erase and program sectors that differ from a dump of the ECU\n"+
+          "     (the sectors left out are checked against the ECU, the programmed ones read back):\n"+
+          "eg:  bsl.py  57600     -writeextflash   tune.bin  simk4x_i4  -diff=ca663045.bin\n"+
+          "     or read the flash back first to find them:\n"+
+          "eg:  bsl.py  57600     -writeextflash   tune.bin  simk4x_i4  -diff\n"+
           "------------------------------------------------------------------------\n"+
           
           "\n-------------------- Baudrate ------------------------------------------\n"+
           " standard rates: 9600, 19200, 28800, 38400 (default: 57600)\n"
+          " once the kernel runs it is switched up to 125000 baud, -maxbaud=rate limits that\n"
+          " (-maxbaud=0 keeps the starting rate)\n"
+          "------------------------------------------------------------------------\n"+
+          "\n-------------------- Port ----------------------------------------------\n"+
+          " -port=COM3 or -port=/dev/ttyUSB0 skips adapter detection\n"
           "------------------------------------------------------------------------\n", extra={"suppress_format": True})
 
 
-# Global Variables
+# Jobs
 jobHwInfo = 0
 jobReadIntRom = 1
 jobReadExtFlash = 2
 jobWriteExtFlash = 3
-size = 0x200
-baud = 57600
 portAddr4 = Port4Address8bit
 directionPortAddress4 = DirectionPort4Address8bit
 pinnum = 7
 
-def run_bsl_loop(progress_callback=None, log_callback2=None):
-    """Executes the main BSL loop."""
-    global exit, usbpresent, state, printwait, ports, filename, job, size, baud, eetype, file
-    try:
-        while exit == 0:
-            try:
-                if state == 0:
-                    raise RuntimeError("Unexpected state 0 in run_bsl_loop.")
-                elif state == 10:
-                    if printwait == 0:
-                        logger.info("\nBootstrap Loader for Siemens SIMK4x ECU's \n********************************************\n", extra={"suppress_format": True})
-                        logger.info("Waiting for K+Can or KKL Adapter (plug in USB if not done!!)")
-                        printwait = 1
-                    while usbpresent == 0:
-                        time.sleep(1)
-                        usbPort = serial.tools.list_ports.grep("USB Serial Port")
-                        for port in usbPort:
-                            ports.append(port)
-                            usbpresent = 1
-                            state = 11
-                            printwait = 0
-
-                elif state == 11:
-                    comcounter = 0
-                    if len(ports) > 1:
-                        while comcounter < len(ports):
-                            logger.info(f"num: {comcounter} : {ports[comcounter]}")
-                            comcounter += 1
-                        num = input("Select COM Port (position number): ")
-                        try:
-                            comcounter = int(num)
-                            if comcounter >= len(ports) or comcounter < 0:
-                                logger.warning("Invalid input")
-                                usbpresent = 0
-                                state = 10
-                                ports = []
-                        except ValueError:
-                            logger.warning("Invalid input")
-                            usbpresent = 0
-                            state = 10
-                            ports = []
-                    if usbpresent == 1:
-                        logger.info(f"Using {ports[comcounter].device}, baudrate {baud}")
-                        ser = serial.Serial(ports[comcounter].device, baud, timeout=3)
-                        ser.reset_input_buffer()
-                        state = 20
-
-                elif state == 20:
-                    try:
-                        exit = RunFunc(exit, ser, file, job, size, eetype, Port4Address8bit, DirectionPort4Address8bit, pinnum, progress_callback=progress_callback, log_callback2=log_callback2)
-                    except Exception as e:
-                        exit = -1
-                        traceback.print_exc()
-                        logger.error(f"Job execution failed: {e}")
-            except Exception as e:
-                exit = 1
-                traceback.print_exc()
-                logger.error(f"Exception in loop: {e}")
-    finally:
+def FindPort():
+    """Wait for a K+Can or KKL adapter, ask which one to use if there are several (command line only)"""
+    logger.info("\nBootstrap Loader for Siemens SIMK4x ECU's \n********************************************\n", extra={"suppress_format": True})
+    logger.info("Waiting for K+Can or KKL Adapter (plug in USB if not done!!)")
+    while True:
+        ports = []
+        while not ports:
+            time.sleep(1)
+            ports = list(serial.tools.list_ports.grep("USB Serial Port"))
+
+        if len(ports) == 1:
+            return ports[0].device
+
+        for comcounter, port in enumerate(ports):
+            logger.info(f"num: {comcounter} : {port}")
+        num = input("Select COM Port (position number): ")
         try:
-            if file:
-                file.close()
-        except Exception as cleanup_error:
-            logger.error(f"Error during cleanup: {cleanup_error}")
+            comcounter = int(num)
+            if 0 <= comcounter < len(ports):
+                return ports[comcounter].device
+        except ValueError:
+            pass
+        logger.warning("Invalid input")
+
+def ParseArgs(args):
+    """
+    Turn the command line arguments into a job description:
+    dict with job, baud, size, filename, eetype, diffSource, maxBaud and port
+    """
+    if len(args) < 2:
+        raise ValueError("Not enough arguments provided.")
+
+    options = {
+        'size': None,           # Default to None for auto-detection
+        'eetype': None,         # Default to None for auto-detection
+        'filename': None,
+        'diffSource': None,     # None: write every sector, "": read back, otherwise reference dump
+        'maxBaud': BslBaudrates[0], # highest rate used once the kernel runs
+        'port': None            # serial port, found automatically if None
+    }
 
+    # -diff[=reference.bin], -maxbaud=rate and -port=name can be given anywhere after the command
+    flags = [arg for arg in args[2:] if arg.startswith('-')]
+    args = args[:2] + [arg for arg in args[2:] if not arg.startswith('-')]
+    for flag in flags:
+        if flag.lower().startswith("-diff"):
+            options['diffSource'] = flag.split('=', 1)[1] if '=' in flag else ""
+        elif flag.lower().startswith("-maxbaud="):
+            options['maxBaud'] = int(flag.split('=', 1)[1])
+        elif flag.lower().startswith("-port="):
+            options['port'] = flag.split('=', 1)[1]
+        else:
+            raise ValueError(f"Invalid option: {flag}")
+
+    options['baud'] = int(args[0])
+    opt1 = args[1]
+
+    if "hwinfo" in opt1.lower():
+        options['job'] = jobHwInfo
+
+    elif "readint" in opt1.lower():
+        options['size'] = int(args[2], 16 if args[2].startswith('0x') else 10)
+        options['filename'] = args[3] if len(args) > 3 else "intRom.bin"
+        options['job'] = jobReadIntRom
+
+    elif "readextflash" in opt1.lower():
+        if len(args) > 2:  # Check if size is provided
+            options['size'] = int(args[2], 16 if args[2].startswith('0x') else 10)
+        options['filename'] = args[3] if len(args) > 3 else "extFlash.bin"
+        options['job'] = jobReadExtFlash
+
+    elif "writeextflash" in opt1.lower():
+        if len(args) < 3:
+            raise ValueError("Missing arguments for writeextflash command.")
+        options['filename'] = args[2]
+        eetype_str = args[3].lower() if len(args) > 3 else None
+        options['eetype'] = "T_29FX00B_SIMK4X_I4" if eetype_str and "simk4x_i4" in eetype_str else (
+        "T_29FX00B_SIMK4X_V6" if eetype_str and "simk4x_v6" in eetype_str else None
+        )
+        options['job'] = jobWriteExtFlash
 
-# Main callable function
-def execute_bsl(args, progress_callback=None, log_callback2=None):
+    else:
+        raise ValueError(f"Invalid command: {opt1}")
 
-    global exit, usbpresent, state, printwait, ports, filename, job, size, baud, eetype, file
+    return options
 
-    # reset vars before each run
-    exit = 0
-    usbpresent = 0
-    state = 10  # Reset to the starting state
-    printwait = 0
-    ports = []
-    file = None
-    job = 0
-    size = None  # Default to None for auto-detection
-    eetype = None  # Default to None for auto-detection
+def confirm_unknown_eeprom():
+    input("\n Warning: EEPROM ID not recognized, press ENTER to proceed manually or CTRL + C to abort.\n")
+    return True
 
+# Main callable function
+def execute_bsl(args, progress_callback=None, log_callback2=None, session=None, port=None, confirm_unknown=None):
+    """
+    Run a single BSL job described by command line style arguments. Pass a session
+    to run it on an ECU that's already connected, otherwise one is opened (and closed) here
+    on -port= from the arguments or on port. confirm_unknown() is asked whether to go on
+    when the EEPROM IDs can't be read - the caller decides how (a console prompt, a dialog).
+    Returns 1 when done, -1 on errors
+    """
     #logger.info(f"Received args in execute_bsl: {args}")
     try:
-        if len(args) < 2:
-            raise ValueError("Not enough arguments provided.")
-
-        baud = int(args[0])
-        opt1 = args[1]
-
-        if "hwinfo" in opt1.lower():
-            job = jobHwInfo
-            state = 10
-
-        elif "readint" in opt1.lower():
-            size = int(args[2], 16 if args[2].startswith('0x') else 10)
-            filename = args[3] if len(args) > 3 else "intRom.bin"
-            file = open(filename, 'wb')
-            job = jobReadIntRom
-            state = 10
-
-        elif "readextflash" in opt1.lower():
-            if len(args) > 2:  # Check if size is provided
-                size = int(args[2], 16 if args[2].startswith('0x') else 10)
-            else:
-                size = None  # Default to None if size is not provided
-            filename = args[3] if len(args) > 3 else "extFlash.bin"
-            file = open(filename, 'wb')
-            job = jobReadExtFlash
-            state = 10
-
-        elif "writeextflash" in opt1.lower():
-            if len(args) < 3:
-                raise ValueError("Missing arguments for writeextflash command.")
-            filename = args[2]
-            eetype_str = args[3].lower() if len(args) > 3 else None
-            eetype = "T_29FX00B_SIMK4X_I4" if eetype_str and "simk4x_i4" in eetype_str else (
-            "T_29FX00B_SIMK4X_V6" if eetype_str and "simk4x_v6" in eetype_str else None
-            )
-            file = open(filename, 'rb')
-            job = jobWriteExtFlash
-            state = 10
-
-        else:
-            raise ValueError(f"Invalid command: {opt1}")
-
-        # Call the reusable loop
-        # Pass the progress_callback to the loop
-        run_bsl_loop(progress_callback=progress_callback, log_callback2=log_callback2)
-
+        options = ParseArgs(args)
     except Exception as e:
         logger.error(f"Error occurred in execute_bsl: {e}")
         raise
 
+    ownSession = session is None
+    if ownSession:
+        port = options['port'] or port
+        if not port:
+            raise ValueError("No serial port given.")
+        session = BslSession(port, options['baud'], maxBaud=options['maxBaud'])
+    session.progress_callback, session.log_callback2 = progress_callback, log_callback2
+
+    file = None
+    try:
+        if options['job'] == jobWriteExtFlash:
+            file = open(options['filename'], 'rb')
+        elif options['filename']:
+            file = open(options['filename'], 'wb')
+        return RunJob(session, options['job'], file, options['size'], options['eetype'], options['diffSource'], confirm_unknown)
+    except Exception as e:
+        traceback.print_exc()
+        logger.error(f"Job execution failed: {e}")
+        return -1
+    finally:
+        if file:
+            file.close()
+        if ownSession:
+            session.close()
+
 # Run when the script is executed directly
 if __name__ == "__main__":
 
@@ -1050,7 +1371,8 @@ if __name__ == "__main__":
 
     if len(sys.argv) > 1:
         try:
-            execute_bsl(sys.argv[1:])
+            port = ParseArgs(sys.argv[1:])['port'] or FindPort()
+            execute_bsl(sys.argv[1:], port=port, confirm_unknown=confirm_unknown_eeprom)
         except Exception as e:
             logger.error(f"An error occurred: {e}")
     else:
@@ -0,0 +1,364 @@
+"""
+Emulator of a SIMK4x ECU in C167 bootstrap mode, for testing bsl.py without hardware.
+
+It opens a pseudo terminal and answers the bootstrap loader handshake, the kernel
+commands bsl.py uses and the flash driver functions (FC_ERASE, FC_PROG, FC_GETSTATE)
+on top of an in-memory flash image. Every byte is echoed like on a K-line adapter
+and, unless timing is disabled, paced at the line's baud rate.
+
+    python bsl_emulator.py [image.bin] [--chip AM29F400BB] [--lineswap] [--save out.bin]
+    python bsl.py 57600 -readextflash 0x100000 out.bin -port=/dev/pts/N
+"""
+import argparse
+import fcntl
+import logging
+import os
+import pty
+import select
+import struct
+import threading
+import time
+import tty
+
+from bsl import (
+    I_LOADER_STARTED, I_APPLICATION_STARTED, I_AUTOBAUD_ACKNOWLEDGE, A_ACK1, A_ACK2,
+    C_WRITE_BLOCK, C_READ_BLOCK, C_GETCHECKSUM, C_TEST_COMM, C_CALL_FUNCTION, C_WRITE_WORD,
+    C_READ_WORD, C_AUTOBAUD, variantByteC167, CalcBlockChecksum, GetSectorMap, resource_path,
+    ExtFlashAddress, FlashDriverEntryPoint, FC_PROG, FC_ERASE, FC_GETSTATE, FC_GETSTATE_ADDR_MANUFID,
+    E_NOERROR, E_UNKNOWN_FC, E_PROG_FAILED, E_INVALID_DEST_ADDR
+)
+from flasher.lineswap import reverse_lookup
+
+logger = logging.getLogger("bsl_emulator")
+
+# name: (manufacturer id, device id, size, bottom boot sector)
+chips = {
+    "AM29F200BB": (0x01, 0x57, 1 << 18, True),
+    "AM29F400BB": (0x01, 0xAB, 1 << 19, True),
+    "AM29F800BB": (0x01, 0x58, 1 << 20, True),
+    "AM29F200BT": (0x01, 0x51, 1 << 18, False),
+    "AM29F400BT": (0x01, 0x23, 1 << 19, False),
+    "AM29F800BT": (0x01, 0xD6, 1 << 20, False),
+    "M29F200BB": (0x20, 0xD4, 1 << 18, True),
+    "M29F200BT": (0x20, 0xD5, 1 << 18, False),
+    "M29F400BT": (0x20, 0xD3, 1 << 19, False),
+}
+
+# struct termios2 from asm-generic/termbits.h, c_ospeed is the last field
+TCGETS2 = 0x802C542A
+termios2_size = 44
+
+
+class EcuReset(Exception):
+    pass
+
+
+class BslEmulator:
+    """
+    Args:
+        image (bytes): Initial flash content, erased (0xFF) if None.
+        chip (str): Flash chip, a key of chips.
+        lineswap (bool): Data lines are crossed like on the SIMK43 2.0L, IDs are returned crossed.
+        kernel_running (bool): Answer the first zero byte with A_ACK1 as if the kernel was already loaded.
+        baud (int): Fixed rate used for timing. By default the rate the host set on the line is followed.
+        max_baud (int): Autobaud requests above this rate are not acknowledged.
+        timing (bool): Pace bytes at the baud rate, off answers as fast as possible.
+    """
+
+    def __init__(self, image=None, chip="AM29F800BB", lineswap=False, kernel_running=False, baud=None, max_baud=125000, timing=True):
+        self.manufacturer_id, self.device_id, self.flash_size, self.bottom_boot = chips[chip]
+        self.lineswap = lineswap
+        self.kernel_running = kernel_running
+        self.fixed_baud = baud
+        self.max_baud = max_baud
+        self.timing = timing
+
+        # whole C167 address space, external flash mapped at ExtFlashAddress
+        self.memory = bytearray(1 << 24)
+        self.memory[ExtFlashAddress:ExtFlashAddress + self.flash_size] = b'\xff' * self.flash_size
+        if image is not None:
+            self.memory[ExtFlashAddress:ExtFlashAddress + len(image)] = image[:self.flash_size]
+        self.sectors = GetSectorMap(self.flash_size, self.flash_size, self.bottom_boot)
+
+        with open(resource_path("assets/simk4x_bootstrap.bin"), 'rb') as loader:
+            self.loader_size = len(loader.read())
+        with open(resource_path("assets/simk4x_kernel.bin"), 'rb') as kernel:
+            self.kernel_size = len(kernel.read())
+
+        self.baud = baud or 57600
+        self.last_checksum = 0
+        self.wire_clock = 0
+        self.erase_count = 0
+        self.program_count = 0
+        self.bytes_sent = 0
+        self.running = False
+        self.reset_pending = False
+
+    @property
+    def flash(self):
+        return bytes(self.memory[ExtFlashAddress:ExtFlashAddress + self.flash_size])
+
+    def open(self):
+        """Create the pseudo terminal. Returns the port name to pass to bsl.py (-port=)."""
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        return self.port
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def reset(self):
+        """Power cycle into bootstrap mode, the kernel has to be loaded again."""
+        self.reset_pending = True
+
+    def line_speed(self):
+        """Baud rate the host configured on the pty, custom rates included."""
+        if self.fixed_baud:
+            return self.fixed_baud
+        try:
+            termios2 = fcntl.ioctl(self.slave, TCGETS2, bytes(termios2_size))
+            return struct.unpack_from('I', termios2, termios2_size - 4)[0] or self.baud
+        except OSError:
+            return self.baud
+
+    def pace(self, size):
+        # Every byte on the wire takes 10 bits (8N1)
+        if not self.timing:
+            return
+        now = time.perf_counter()
+        self.wire_clock = max(self.wire_clock, now) + size * 10 / self.baud
+        if self.wire_clock > now:
+            time.sleep(self.wire_clock - now)
+
+    def send(self, data):
+        data = bytes(data)
+        self.pace(len(data))
+        os.write(self.master, data)
+        self.bytes_sent += len(data)
+
+    def read(self, size):
+        # Read exactly size bytes from the host and echo them back like the K-line does
+        data = bytearray()
+        while len(data) < size:
+            self.wait_readable()
+            received = os.read(self.master, size - len(data))
+            if self.kernel_running and self.line_speed() != self.baud:
+                # the kernel's UART stays at its own rate, bytes sent at another one are lost to framing errors
+                logger.debug(f"Dropped {len(received)} bytes sent at {self.line_speed()} baud, kernel runs at {self.baud}")
+                continue
+            data += received
+        self.send(data)
+        return bytes(data)
+
+    def wait_readable(self):
+        while True:
+            self.check_state()
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if ready:
+                return
+
+    def check_state(self):
+        if not self.running:
+            raise EOFError
+        if self.reset_pending:
+            self.reset_pending = False
+            self.kernel_running = False
+            raise EcuReset
+
+    def read_address(self):
+        address = self.read(3)
+        return address[0] | address[1] << 8 | address[2] << 16
+
+    def read_word(self):
+        word = self.read(2)
+        return word[0] | word[1] << 8
+
+    def serve(self):
+        while self.running:
+            try:
+                self.bootstrap()
+                while self.running:
+                    self.command(self.read(1)[0])
+            except EcuReset:
+                logger.info("Reset")
+            except EOFError:
+                return
+            except OSError:
+                return
+
+    def bootstrap(self):
+        """Zero byte probe, 32 byte loader and kernel upload."""
+        while True:
+            self.wait_readable()
+            if not self.kernel_running:
+                self.baud = self.line_speed() # the bootstrap loader measures the zero byte
+            if self.read(1) == b'\x00':
+                break
+        if self.kernel_running:
+            self.send([A_ACK1])
+            return
+
+        self.send([variantByteC167])
+        self.read(self.loader_size)
+        self.send([I_LOADER_STARTED])
+        self.read(self.kernel_size)
+        self.send([I_APPLICATION_STARTED])
+        self.kernel_running = True
+        logger.info("Kernel started")
+
+    def command(self, command):
+        if command == 0x00:
+            # hello of a new session while the kernel still runs
+            self.send([A_ACK1])
+
+        elif command == C_TEST_COMM:
+            self.send([A_ACK1, A_ACK2])
+
+        elif command == C_GETCHECKSUM:
+            self.send([A_ACK1, self.last_checksum, A_ACK2])
+
+        elif command == C_WRITE_WORD:
+            self.send([A_ACK1])
+            address, word = self.read_address(), self.read_word()
+            self.memory[address:address + 2] = word.to_bytes(2, 'little')
+            self.send([A_ACK2])
+
+        elif command == C_READ_WORD:
+            self.send([A_ACK1])
+            address = self.read_address()
+            self.send(self.memory[address:address + 2] + bytes([A_ACK2]))
+
+        elif command == C_WRITE_BLOCK:
+            self.send([A_ACK1])
+            address, size = self.read_address(), self.read_word()
+            data = self.read(size)
+            self.memory[address:address + size] = data
+            self.last_checksum = CalcBlockChecksum(data)
+            self.send([A_ACK2])
+
+        elif command == C_READ_BLOCK:
+            self.send([A_ACK1])
+            address, size = self.read_address(), self.read_word()
+            data = bytes(self.memory[address:address + size])
+            self.last_checksum = CalcBlockChecksum(data)
+            self.send(data + bytes([A_ACK2]))
+
+        elif command == C_CALL_FUNCTION:
+            self.send([A_ACK1])
+            address = self.read_address()
+            registers = list(struct.unpack('<8H', self.read(16)))
+            if address == FlashDriverEntryPoint:
+                registers = self.flash_driver(registers)
+            self.send(struct.pack('<8H', *registers) + bytes([A_ACK2]))
+
+        elif command == C_AUTOBAUD:
+            self.send([A_ACK1])
+            self.autobaud()
+
+        else:
+            logger.warning(f"Unknown command {hex(command)}")
+
+    def autobaud(self):
+        # The host switches its rate and sends a zero byte which the kernel measures
+        self.wait_readable()
+        speed = self.line_speed()
+        probe = os.read(self.master, 1)
+        if probe != b'\x00' or speed > self.max_baud:
+            # the kernel measured garbage and keeps its old rate
+            logger.info(f"Autobaud to {speed} rejected")
+            self.send(b'\x99')
+            return
+        self.baud = speed
+        self.send(probe + bytes([I_AUTOBAUD_ACKNOWLEDGE]))
+        logger.info(f"Autobaud to {speed}")
+
+    def flash_address(self, high, low):
+        return ((high << 16) | low) - ExtFlashAddress
+
+    def flash_driver(self, registers):
+        """FC_* calls of the SIMK4x flash driver, the error code is returned in r15."""
+        function = registers[0]
+
+        if function == FC_GETSTATE:
+            value = self.manufacturer_id if registers[6] == FC_GETSTATE_ADDR_MANUFID else self.device_id
+            registers[1] = reverse_lookup(value) if self.lineswap else value
+            registers[7] = E_NOERROR
+
+        elif function == FC_ERASE:
+            offset = self.flash_address(registers[2], registers[1])
+            for sector, sector_offset, sector_size in self.sectors:
+                if sector_offset == offset:
+                    start = ExtFlashAddress + sector_offset
+                    self.memory[start:start + sector_size] = b'\xff' * sector_size
+                    self.erase_count += 1
+                    registers[7] = E_NOERROR
+                    break
+            else:
+                registers[7] = E_INVALID_DEST_ADDR
+
+        elif function == FC_PROG:
+            size, source = registers[1], registers[2]
+            offset = self.flash_address(registers[6], registers[5])
+            if offset < 0 or offset + size > self.flash_size:
+                registers[7] = E_INVALID_DEST_ADDR
+                return registers
+            start = ExtFlashAddress + offset
+            data = self.memory[source:source + size]
+            current = self.memory[start:start + size]
+            # programming can only clear bits, anything else needs an erase first
+            programmed = bytes([old & new for old, new in zip(current, data)])
+            self.memory[start:start + size] = programmed
+            self.program_count += 1
+            registers[7] = E_NOERROR if programmed == data else E_PROG_FAILED
+
+        else:
+            registers[7] = E_UNKNOWN_FC
+
+        return registers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMK4x bootstrap loader emulator")
+    parser.add_argument("image", nargs="?", help="Initial flash content")
+    parser.add_argument("--chip", default="AM29F800BB", choices=chips.keys())
+    parser.add_argument("--lineswap", action="store_true", help="Crossed data lines like the SIMK43 2.0L")
+    parser.add_argument("--kernel-running", action="store_true")
+    parser.add_argument("--baud", type=int, help="Fixed rate for timing instead of following the line")
+    parser.add_argument("--max-baud", type=int, default=125000, help="Highest rate autobaud accepts")
+    parser.add_argument("--no-timing", action="store_true", help="Answer as fast as possible")
+    parser.add_argument("--save", help="Save the flash content here on exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="[*] %(message)s")
+
+    image = None
+    if args.image:
+        with open(args.image, 'rb') as file:
+            image = file.read()
+
+    emulator = BslEmulator(image, chip=args.chip, lineswap=args.lineswap, kernel_running=args.kernel_running,
+        baud=args.baud, max_baud=args.max_baud, timing=not args.no_timing)
+    logger.info(f"Listening on {emulator.open()}, press CTRL + C to stop")
+    emulator.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    logger.info(f"{emulator.bytes_sent} bytes sent, {emulator.erase_count} sectors erased, {emulator.program_count} blocks programmed")
+
+    if args.save:
+        with open(args.save, 'wb') as file:
+            file.write(emulator.flash)
+        logger.info(f"Flash saved to {args.save}")
@@ -0,0 +1,69 @@
+import json, logging, os, tempfile, time
+from contextlib import contextmanager
+
+try:
+	import fcntl
+except ImportError: # Windows
+	fcntl = None
+	import msvcrt
+
+logger = logging.getLogger(__name__)
+
+# small persistent JSON stores for things GKFlasher learns about ECUs and adapters
+cache_directory = os.path.join(os.path.expanduser('~'), '.gkflasher')
+
+def load_cache (name: str) -> dict:
+	try:
+		with open(os.path.join(cache_directory, name + '.json'), 'r') as file:
+			return json.load(file)
+	except (FileNotFoundError, json.JSONDecodeError):
+		return {}
+
+@contextmanager
+def cache_lock (name: str):
+	'''
+	Exclusive lock on a cache for a read-modify-write, station workers in separate processes share the directory
+	'''
+	os.makedirs(cache_directory, exist_ok=True)
+	with open(os.path.join(cache_directory, name + '.lock'), 'a+') as lock_file:
+		if fcntl:
+			fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+		else:
+			lock_file.seek(0)
+			while True:
+				try:
+					msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+					break
+				except OSError: # gave up after 10 attempts, keep waiting
+					time.sleep(0.1)
+		try:
+			yield
+		finally:
+			if fcntl:
+				fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+			else:
+				lock_file.seek(0)
+				msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _write_cache (name: str, data: dict) -> None:
+	descriptor, temporary = tempfile.mkstemp(dir=cache_directory, prefix=name + '.', suffix='.tmp')
+	try:
+		with os.fdopen(descriptor, 'w') as file:
+			json.dump(data, file, indent='\t')
+		os.replace(temporary, os.path.join(cache_directory, name + '.json'))
+	except BaseException:
+		os.remove(temporary)
+		raise
+
+def update_cache (name: str, update) -> None:
+	'''
+	Reload the cache under its lock, let update change it in place and write it back.
+	A cache is only a shortcut - failures are logged, never raised into a read or flash
+	'''
+	try:
+		with cache_lock(name):
+			data = load_cache(name)
+			update(data)
+			_write_cache(name, data)
+	except (OSError, TypeError, ValueError) as e:
+		logger.warning('Couldn\'t save the %s cache: %s', name, e)
@@ -1,13 +1,17 @@
-import crcmod, sys
+import crcmod, mmap, os, time
+from concurrent.futures import ProcessPoolExecutor
+from ecu_definitions import ECU_IDENTIFICATION_TABLE
 
 cks_types = [ # todo: incorporate into ECU definitions
 	{
         'name': '2mbit',
+        'size': 0x40000, # bytes of a full image
         'identification_flag_address': 0xFEFE,
         'regions': [
 			{
 	        	'name': 'Boot',
 		        'flag_address': 0xDEFE,
+		        'start': 0, # first byte of the region in the bin file
 		        'init_address': 0x3FE4,
 		        'cks_address': 0x3EF4,
 		        'bin_offset': 0
@@ -15,6 +19,7 @@ cks_types = [ # todo: incorporate into ECU definitions
         	{
 	        	'name': 'Calibration', 
 		        'flag_address': 0xFEFE,
+		        'start': 0x008000,
 		        'init_address': 0x00800C,
 		        'cks_address': 0x0FEE0,
 		        'bin_offset': -0x040000
@@ -22,6 +27,7 @@ cks_types = [ # todo: incorporate into ECU definitions
 		    {
 		    	'name': 'Program',
 		    	'flag_address': 0xFEFE,
+		    	'start': 0x010000,
 		    	'init_address': 0x010052,
 		    	'cks_address': 0x010010,
 		    	'bin_offset': -0x040000
@@ -30,11 +36,13 @@ cks_types = [ # todo: incorporate into ECU definitions
 	},
 	{
         'name': '4mbit (FL2)',
+        'size': 0x80000,
         'identification_flag_address': 0x16135, # This is a random "OK" towards the end of the cal zone.
         'regions': [
 			{
 	        	'name': 'Boot',
 		        'flag_address': 0x017EFE,
+		        'start': 0,
 		        'init_address': 0x3FE4,
 		        'cks_address': 0x3EEC, # 663057/58
 		        'bin_offset': 0
@@ -42,6 +50,7 @@ cks_types = [ # todo: incorporate into ECU definitions
         	{
 		        'name': 'Calibration',
 		        'flag_address': 0x017EFE,
+		        'start': 0x010000,
 		        'init_address': 0x01000C,
 		        'cks_address': 0x017EE0,
 		        'bin_offset': -0x080000
@@ -49,6 +58,7 @@ cks_types = [ # todo: incorporate into ECU definitions
 		    {
 		    	'name': 'Program',
 		    	'flag_address': 0x17EFE,
+		    	'start': 0x020000,
 		    	'init_address': 0x020052,
 		    	'cks_address': 0x020010,
 		    	'bin_offset': -0x080000
@@ -57,11 +67,13 @@ cks_types = [ # todo: incorporate into ECU definitions
 	},
 	{
         'name': '4mbit',
+        'size': 0x80000,
         'identification_flag_address': 0x017EFE,
         'regions': [
 			{
 	        	'name': 'Boot',
 		        'flag_address': 0x017EFE,
+		        'start': 0,
 		        'init_address': 0x3FE4,
 		        'cks_address': 0x3EF4,
 		        'bin_offset': 0
@@ -69,6 +81,7 @@ cks_types = [ # todo: incorporate into ECU definitions
         	{
 		        'name': 'Calibration',
 		        'flag_address': 0x017EFE,
+		        'start': 0x010000,
 		        'init_address': 0x01000C,
 		        'cks_address': 0x017EE0,
 		        'bin_offset': -0x080000
@@ -76,6 +89,7 @@ cks_types = [ # todo: incorporate into ECU definitions
 		    {
 		    	'name': 'Program',
 		    	'flag_address': 0x17EFE,
+		    	'start': 0x020000,
 		    	'init_address': 0x020052,
 		    	'cks_address': 0x020010,
 		    	'bin_offset': -0x080000
@@ -84,11 +98,13 @@ cks_types = [ # todo: incorporate into ECU definitions
 	},
 	{
         'name': 'v6 (5WY17)',
+        'size': 0x80000,
         'identification_flag_address': 0xDEFE,
         'regions': [
         	{
 	        	'name': 'Boot',
 		        'flag_address': 0xDEFE,
+		        'start': 0,
 		        'init_address': 0x3FE4,
 		        'cks_address': 0x3EF4,
 		        'bin_offset': 0
@@ -96,6 +112,7 @@ cks_types = [ # todo: incorporate into ECU definitions
         	{
 	        	'name': 'Calibration',
 		        'flag_address': 0xDEFE,
+		        'start': 0x08000,
 		        'init_address': 0x0800C,
 		        'cks_address': 0xDEE0,
 		        'bin_offset': -0x080000
@@ -103,6 +120,7 @@ cks_types = [ # todo: incorporate into ECU definitions
 		    {
 		    	'name': 'Program',
 		    	'flag_address': 0xDEFE,
+		    	'start': 0x010000,
 		    	'init_address': 0x010052,
 		    	'cks_address': 0x010010,
 		    	'bin_offset': -0x080000
@@ -111,11 +129,13 @@ cks_types = [ # todo: incorporate into ECU definitions
 	},
 	{
         'name': 'v6 (5WY18+)',
+        'size': 0x80000,
         'identification_flag_address': 0xEEFE,
         'regions': [
         	{
 	        	'name': 'Boot',
 		        'flag_address': 0xEEFE,
+		        'start': 0,
 		        'init_address': 0x3FE4,
 		        'cks_address': 0x3EF4,
 		        'bin_offset': 0
@@ -123,6 +143,7 @@ cks_types = [ # todo: incorporate into ECU definitions
         	{
 	        	'name': 'Calibration',
 		        'flag_address': 0xEEFE,
+		        'start': 0x08000,
 		        'init_address': 0x0800C,
 		        'cks_address': 0xEEE0,
 		        'bin_offset': -0x080000
@@ -130,6 +151,7 @@ cks_types = [ # todo: incorporate into ECU definitions
 		    {
 		    	'name': 'Program',
 		    	'flag_address': 0xEEFE,
+		    	'start': 0x010000,
 		    	'init_address': 0x010052,
 		    	'cks_address': 0x010010,
 		    	'bin_offset': -0x080000
@@ -138,11 +160,13 @@ cks_types = [ # todo: incorporate into ECU definitions
 	},	
 	{
         'name': '8mbit',
+        'size': 0x100000,
         'identification_flag_address': 0x97EFE,
         'regions': [
 			{
 	        	'name': 'Boot',
 		        'flag_address': 0x97EFE,
+		        'start': 0,
 		        'init_address': 0x3FE4,
 		        'cks_address': 0x3EEC,
 		        'bin_offset': 0
@@ -150,6 +174,7 @@ cks_types = [ # todo: incorporate into ECU definitions
         	{
 	        	'name': 'Calibration',
 		        'flag_address': 0x97EFE,
+		        'start': 0x090000,
 		        'init_address': 0x09000C,
 		        'cks_address': 0x097EE0,
 		        'bin_offset': 0
@@ -157,6 +182,7 @@ cks_types = [ # todo: incorporate into ECU definitions
 		    {
 		    	'name': 'Program',
 				'flag_address': 0x97EFE,
+		    	'start': 0x0A0000,
 		    	'init_address': 0x0A0052,
 		    	'cks_address': 0x0A0010,
 		    	'bin_offset': 0
@@ -173,17 +199,453 @@ def read_and_reverse (payload, start, length):
 def concat_3_bytes (payload):
 	return ( (payload[0] << 8 | payload[1]) << 8 | payload[2])
 
+# built once - crc16(data, init) continues from any initial value
+crc16 = crcmod.mkCrcFun(0x18005, initCrc=0)
+
 def checksum (payload, start, stop, init):
-	crc16 = crcmod.mkCrcFun(0x18005, initCrc=init)
+	return crc16(payload[start:stop], init)
+
+def _zero_advance_maps ():
+	'''
+	The CRC register is linear over GF(2): crc(init, data) == crc(init, zeros) ^ crc(0, data).
+	Feeding n zero bytes is a linear map of the 16 bit register, kept here as its 
+	16 columns, for every power of two n. That's enough to move a CRC difference
+	across any amount of unchanged data in a handful of operations
+	'''
+	maps = [[crc16(b'\x00', 1 << bit) for bit in range(16)]]
+	for power in range(1, 32):
+		previous = maps[-1]
+		maps.append([apply_map(previous, column) for column in previous])
+	return maps
+
+def apply_map (columns, value):
+	result = 0
+	bit = 0
+	while value:
+		if (value & 1):
+			result ^= columns[bit]
+		value >>= 1
+		bit += 1
+	return result
+
+zero_advance_maps = _zero_advance_maps()
+
+def advance_zeros (value, length):
+	'''
+	:return: crc16(b'\\x00'*length, value), without feeding the zeros
+	'''
+	power = 0
+	while length and value:
+		if (length & 1):
+			value = apply_map(zero_advance_maps[power], value)
+		length >>= 1
+		power += 1
+	return value
+
+def region_checksum (payload, region):
+	'''
+	Calculate the checksum of a single region. Every zone's CRC starts from the previous zone's one
+
+	:return: None if the region has no zones, otherwise dict with 
+		zones - list of (start, stop, initial value, checksum),
+		current - checksum stored in the payload,
+		calculated - checksum the payload should have, in the same byte order
+	'''
+	init_address, cks_address, bin_offset = region['init_address'], region['cks_address'], region['bin_offset']
+
+	amount_of_zones = payload[cks_address+2]
+	if (amount_of_zones == 0 or amount_of_zones == 0xFF):
+		return None
+
+	zones = []
+	for zone_index in range(amount_of_zones):
+		zone_address = cks_address + zone_index*0x08
+		zone_start = concat_3_bytes(read_and_reverse(payload, zone_address+0x04, 3)) + bin_offset
+		zone_stop = concat_3_bytes(read_and_reverse(payload, zone_address+0x08, 3)) + bin_offset + 1
+
+		if (zone_index == 0):
+			initial_value_bytes = read_and_reverse(payload, init_address, 2)
+			initial_value = (initial_value_bytes[0]<< 8) | initial_value_bytes[1]
+		else:
+			initial_value = zones[-1][3]
+
+		zones.append((zone_start, zone_stop, initial_value, checksum(payload, zone_start, zone_stop, initial_value)))
+
+	checksum_b1 = (zones[-1][3] >> 8) & 0xFF
+	checksum_b2 = (zones[-1][3] & 0xFF)
+
+	return {
+		'zones': zones,
+		'current': int.from_bytes(payload[cks_address:cks_address+2], "big"),
+		'calculated': (checksum_b2 << 8) | checksum_b1
+	}
+
+# weights of the evidence a layout gets scored with
+identification_weight = 3
+region_flag_weight = 1
+zone_table_weight = 2
+size_weight = 2
+ecu_weight = 1
+# candidates closer than this in confidence make an image ambiguous
+ambiguity_margin = 0.15
+
+def _build_signature_index ():
+	'''
+	offset -> list of (layout index, expected bytes, weight, identification).
+	Layouts sharing an offset are checked with a single read
+	'''
+	index = {}
+	for layout_index, cks_type in enumerate(cks_types):
+		signatures = {cks_type['identification_flag_address']: identification_weight}
+		for region in cks_type['regions']:
+			signatures.setdefault(region['flag_address'], region_flag_weight)
+		for offset, weight in signatures.items():
+			index.setdefault(offset, []).append((layout_index, b'OK', weight, offset == cks_type['identification_flag_address']))
+	return index
+
+signature_index = _build_signature_index()
+
+def region_stop (cks_type, region) -> int:
+	'''
+	:return: first byte after the region in the bin file - where the next region starts, or the end of the image
+	'''
+	starts = [other['start'] for other in cks_type['regions'] if other['start'] > region['start']]
+	return min(starts) if starts else cks_type['size']
+
+def zone_table_state (payload, cks_type, region) -> str:
+	'''
+	Zone table of a region should point at ascending, non overlapping ranges inside the region itself. 
+	Layouts that only differ in where a table sits (FL2 and 4mbit boot) are told apart by it - 
+	read at the wrong address, a table comes out empty or pointing outside of its region
+
+	:return: 'sane', 'unused' (no zones) or 'broken'
+	'''
+	cks_address = region['cks_address']
+	if (cks_address+3 > len(payload)):
+		return 'broken'
+	amount_of_zones = payload[cks_address+2]
+	if (amount_of_zones == 0 or amount_of_zones == 0xFF):
+		return 'unused'
+	if (cks_address+0x0B+(amount_of_zones-1)*0x08 > len(payload)):
+		return 'broken'
+
+	position, stop = region['start'], min(region_stop(cks_type, region), len(payload))
+	for zone_index in range(amount_of_zones):
+		zone_address = cks_address + zone_index*0x08
+		zone_start = concat_3_bytes(read_and_reverse(payload, zone_address+0x04, 3)) + region['bin_offset']
+		zone_stop = concat_3_bytes(read_and_reverse(payload, zone_address+0x08, 3)) + region['bin_offset'] + 1
+		if not (position <= zone_start < zone_stop <= stop):
+			return 'broken'
+		position = zone_stop
+	return 'sane'
+
+def identify_ecus (payload) -> list[str]:
+	'''
+	Names of ECUs from ECU_IDENTIFICATION_TABLE whose identification matches the image and its size
+	'''
+	names = []
+	for entry in ECU_IDENTIFICATION_TABLE:
+		ecu = entry['ecu']
+		offset = entry['offset'] + ecu['bin_offset']
+		if (ecu['eeprom_size_bytes'] != len(payload) or offset < 0):
+			continue
+		for expected in entry['expected']:
+			if (bytes(payload[offset:offset+len(expected)]) == bytes(expected)):
+				names.append(ecu['name'])
+				break
+	return names
 
-	checksum = crc16(payload[start:stop])
-	return checksum
+def classify (payload) -> dict:
+	'''
+	Score every checksum layout against an image: identification flag (required), 
+	region flags, zone tables (in use and pointing inside their regions), image size and ECU identification
+
+	:return: dict with cks_type (best layout or None), confidence (0-1), 
+		status - 'ok', 'ambiguous' or 'unknown', candidates - list of (layout name, confidence) and ecus
+	'''
+	scores = [0]*len(cks_types)
+	identified = [False]*len(cks_types)
+	for offset, signatures in signature_index.items():
+		found = bytes(payload[offset:offset+2])
+		for layout_index, expected, weight, identification in signatures:
+			if (found == expected):
+				scores[layout_index] += weight
+				identified[layout_index] = identified[layout_index] or identification
+
+	ecus = identify_ecus(payload)
+	ecu_sizes = {entry['ecu']['eeprom_size_bytes'] for entry in ECU_IDENTIFICATION_TABLE if entry['ecu']['name'] in ecus}
+
+	candidates = []
+	for layout_index, cks_type in enumerate(cks_types):
+		if not identified[layout_index]:
+			continue
+		score = scores[layout_index]
+		maximum = identification_weight + region_flag_weight*len({region['flag_address'] for region in cks_type['regions']} - {cks_type['identification_flag_address']})
+
+		# an empty table is no evidence either way
+		zone_table_scores = {'sane': zone_table_weight, 'unused': 0, 'broken': -zone_table_weight}
+		for region in cks_type['regions']:
+			score += zone_table_scores[zone_table_state(payload, cks_type, region)]
+			maximum += zone_table_weight
+
+		score += size_weight if cks_type['size'] == len(payload) else -size_weight
+		score += ecu_weight if cks_type['size'] in ecu_sizes else 0
+		maximum += size_weight + ecu_weight
+
+		candidates.append((max(0, score)/maximum, layout_index))
+
+	# sort by confidence, ties go to the layout listed first
+	candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+	if not candidates:
+		return {'cks_type': None, 'confidence': 0, 'status': 'unknown', 'candidates': [], 'ecus': ecus}
+
+	confidence, layout_index = candidates[0]
+	ambiguous = len(candidates) > 1 and confidence - candidates[1][0] < ambiguity_margin
+	return {
+		'cks_type': cks_types[layout_index],
+		'confidence': confidence,
+		'status': 'ambiguous' if ambiguous else 'ok',
+		'candidates': [(cks_types[index]['name'], candidate_confidence) for candidate_confidence, index in candidates],
+		'ecus': ecus
+	}
 
 def detect_offsets (payload):
-	for cks_type in cks_types:
-		flag = payload[cks_type['identification_flag_address']:cks_type['identification_flag_address']+2]
-		if (flag == b'OK'):
-			return cks_type # todo: unpack
+	return classify(payload)['cks_type']
+
+def split_regions (payload):
+	'''
+	Split a dump into boot/calibration/program regions per its checksum layout.
+	Unknown layouts are treated as a single region
+
+	:return: layout name, list of (start, stop, region name)
+	'''
+	cks_type = detect_offsets(payload)
+	if (cks_type == None):
+		return None, [(0, len(payload), None)]
+
+	starts = sorted([(region['start'], region['name']) for region in cks_type['regions'] if region['start'] < len(payload)])
+	regions = []
+	for index, (start, name) in enumerate(starts):
+		stop = starts[index+1][0] if index+1 < len(starts) else len(payload)
+		regions.append((start, stop, name))
+	if (regions[0][0] > 0):
+		regions.insert(0, (0, regions[0][0], None))
+	return cks_type['name'], regions
+
+class ChecksumException (Exception):
+	pass
+
+class ChecksumEngine:
+	'''
+	Checksums of an image that is being edited. CRCs of all zones are calculated once,
+	after that every edit only costs the CRC of the changed bytes: the difference is
+	moved to the end of its zone and carried down the zone chain (each zone starts
+	from the previous zone's CRC) with zero_advance_maps, nothing is read again.
+	Edits touching zone tables, initial values or the layout flags rebuild everything
+	'''
+	def __init__ (self, payload: bytearray, cks_type=None):
+		self.payload = payload
+		self.cks_type = cks_type
+		self.rebuild()
+
+	def rebuild (self) -> None:
+		if (self.cks_type == None):
+			self.cks_type = detect_offsets(self.payload)
+		self.result = calculate_checksums(self.payload, self.cks_type)
+		self.spans = [] # bytes every zone really covers, the way payload[start:stop] sees it
+		for region in self.result['regions']:
+			region['zones'] = [list(zone) for zone in region['zones']]
+			self.spans.append([range(len(self.payload))[zone[0]:zone[1]] for zone in region['zones']])
+
+		self.metadata = [(self.cks_type['identification_flag_address'], self.cks_type['identification_flag_address']+2)]
+		for region in self.cks_type['regions']:
+			self.metadata.append((region['init_address'], region['init_address']+2))
+			self.metadata.append((region['cks_address']+2, region['cks_address']+0x03+self.payload[region['cks_address']+2]*0x08))
+
+	def edit (self, offset: int, data: bytes) -> list[str]:
+		'''
+		Write data at offset and update checksums
+
+		:return: names of regions whose calculated checksum changed
+		'''
+		stop = offset+len(data)
+		previous = int.from_bytes(self.payload[offset:stop], 'big')
+		self.payload[offset:stop] = data
+
+		if any([offset < metadata_stop and stop > metadata_start for metadata_start, metadata_stop in self.metadata]):
+			before = [region['calculated'] for region in self.result['regions']]
+			self.rebuild()
+			return [region['name'] for region, calculated in zip(self.result['regions'], before) if region['calculated'] != calculated]
+
+		delta = (previous ^ int.from_bytes(data, 'big')).to_bytes(len(data), 'big')
+		changed = []
+		for region, spans in zip(self.result['regions'], self.spans):
+			carry = 0 # change of the previous zone's CRC, which is this zone's initial value
+			for zone, span in zip(region['zones'], spans):
+				zone_start, zone_stop = span.start, max(span.start, span.stop)
+				difference = advance_zeros(carry, zone_stop-zone_start) if carry else 0
+
+				edit_start, edit_stop = max(offset, zone_start), min(stop, zone_stop)
+				if (edit_start < edit_stop):
+					difference ^= advance_zeros(crc16(delta[edit_start-offset:edit_stop-offset], 0), zone_stop-edit_stop)
+
+				zone[2] ^= carry
+				zone[3] ^= difference
+				carry = difference
+
+			if (carry):
+				last = region['zones'][-1][3]
+				region['calculated'] = ((last & 0xFF) << 8) | ((last >> 8) & 0xFF)
+				changed.append(region['name'])
+
+		return changed
+
+	def checksums (self) -> dict:
+		'''
+		:return: same as calculate_checksums, current checksums as they're in the payload now
+		'''
+		for region in self.result['regions']:
+			if region['zones']:
+				region['current'] = int.from_bytes(self.payload[region['cks_address']:region['cks_address']+2], "big")
+		return self.result
+
+	def patch (self) -> int:
+		return patch_checksums(self.payload, self.checksums())
+
+def calculate_checksums (payload, cks_type=None) -> dict:
+	'''
+	Calculate checksums of every region of an image. Doesn't print, ask or modify anything
+
+	:param payload: bytes, bytearray or mmap of the image
+	:param cks_type: layout from cks_types, detected if not given
+	:return: dict with layout name and regions - list of dicts with name, cks_address
+		and (see region_checksum) zones, current and calculated. Regions without zones have zones
+		empty and calculated set to None
+	'''
+	if (cks_type == None):
+		cks_type = detect_offsets(payload)
+	if (cks_type == None):
+		raise ChecksumException('Calibration zone not detected')
+
+	regions = []
+	for region in cks_type['regions']:
+		result = region_checksum(payload, region) or {'zones': [], 'current': None, 'calculated': None}
+		regions.append(dict(result, name=region['name'], cks_address=region['cks_address']))
+
+	return {'layout': cks_type['name'], 'regions': regions}
+
+def checksums_valid (result: dict) -> bool:
+	return all([region['current'] == region['calculated'] for region in result['regions'] if region['zones']])
+
+def patch_checksums (payload, result: dict) -> int:
+	'''
+	Write calculated checksums into a writable buffer (bytearray or mmap)
+
+	:return: amount of regions whose checksum changed
+	'''
+	changed = 0
+	for region in result['regions']:
+		if (not region['zones'] or region['current'] == region['calculated']):
+			continue
+		payload[region['cks_address']:region['cks_address']+2] = region['calculated'].to_bytes(2, "big")
+		changed += 1
+	return changed
+
+def correct_checksum_file (filename: str, patch: bool = True) -> dict:
+	'''
+	Calculate checksums of a file and, with patch, correct them in place
+
+	:return: see calculate_checksums, with changed - amount of regions patched
+	'''
+	with open(filename, 'r+b' if patch else 'rb') as file:
+		with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE if patch else mmap.ACCESS_READ) as payload:
+			result = calculate_checksums(payload)
+			result['changed'] = patch_checksums(payload, result) if patch else 0
+			if result['changed']:
+				payload.flush()
+	return result
+
+def _correct_checksum_file (filename: str, patch: bool) -> tuple[str, dict, str]:
+	try:
+		return filename, correct_checksum_file(filename, patch), None
+	except (OSError, ValueError, IndexError, ChecksumException) as e:
+		return filename, None, str(e) or type(e).__name__
+
+def correct_checksum_files (filenames: list[str], patch: bool = True, workers: int = None):
+	'''
+	Correct checksums of many files in a process pool
+
+	:return: generator of (filename, result or None, error or None), in the order of filenames
+	'''
+	if (len(filenames) < 2):
+		yield from map(_correct_checksum_file, filenames, [patch]*len(filenames))
+		return
+
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		yield from executor.map(_correct_checksum_file, filenames, [patch]*len(filenames), chunksize=8)
+
+def checksum_filenames (paths: list[str]) -> list[str]:
+	filenames = []
+	for path in paths:
+		if os.path.isdir(path):
+			for root, directories, files in os.walk(path):
+				filenames += [os.path.join(root, filename) for filename in sorted(files) if filename.lower().endswith('.bin')]
+		else:
+			filenames.append(path)
+	return filenames
+
+def _classify_file (filename: str) -> tuple[str, dict, str]:
+	try:
+		with open(filename, 'rb') as file:
+			with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as payload:
+				result = classify(payload)
+		result['layout'] = result.pop('cks_type')['name'] if result['cks_type'] else None
+		return filename, result, None
+	except (OSError, ValueError) as e:
+		return filename, None, str(e) or type(e).__name__
+
+def cli_classify (paths: list[str]) -> bool:
+	filenames = checksum_filenames(paths)
+	started = time.time()
+	layouts, unknown, ambiguous = {}, [], []
+
+	for filename, result, error in map(_classify_file, filenames):
+		if (error or result['status'] == 'unknown'):
+			unknown.append(filename)
+			print('[!] {}: unknown{}'.format(filename, ', '+error if error else ''))
+			continue
+		layouts[result['layout']] = layouts.get(result['layout'], 0) + 1
+		if (result['status'] == 'ambiguous'):
+			ambiguous.append(filename)
+			print('[!] {}: ambiguous - {}'.format(filename, ', '.join(['{} {:.0%}'.format(name, confidence) for name, confidence in result['candidates']])))
+		else:
+			print('[*] {}: {} ({:.0%}){}'.format(filename, result['layout'], result['confidence'], ', '+', '.join(result['ecus']) if result['ecus'] else ''))
+
+	print('[*] Classified {} files in {:.2f}s'.format(len(filenames), time.time()-started))
+	for layout, count in layouts.items():
+		print('    {}: {}'.format(layout, count))
+	print('    ambiguous: {}, unknown: {}'.format(len(ambiguous), len(unknown)))
+	return not (ambiguous or unknown)
+
+def cli_correct_checksums (paths: list[str], patch: bool = True) -> bool:
+	filenames = checksum_filenames(paths)
+	print('[*] Correcting checksums of {} files'.format(len(filenames)))
+
+	started = time.time()
+	failed = 0
+	for filename, result, error in correct_checksum_files(filenames, patch):
+		if (error):
+			print('[!] {}: {}'.format(filename, error))
+			failed += 1
+		elif (result['changed']):
+			print('[*] {}: {}, corrected {} regions'.format(filename, result['layout'], result['changed']))
+		elif checksums_valid(result):
+			print('[*] {}: {}, OK'.format(filename, result['layout']))
+		else:
+			print('[*] {}: {}, checksums are wrong'.format(filename, result['layout']))
+
+	print('[*] Done in {:.1f}s, {} failed'.format(time.time()-started, failed))
+	return failed == 0
 
 def correct_checksum (filename):
 	print('[*] Reading {}'.format(filename))
@@ -193,72 +655,34 @@ def correct_checksum (filename):
 			payload = file.read()
 	except FileNotFoundError:
 		print('\n[!] Error: No such file or directory:', filename)
-		sys.exit(1)
+		return False
 	
 	print('[*] Trying to detect type.. ', end='')
-	cks_type = detect_offsets(payload)
-
-	if cks_type == None:
+	try:
+		result = calculate_checksums(payload)
+	except ChecksumException:
 		print('\n[!] Error: Calibration zone not detected.')
-		sys.exit(1)
+		return False
 
-	print(cks_type['name'])
+	print(result['layout'])
 
-	for region in cks_type['regions']:
+	for region in result['regions']:
 		print('[*] Calculating checksum for region {}'.format(region['name']))
-		flag_address, init_address, cks_address, bin_offset = region['flag_address'], region['init_address'], region['cks_address'], region['bin_offset']
+		print('[*] Amount of zones: {}'.format(len(region['zones']) if region['zones'] else payload[region['cks_address']+2]))
 
-		amount_of_zones = int.from_bytes(payload[cks_address+2:cks_address+3], "big")
-		print('[*] Amount of zones: {}'.format(amount_of_zones))
-
-		if (amount_of_zones == 0 or amount_of_zones == 0xFF):
+		if not region['zones']:
 			print('[*] Skipping region {}'.format(region['name']))
 			continue
 
-		checksums = []
-
-		zone_address = cks_address
-		for zone_index in range(amount_of_zones):
-
-			print('[*] Trying to find addresses of zone #{}.. '.format(zone_index+1), end='')
-			zone_start_offset = zone_address+0x04
-			zone_start = concat_3_bytes(read_and_reverse(payload, zone_start_offset, 3)) + bin_offset
-
-			zone_stop_offset = zone_address+0x08
-			zone_stop = concat_3_bytes(read_and_reverse(payload, zone_stop_offset, 3)) + bin_offset + 1
-			print('{} - {}'.format(hex(zone_start), hex(zone_stop)))
-
-			print('[*] Trying to find initial value.. ', end='')
-			if (zone_index == 0):
-				initial_value_bytes = read_and_reverse(payload, init_address, 2)
-				initial_value = (initial_value_bytes[0]<< 8) | initial_value_bytes[1]
-			else:
-				initial_value = checksums[zone_index-1]
-			print(hex(initial_value))
-
-			print('[*] checksum of zone #{}: '.format(zone_index+1), end='')
-			zone_cks = checksum(payload, zone_start, zone_stop, initial_value)
-			print(hex(zone_cks))
-			checksums.append(zone_cks)
-			zone_address += 0x08
-
-		checksum_b1 = (checksums[-1] >> 8) & 0xFF
-		checksum_b2 = (checksums[-1] & 0xFF)
-		checksum_reversed = (checksum_b2 << 8) | checksum_b1
-
-		current_checksum = int.from_bytes(payload[cks_address:cks_address+2], "big")
-		region['checksum'] = checksum_reversed
+		for zone_index, (zone_start, zone_stop, initial_value, zone_cks) in enumerate(region['zones']):
+			print('[*] Trying to find addresses of zone #{}.. {} - {}'.format(zone_index+1, hex(zone_start), hex(zone_stop)))
+			print('[*] Trying to find initial value.. {}'.format(hex(initial_value)))
+			print('[*] checksum of zone #{}: {}'.format(zone_index+1, hex(zone_cks)))
 
-		print('[*] OK! Current {} checksum: {}, new checksum: {}'.format(region['name'], hex(current_checksum), hex(checksum_reversed)))
+		print('[*] OK! Current {} checksum: {}, new checksum: {}'.format(region['name'], hex(region['current']), hex(region['calculated'])))
 
 	if (input('[?] Save to {}? [y/n]: '.format(filename)) == 'y'):
-		with open(filename, 'rb+') as file:
-			for region in cks_type['regions']:
-				file.seek(region['cks_address'])
-				try:
-					file.write(region['checksum'].to_bytes(2, "big"))
-				except KeyError:
-					continue
+		correct_checksum_file(filename, patch=True)
 		print('[*] Done!')
 
-	sys.exit(1)
+	return True
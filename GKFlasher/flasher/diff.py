@@ -0,0 +1,132 @@
+import mmap, os, sys
+from flasher.checksum import split_regions, detect_offsets, region_checksum
+
+# blocks compared at once - differing ones are narrowed down to sub blocks and then bytes
+block_size = 0x1000
+sub_block_size = 0x40
+
+def open_image (filename: str):
+	'''
+	Memory map a dump read only. Empty files can't be mapped, they're returned as b''
+	'''
+	with open(filename, 'rb') as file:
+		if (os.fstat(file.fileno()).st_size == 0):
+			return b''
+		return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def differing_bytes (a, b, start: int, stop: int) -> list[tuple[int, int]]:
+	ranges = []
+	for offset in range(start, stop):
+		if (a[offset] != b[offset]):
+			if (ranges and ranges[-1][1] == offset):
+				ranges[-1][1] = offset+1
+			else:
+				ranges.append([offset, offset+1])
+	return ranges
+
+def find_differences (a, b) -> list[tuple[int, int]]:
+	'''
+	Find ranges where two images differ. Equal blocks are skipped with a single
+	slice comparison, only differing sub blocks are compared byte by byte.
+	If the images differ in size, the extra tail counts as a difference
+
+	:return: list of (start, stop), adjacent ranges merged
+	'''
+	a_view, b_view = memoryview(a), memoryview(b)
+	common = min(len(a), len(b))
+	ranges = []
+
+	for block_start in range(0, common, block_size):
+		block_stop = min(block_start+block_size, common)
+		if (a_view[block_start:block_stop] == b_view[block_start:block_stop]):
+			continue
+
+		for sub_start in range(block_start, block_stop, sub_block_size):
+			sub_stop = min(sub_start+sub_block_size, block_stop)
+			if (a_view[sub_start:sub_stop] == b_view[sub_start:sub_stop]):
+				continue
+
+			for start, stop in differing_bytes(a_view, b_view, sub_start, sub_stop):
+				if (ranges and ranges[-1][1] == start):
+					ranges[-1][1] = stop
+				else:
+					ranges.append([start, stop])
+
+	if (len(a) != len(b)):
+		if (ranges and ranges[-1][1] == common):
+			ranges[-1][1] = max(len(a), len(b))
+		else:
+			ranges.append([common, max(len(a), len(b))])
+
+	a_view.release()
+	b_view.release()
+	return [tuple(x) for x in ranges]
+
+def label_ranges (ranges: list, regions: list) -> list[tuple[int, int, str]]:
+	'''
+	Split ranges at region borders and name them after the region they're in
+
+	:return: list of (start, stop, region name)
+	'''
+	labelled = []
+	for start, stop in ranges:
+		for region_start, region_stop, name in regions:
+			if (start < region_stop and stop > region_start):
+				labelled.append((max(start, region_start), min(stop, region_stop), name))
+		if (stop > regions[-1][1]):
+			labelled.append((max(start, regions[-1][1]), stop, None))
+	return labelled
+
+def checksum_status (payload) -> dict:
+	'''
+	:return: region name -> 'OK', 'BAD' or 'no zones'. Empty if the layout isn't known
+	'''
+	cks_type = detect_offsets(payload)
+	if (cks_type == None):
+		return {}
+
+	status = {}
+	for region in cks_type['regions']:
+		try:
+			result = region_checksum(payload, region)
+		except IndexError: # zone table points outside of the image
+			status[region['name']] = 'BAD'
+			continue
+		if (result == None):
+			status[region['name']] = 'no zones'
+		else:
+			status[region['name']] = 'OK' if result['current'] == result['calculated'] else 'BAD'
+	return status
+
+def diff_images (a, b) -> dict:
+	layout, regions = split_regions(a)
+	ranges = find_differences(a, b)
+	return {
+		'layout': layout,
+		'ranges': label_ranges(ranges, regions),
+		'bytes': sum([stop-start for start, stop in ranges]),
+		'checksums': (checksum_status(a), checksum_status(b))
+	}
+
+def cli_diff (filename_a: str, filename_b: str) -> bool:
+	try:
+		a, b = open_image(filename_a), open_image(filename_b)
+	except FileNotFoundError as e:
+		print('[!] Error: No such file or directory:', e.filename)
+		sys.exit(1)
+
+	result = diff_images(a, b)
+
+	print('[*] Layout: {}'.format(result['layout'] or 'unknown'))
+	if (len(a) != len(b)):
+		print('[!] Sizes differ: {} bytes vs {} bytes'.format(len(a), len(b)))
+
+	print('[*] {} differing ranges, {} bytes'.format(len(result['ranges']), result['bytes']))
+	for start, stop, name in result['ranges']:
+		print('    {} {} - {} ({} bytes)'.format(name or '-', hex(start), hex(stop), stop-start))
+
+	checksums_a, checksums_b = result['checksums']
+	for name in dict.fromkeys(list(checksums_a)+list(checksums_b)):
+		print('[*] {} checksum: {}: {}, {}: {}'.format(name, filename_a, checksums_a.get(name, '-'), filename_b, checksums_b.get(name, '-')))
+
+	return len(result['ranges']) == 0
@@ -1,6 +1,7 @@
 from gkbus import kwp
 import logging
 from ecu_definitions import ECU_IDENTIFICATION_TABLE, IOIdentifier
+from flasher.planner import RegionMap
 logger = logging.getLogger(__name__)
 
 kwp_ecu_identification_parameters = [
@@ -118,30 +119,85 @@ class ECU:
 		description = self.bus.execute(kwp.commands.ReadMemoryByAddress(offset=self.calculate_memory_offset(0x090040), size=8)).get_data()
 		return ''.join([chr(x) for x in description])
 
+	def get_region_map (self) -> RegionMap:
+		if not hasattr(self, 'region_map'):
+			self.region_map = RegionMap.load(self.name)
+		return self.region_map
+
+	def _read_memory_by_address (self, offset: int, size: int):
+		return self.bus.execute(
+			kwp.commands.ReadMemoryByAddress(
+				offset=self.calculate_memory_offset(offset), 
+				size=size
+			)
+		).get_data()
+
+	def _is_readable (self, offset: int) -> bool:
+		try:
+			self._read_memory_by_address(offset, 1)
+			return True
+		except kwp.KWPNegativeResponseException as e:
+			if '0x52' not in str(e):
+				raise
+			return False
+
 	def read_memory_by_address (self, offset: int, size: int):
-		data = []
-		
 		try:
-			data = self.bus.execute(
-				kwp.commands.ReadMemoryByAddress(
-					offset=self.calculate_memory_offset(offset), 
-					size=size
-				)
-			).get_data()
+			return self._read_memory_by_address(offset, size)
 		except kwp.KWPNegativeResponseException as e:
-			if '0x52' in str(e): # TODO TODO! gkbus enum. can't upload from specific address
-				if size == 1:
-					raise
-				logger.warning('Can\'t upload from %s! This might be a restricted area or more commonly, offset where eeprom pages switch. I\'m gonna try reading 1 byte at a time for the next 16 bytes', hex(offset))
-				try:
-					one_at_a_time_amount = min(16, size)
-					for x in range(one_at_a_time_amount):
-						data += self.read_memory_by_address(offset+x, size=1)
-					data += self.read_memory_by_address(offset+one_at_a_time_amount, size=size-one_at_a_time_amount)
-				except KWPNegativeResponseException as e:
-					raise
-			else:
+			if '0x52' not in str(e) or size == 1: # TODO TODO! gkbus enum. can't upload from specific address
 				raise
+			logger.warning('Can\'t upload from %s! This might be a restricted area or more commonly, offset where eeprom pages switch. Looking for it..', hex(offset))
+			return self._read_around_restriction(offset, size)
+
+	def _read_around_restriction (self, offset: int, size: int):
+		region_map = self.get_region_map()
+
+		# longest prefix that can still be read in one request. 
+		# readable (0 = nothing) is known to work, failing is known to fail
+		data, readable, failing = [], 0, size
+		while (failing - readable) > 1:
+			middle = (readable+failing)//2
+			try:
+				data = self._read_memory_by_address(offset, middle)
+				readable = middle
+			except kwp.KWPNegativeResponseException as e:
+				if '0x52' not in str(e):
+					raise
+				failing = middle
+
+		address = offset+readable
+		data = list(data)
+		if self._is_readable(address):
+			# byte itself is readable, a request just can't cross this address
+			logger.info('Found page boundary at %s', hex(address))
+			region_map.add_boundary(address)
+		else:
+			# restricted. gallop forward for the first readable byte, then narrow it down.
+			# restricted is the amount of bytes known to be restricted, readable the first known readable
+			remaining = offset+size-address
+			restricted, readable, step = 1, remaining, 1
+			while restricted < remaining:
+				probe = min(restricted-1+step, remaining-1)
+				if self._is_readable(address+probe):
+					readable = probe
+					break
+				restricted, step = probe+1, step*2
+
+			while restricted < readable:
+				middle = (restricted+readable)//2
+				if self._is_readable(address+middle):
+					readable = middle
+				else:
+					restricted = middle+1
+
+			logger.warning('Found restricted range %s - %s, filling it with 0xFF', hex(address), hex(address+restricted))
+			region_map.add_restricted(address, address+restricted)
+			data = list(data) + [0xFF]*restricted
+			address += restricted
+
+		if (address < offset+size):
+			data += self.read_memory_by_address(address, offset+size-address)
 		return data
 
 	def clear_adaptive_values (self, desired_baudrate):
@@ -167,3 +223,11 @@ def identify_ecu (bus) -> ECU:
 			ecu.set_bus(bus)
 			return ecu
 	raise ECUIdentificationException('Failed to identify ECU!')
+
+def get_ecu_by_name (bus, name: str) -> ECU:
+	for ecu_identifier in ECU_IDENTIFICATION_TABLE:
+		if ecu_identifier['ecu']['name'] == name:
+			ecu = ECU(**ecu_identifier['ecu'])
+			ecu.set_bus(bus)
+			return ecu
+	raise ECUIdentificationException('Unknown ECU: {}'.format(name))
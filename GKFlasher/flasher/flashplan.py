@@ -0,0 +1,180 @@
+import hashlib
+from gkbus import kwp
+from ecu_definitions import Routine
+from flasher.cache import load_cache, update_cache
+from flasher.memory import write_memory, dynamic_find_end, find_data_segments, TransferStats
+
+# used for time estimates until a real transfer has been measured, bytes per second
+default_write_throughput = 1000
+# block size of section readbacks
+readback_block_size = 254
+
+class FlashSection:
+	def __init__ (self, name: str, description: str, routine: Routine, flash_start: int, read_address: int, data: bytes, download_address=None):
+		self.name, self.description, self.routine = name, description, routine
+		self.flash_start, self.read_address = flash_start, read_address
+		self.data = bytes(data) # whole section, as it is in the file
+		self.payload = self.data[:dynamic_find_end(self.data)]
+		self.segments = [(0, len(self.payload))] # parts of the payload that are sent, see skip_gaps in plan_flash
+		self.digest = hashlib.sha1(self.data).hexdigest()
+		self.skip, self.reason = False, None
+		self._download_address = download_address
+
+	def download_address (self, offset: int) -> int:
+		if (self._download_address):
+			return self._download_address(offset)
+		return self.flash_start + offset
+
+	def bytes_to_send (self) -> int:
+		return sum([stop-start for start, stop in self.segments])
+
+def build_sections (ecu, eeprom: bytes, flash_calibration: bool = True, flash_program: bool = True) -> list[FlashSection]:
+	sections = []
+
+	if flash_program:
+		payload_start = ecu.get_program_section_flash_bin_offset()
+		sections.append(FlashSection(
+			'program', 'program code', Routine.ERASE_PROGRAM,
+			flash_start=ecu.get_program_section_offset() + ecu.get_program_section_flash_memory_offset(),
+			read_address=payload_start - ecu.bin_offset,
+			data=eeprom[payload_start:payload_start+ecu.get_program_section_flash_size()]
+		))
+
+	if flash_calibration:
+		payload_start = ecu.calculate_bin_offset(0x090000)
+		sections.append(FlashSection(
+			'calibration', 'calibration', Routine.ERASE_CALIBRATION,
+			flash_start=ecu.calculate_memory_write_offset(0x090000),
+			read_address=0x090000,
+			data=eeprom[payload_start:payload_start+ecu.get_calibration_size_bytes_flash()],
+			download_address=lambda offset: ecu.calculate_memory_write_offset(0x090000+offset)
+		))
+
+	return sections
+
+def file_calibration (ecu, eeprom: bytes) -> str:
+	offset = ecu.calculate_bin_offset(0x090000)
+	return ''.join([chr(x) for x in eeprom[offset:offset+8]])
+
+def section_cache_key (ecu, calibration: str) -> str:
+	return '{}/{}'.format(ecu.get_name(), calibration)
+
+def get_write_throughput () -> float:
+	return load_cache('flash_stats').get('write_throughput', default_write_throughput)
+
+def record_write_throughput (size: int, elapsed: float) -> None:
+	if (elapsed <= 0 or size == 0):
+		return
+	update_cache('flash_stats', lambda stats: stats.update(write_throughput=size/elapsed))
+
+def remember_sections (ecu, calibration: str, digests: dict) -> None:
+	key = section_cache_key(ecu, calibration)
+	update_cache('ecu_sections', lambda known: known.setdefault(key, {}).update(digests))
+
+def remember_dump (ecu, calibration: str, eeprom: bytes, address_start: int, address_stop: int) -> None:
+	'''
+	Remember hashes of the sections a dump fully covers, so flashing a file
+	with the same sections later on can skip them
+	'''
+	if (calibration == None):
+		return
+	digests = {}
+	for section in build_sections(ecu, eeprom):
+		if (address_start <= section.read_address and section.read_address+len(section.data) <= address_stop):
+			digests[section.name] = section.digest
+	if digests:
+		remember_sections(ecu, calibration, digests)
+
+def readback_digest (ecu, section: FlashSection) -> str:
+	digest = hashlib.sha1()
+	for offset in range(0, len(section.data), readback_block_size):
+		size = min(readback_block_size, len(section.data)-offset)
+		digest.update(bytes(ecu.read_memory_by_address(section.read_address+offset, size)))
+	return digest.hexdigest()
+
+def cached_dump_matches (ecu, section: FlashSection) -> bool:
+	'''
+	Confirm the ECU still holds the cached dump - it may have been reflashed by other means since.
+	The whole section is read back, a few samples miss a tune that kept the calibration ID 
+	or a patch of a few program bytes
+	'''
+	try:
+		return readback_digest(ecu, section) == section.digest
+	except kwp.KWPNegativeResponseException:
+		return False
+
+class FlashPlan:
+	def __init__ (self, ecu, eeprom: bytes, sections: list[FlashSection], current_calibration: str = None):
+		self.ecu, self.eeprom, self.sections = ecu, eeprom, sections
+		self.current_calibration = current_calibration
+
+	def to_send (self) -> list[FlashSection]:
+		return [section for section in self.sections if not section.skip]
+
+	def bytes_to_send (self) -> int:
+		return sum([section.bytes_to_send() for section in self.to_send()])
+
+	def estimated_time (self) -> float:
+		return self.bytes_to_send()/get_write_throughput()
+
+	def summary (self) -> list[str]:
+		lines = []
+		for section in self.sections:
+			if section.skip:
+				lines.append('{}: skipping, {}'.format(section.description.capitalize(), section.reason))
+			elif (len(section.segments) > 1):
+				lines.append('{}: erase and write {} bytes in {} segments, skipping {} erased bytes'.format(section.description.capitalize(), section.bytes_to_send(), len(section.segments), len(section.payload)-section.bytes_to_send()))
+			else:
+				lines.append('{}: erase and write {} bytes'.format(section.description.capitalize(), section.bytes_to_send()))
+		lines.append('Bytes to send: {}, estimated time: {}m {}s'.format(self.bytes_to_send(), *divmod(round(self.estimated_time()), 60)))
+		return lines
+
+	def remember (self) -> None:
+		'''
+		Call after a successful flash - from now on the ECU holds what the file holds
+		'''
+		digests = {}
+		if (self.current_calibration != None):
+			digests.update(load_cache('ecu_sections').get(section_cache_key(self.ecu, self.current_calibration), {}))
+		digests.update({section.name: section.digest for section in self.sections})
+		remember_sections(self.ecu, file_calibration(self.ecu, self.eeprom), digests)
+
+def plan_flash (ecu, eeprom: bytes, flash_calibration: bool = True, flash_program: bool = True, diff: bool = True, readback: bool = False, skip_gaps: bool = False) -> FlashPlan:
+	'''
+	Figure out which sections actually have to be flashed. A section is skipped when
+	it's identical to what's on the ECU - either according to a cached dump of the
+	ECU's current calibration (confirmed by reading the section back), or, if readback 
+	is enabled, by reading back the whole section even without a cached dump.
+	With skip_gaps, erased (0xFF) runs inside a section aren't sent - every
+	data segment gets its own RequestDownload instead
+	'''
+	sections = build_sections(ecu, eeprom, flash_calibration, flash_program)
+	if skip_gaps:
+		for section in sections:
+			section.segments = find_data_segments(section.payload)
+	if not diff:
+		return FlashPlan(ecu, eeprom, sections)
+
+	try:
+		current_calibration = ecu.get_calibration()
+	except kwp.KWPNegativeResponseException:
+		return FlashPlan(ecu, eeprom, sections)
+
+	known = load_cache('ecu_sections').get(section_cache_key(ecu, current_calibration), {})
+	for section in sections:
+		if (known.get(section.name) == section.digest):
+			if cached_dump_matches(ecu, section):
+				section.skip, section.reason = True, 'identical to the cached dump of {}'.format(current_calibration)
+		elif (readback and readback_digest(ecu, section) == section.digest):
+			section.skip, section.reason = True, 'identical to the ECU readback'
+
+	return FlashPlan(ecu, eeprom, sections, current_calibration)
+
+def write_section (ecu, section: FlashSection, progress_callback=False) -> TransferStats:
+	ecu.bus.execute(kwp.commands.StartRoutineByLocalIdentifier(section.routine.value))
+
+	stats = TransferStats()
+	for start, stop in section.segments:
+		write_memory(ecu, section.payload[start:stop], section.download_address(start), stop-start, progress_callback=progress_callback, stats=stats)
+	record_write_throughput(stats.bytes_sent, stats.elapsed())
+	return stats
@@ -0,0 +1,116 @@
+import json, os
+
+class DumpJournalException (Exception):
+	pass
+
+class DumpJournal:
+	'''
+	Checkpoint journal of a memory dump. Fetched pages are written straight into
+	a sparse output file, and the address ranges that already made it to disk
+	are recorded in <output filename>.journal, so an interrupted read
+	(K-Line dropout, Ctrl-C) can be resumed instead of started over.
+	'''
+	def __init__ (self, output_filename: str, ecu_name: str, calibration: str, eeprom_size: int, bin_offset: int, address_start: int, address_stop: int, completed: list = None):
+		self.output_filename = output_filename
+		self.ecu_name, self.calibration = ecu_name, calibration
+		self.eeprom_size, self.bin_offset = eeprom_size, bin_offset
+		self.address_start, self.address_stop = address_start, address_stop
+		self.completed = completed if completed != None else []
+
+	@staticmethod
+	def journal_filename (output_filename: str) -> str:
+		return output_filename + '.journal'
+
+	@classmethod
+	def create (cls, output_filename: str, ecu, calibration: str, eeprom_size: int, address_start: int, address_stop: int):
+		journal = cls(output_filename, ecu.get_name(), calibration, eeprom_size, ecu.bin_offset, address_start, address_stop)
+
+		with open(output_filename, 'wb') as file:
+			file.truncate(eeprom_size) # sparse, holes are filled up in finalize()
+
+		journal.save()
+		return journal
+
+	@classmethod
+	def load (cls, output_filename: str):
+		try:
+			with open(cls.journal_filename(output_filename), 'r') as file:
+				state = json.load(file)
+		except FileNotFoundError:
+			raise DumpJournalException('No journal found for {}'.format(output_filename))
+
+		if not os.path.exists(output_filename):
+			raise DumpJournalException('Journal found, but {} is missing'.format(output_filename))
+
+		return cls(output_filename, **state)
+
+	def save (self) -> None:
+		state = {
+			'ecu_name': self.ecu_name,
+			'calibration': self.calibration,
+			'eeprom_size': self.eeprom_size,
+			'bin_offset': self.bin_offset,
+			'address_start': self.address_start,
+			'address_stop': self.address_stop,
+			'completed': self.completed
+		}
+
+		journal_filename = self.journal_filename(self.output_filename)
+		with open(journal_filename + '.tmp', 'w') as file:
+			json.dump(state, file)
+			file.flush()
+			os.fsync(file.fileno())
+		os.replace(journal_filename + '.tmp', journal_filename)
+
+	def mark_completed (self, start: int, stop: int) -> None:
+		merged = []
+		for range_start, range_stop in sorted(self.completed + [[start, stop]]):
+			if merged and range_start <= merged[-1][1]:
+				merged[-1][1] = max(merged[-1][1], range_stop)
+			else:
+				merged.append([range_start, range_stop])
+		self.completed = merged
+
+	def missing_ranges (self) -> list[tuple[int, int]]:
+		missing = []
+		address = self.address_start
+
+		for range_start, range_stop in self.completed:
+			if range_start > address:
+				missing.append((address, min(range_start, self.address_stop)))
+			address = max(address, range_stop)
+			if address >= self.address_stop:
+				break
+
+		if address < self.address_stop:
+			missing.append((address, self.address_stop))
+
+		return missing
+
+	def bytes_missing (self) -> int:
+		return sum([stop-start for start, stop in self.missing_ranges()])
+
+	def write (self, address: int, data) -> None:
+		data = bytes(data[:max(0, self.address_stop-address)])
+
+		with open(self.output_filename, 'r+b') as file:
+			file.seek(address + self.bin_offset)
+			file.write(data)
+			file.flush()
+			os.fsync(file.fileno())
+
+		self.mark_completed(address, address+len(data))
+		self.save()
+
+	def finalize (self) -> None:
+		# pad everything outside of the requested range with 0xFF, just like a regular dump
+		range_start = self.address_start + self.bin_offset
+		range_stop = self.address_stop + self.bin_offset
+
+		with open(self.output_filename, 'r+b') as file:
+			file.seek(0)
+			file.write(b'\xFF'*range_start)
+			file.seek(range_stop)
+			file.write(b'\xFF'*(self.eeprom_size-range_stop))
+
+		os.remove(self.journal_filename(self.output_filename))
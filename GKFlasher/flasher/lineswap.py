@@ -1,5 +1,6 @@
 import os
 import logging
+from array import array
 
 # Logger configuration
 logger = logging.getLogger("bsl")
@@ -32,6 +33,91 @@ def set_gui_log_handler(gui_callback):
     gui_handler.setFormatter(logging.Formatter("%(message)s"))
     logger.addHandler(gui_handler)
 
+# SIMK43 2.0L line swap, source bit -> destination bit
+bin_to_sie_mapping = {
+    15: 0,  # AD15 -> DQ0
+    13: 1,  # AD13 -> DQ1
+    11: 2,  # AD11 -> DQ2
+    9: 3,   # AD9 -> DQ3
+    0: 4,   # AD0 -> DQ4
+    2: 5,   # AD2 -> DQ5
+    4: 6,   # AD4 -> DQ6
+    6: 7,   # AD6 -> DQ7
+    14: 8,  # AD14 -> DQ8
+    12: 9,  # AD12 -> DQ9
+    10: 10, # AD10 -> DQ10
+    8: 11,  # AD8 -> DQ11
+    1: 12,  # AD1 -> DQ12
+    3: 13,  # AD3 -> DQ13
+    5: 14,  # AD5 -> DQ14
+    7: 15   # AD7 -> DQ15
+}
+
+sie_to_bin_mapping = {
+    0: 15,  # DQ0 -> AD15
+    1: 13,  # DQ1 -> AD13
+    2: 11,  # DQ2 -> AD11
+    3: 9,   # DQ3 -> AD9
+    4: 0,   # DQ4 -> AD0
+    5: 2,   # DQ5 -> AD2
+    6: 4,   # DQ6 -> AD4
+    7: 6,   # DQ7 -> AD6
+    8: 14,  # DQ8 -> AD14
+    9: 12,  # DQ9 -> AD12
+    10: 10, # DQ10 -> AD10
+    11: 8,  # DQ11 -> AD8
+    12: 1,  # DQ12 -> AD1
+    13: 3,  # DQ13 -> AD3
+    14: 5,  # DQ14 -> AD5
+    15: 7   # DQ15 -> AD7
+}
+
+# Files are converted in chunks of this size (must be even)
+chunk_size = 0x100000
+
+
+def permute(value, mapping):
+    """Move every bit of value from its source to its destination position."""
+    swapped_value = 0
+    for source, destination in mapping.items():
+        if value >> source & 1:
+            swapped_value |= 1 << destination
+    return swapped_value
+
+
+def build_byte_tables(mapping):
+    """
+    Split a 16-bit permutation into per-byte tables. Each input byte contributes
+    to both output bytes, so a word is swapped as
+    low = low_to_low[b0] | high_to_low[b1], high = low_to_high[b0] | high_to_high[b1].
+
+    Returns:
+        tuple: (low_to_low, low_to_high, high_to_low, high_to_high) as bytes.translate tables.
+    """
+    from_low = [permute(byte, mapping) for byte in range(256)]
+    from_high = [permute(byte << 8, mapping) for byte in range(256)]
+    return (
+        bytes([word & 0xFF for word in from_low]),
+        bytes([word >> 8 for word in from_low]),
+        bytes([word & 0xFF for word in from_high]),
+        bytes([word >> 8 for word in from_high])
+    )
+
+
+def build_word_table(byte_tables):
+    """Combine per-byte tables into a 65,536 entry table indexed by the 16-bit word."""
+    low_to_low, low_to_high, high_to_low, high_to_high = byte_tables
+    from_low = [low_to_low[byte] | low_to_high[byte] << 8 for byte in range(256)]
+    from_high = [high_to_low[byte] | high_to_high[byte] << 8 for byte in range(256)]
+    return array('H', [high | low for high in from_high for low in from_low])
+
+
+forward_byte_tables = build_byte_tables(bin_to_sie_mapping)
+reverse_byte_tables = build_byte_tables(sie_to_bin_mapping)
+forward_table = build_word_table(forward_byte_tables)
+reverse_table = build_word_table(reverse_byte_tables)
+
+
 def forward_lookup(value):
     """
     Convert an input value to its line-swapped equivalent based on the SIMK43 2.0L mapping.
@@ -44,33 +130,7 @@ def forward_lookup(value):
     Returns:
         int: The line-swapped equivalent value.
     """
-    bin_to_sie_mapping = {
-        15: 0,  # AD15 -> DQ0
-        13: 1,  # AD13 -> DQ1
-        11: 2,  # AD11 -> DQ2
-        9: 3,   # AD9 -> DQ3
-        0: 4,   # AD0 -> DQ4
-        2: 5,   # AD2 -> DQ5
-        4: 6,   # AD4 -> DQ6
-        6: 7,   # AD6 -> DQ7
-        14: 8,  # AD14 -> DQ8
-        12: 9,  # AD12 -> DQ9
-        10: 10, # AD10 -> DQ10
-        8: 11,  # AD8 -> DQ11
-        1: 12,  # AD1 -> DQ12
-        3: 13,  # AD3 -> DQ13
-        5: 14,  # AD5 -> DQ14
-        7: 15   # AD7 -> DQ15
-    }
-
-    binary_value = f"{value:016b}"
-    swapped_binary = ['0'] * 16
-
-    for dq_pin, ad_pin in bin_to_sie_mapping.items():
-        swapped_binary[15 - ad_pin] = binary_value[15 - dq_pin]
-
-    swapped_value = int(''.join(swapped_binary), 2)
-    return swapped_value
+    return forward_table[value]
 
 
 def reverse_lookup(value):
@@ -85,59 +145,58 @@ def reverse_lookup(value):
     Returns:
         int: The unline-swapped equivalent value.
     """
-    sie_to_bin_mapping = {
-        0: 15,  # DQ0 -> AD15
-        1: 13,  # DQ1 -> AD13
-        2: 11,  # DQ2 -> AD11
-        3: 9,   # DQ3 -> AD9
-        4: 0,   # DQ4 -> AD0
-        5: 2,   # DQ5 -> AD2
-        6: 4,   # DQ6 -> AD4
-        7: 6,   # DQ7 -> AD6
-        8: 14,  # DQ8 -> AD14
-        9: 12,  # DQ9 -> AD12
-        10: 10, # DQ10 -> AD10
-        11: 8,  # DQ11 -> AD8
-        12: 1,  # DQ12 -> AD1
-        13: 3,  # DQ13 -> AD3
-        14: 5,  # DQ14 -> AD5
-        15: 7   # DQ15 -> AD7
-    }
-
-    binary_value = f"{value:016b}"
-    swapped_binary = ['0'] * 16
-
-    for dq_pin, ad_pin in sie_to_bin_mapping.items():
-        swapped_binary[15 - ad_pin] = binary_value[15 - dq_pin]
-
-    swapped_value = int(''.join(swapped_binary), 2)
-    return swapped_value
+    return reverse_table[value]
+
+
+def swap_words(data, byte_tables):
+    """
+    Line-swap a block of little endian 16-bit words at once. Low and high bytes are
+    translated separately and merged as big integers, so no Python code runs per word.
+    An odd trailing byte is handled like a word with a zero high byte.
+
+    Returns:
+        bytes: The swapped block, always an even number of bytes.
+    """
+    low_to_low, low_to_high, high_to_low, high_to_high = byte_tables
+    low, high = bytes(data[0::2]), bytes(data[1::2])
+    if len(high) < len(low):
+        high += b'\x00'
+
+    size = len(low)
+    swapped_low = int.from_bytes(low.translate(low_to_low), 'little') | int.from_bytes(high.translate(high_to_low), 'little')
+    swapped_high = int.from_bytes(low.translate(low_to_high), 'little') | int.from_bytes(high.translate(high_to_high), 'little')
+
+    swapped = bytearray(size*2)
+    swapped[0::2] = swapped_low.to_bytes(size, 'little')
+    swapped[1::2] = swapped_high.to_bytes(size, 'little')
+    return bytes(swapped)
+
+
+def bin_to_sie(data):
+    return swap_words(data, forward_byte_tables)
+
+
+def sie_to_bin(data):
+    return swap_words(data, reverse_byte_tables)
+
+
+def convert_file(filename, output_filename, byte_tables):
+    with open(filename, 'rb') as infile, open(output_filename, 'wb') as outfile:
+        while chunk := infile.read(chunk_size):
+            outfile.write(swap_words(chunk, byte_tables))
 
 
 def generate_sie(filename):
     logger.info(f"Reading {os.path.basename(filename)}")
-    
-    try:
-        with open(filename, 'rb') as infile:
-            payload = infile.read()
-    except FileNotFoundError:
+
+    if not os.path.isfile(filename):
         logger.error(f"File not found!")
         return
 
     logger.info("Converting BIN to SIE...")
     output_filename = os.path.splitext(filename)[0] + ".sie"
     try:
-        with open(output_filename, 'wb') as outfile:
-            for i in range(0, len(payload), 2):
-                # Read 16-bit word
-                word = int.from_bytes(payload[i:i+2], byteorder='little', signed=False)
-                
-                # Convert using the provided function
-                swapped_word = forward_lookup(word)
-                
-                # Write the swapped word to the output file
-                outfile.write(swapped_word.to_bytes(2, byteorder='little'))
-    
+        convert_file(filename, output_filename, forward_byte_tables)
         logger.info(f"Done! Converted file saved as {output_filename}")
         return
 
@@ -148,33 +207,18 @@ def generate_sie(filename):
 
 def generate_bin(filename):
     logger.info(f"Reading {os.path.basename(filename)}")
-    
-    try:
-        with open(filename, 'rb') as infile:
-            payload = infile.read()
-    except FileNotFoundError:
+
+    if not os.path.isfile(filename):
         logger.error(f"File not found!")
         return
 
     logger.info("Converting SIE to BIN...")
     output_filename = os.path.splitext(filename)[0] + ".bin"
     try:
-        with open(output_filename, 'wb') as outfile:
-            for i in range(0, len(payload), 2):
-                # Read 16-bit word
-                word = int.from_bytes(payload[i:i+2], byteorder='little', signed=False)
-                
-                # Convert using the provided function
-                swapped_word = reverse_lookup(word)
-                
-                # Write the swapped word to the output file
-                outfile.write(swapped_word.to_bytes(2, byteorder='little'))
-    
+        convert_file(filename, output_filename, reverse_byte_tables)
         logger.info(f"Done! Converted file saved as {output_filename}")
         return
 
     except Exception as e:
         logger.error(f"Error during conversion: {e}")
         return
-
-
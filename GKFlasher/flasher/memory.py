@@ -1,9 +1,12 @@
-import logging
-from gkbus.kwp.commands import ReadMemoryByAddress, WriteMemoryByAddress, RequestDownload, TransferData, RequestTransferExit
+import logging, re, time
+from dataclasses import dataclass, field
+from gkbus.kwp.commands import ReadMemoryByAddress, WriteMemoryByAddress, RequestDownload, RequestUpload, TransferData, RequestTransferExit
 from gkbus.kwp.enums import CompressionType, EncryptionType
 from gkbus.kwp import KWPNegativeResponseException
 from gkbus import GKBusTimeoutException
 from math import ceil
+from flasher.planner import plan_reads, max_block_size
+from flasher.cache import load_cache, update_cache
 logger = logging.getLogger(__name__)
 
 page_size_b = 16384
@@ -15,132 +18,399 @@ def round_to_multiple(number, multiple):
         return multiple * ceil(number / multiple)
 
 def dynamic_find_end (payload):
-	payload_len = len(payload)
-	end_offset = payload_len
-	for index, x in enumerate(reversed(payload)):
-		if x == 0xFF:
-			end_offset = (round_to_multiple(payload_len-index, 254))
-		else:
-			break
-	return end_offset
+	# end of the data rounded up to a full packet, with at least one 0xFF byte of the tail kept
+	data_len = len(bytes(payload).rstrip(b'\xFF'))
+	if (data_len == len(payload)):
+		return data_len
+	return round_to_multiple(data_len+1, 254)
+
+# interior runs of 0xFF shorter than this aren't worth a new RequestDownload
+min_erased_gap = 1024
+# RequestDownload addresses of the flash are 0x10 aligned
+download_alignment = 0x10
+
+def find_erased_gaps (payload, min_gap=min_erased_gap, alignment=download_alignment):
+	'''
+	Find runs of 0xFF inside the payload (erased flash already holds 0xFF).
+	Gaps are shrunk inwards to the alignment, so data around them stays aligned
+
+	:return: list of (start, stop)
+	'''
+	gaps = []
+	for match in re.finditer(rb'\xFF{%d,}' % min_gap, bytes(payload)):
+		start = round_to_multiple(match.start(), alignment)
+		stop = match.end() - match.end()%alignment
+		if (stop-start >= min_gap):
+			gaps.append((start, stop))
+	return gaps
+
+def find_data_segments (payload, min_gap=min_erased_gap, alignment=download_alignment):
+	'''
+	Complement of find_erased_gaps - parts of the payload that actually have to be sent
 
-def read_page_16kib(ecu, offset, at_a_time=254, progress_callback=False):
+	:return: list of (start, stop)
+	'''
+	segments = []
+	position = 0
+	for start, stop in find_erased_gaps(payload, min_gap, alignment):
+		if (start > position):
+			segments.append((position, start))
+		position = stop
+	if (position < len(payload)):
+		segments.append((position, len(payload)))
+	return segments
+
+def read_page_16kib(ecu, offset, at_a_time=max_block_size, progress_callback=False):
 	address_start = offset
 	address_stop = offset+page_size_b
-	address = address_start
+	region_map = ecu.get_region_map()
 
 	payload = [0xFF]*(address_stop-address_start)
 
-	while True:
-		if ( (address_stop-address) < at_a_time ):
-			at_a_time = (address_stop-address)
+	plan, plan_version = plan_reads(address_start, address_stop, region_map, at_a_time), region_map.version
+	index = 0
+	while index < len(plan):
+		address, size, readable = plan[index]
 
-		try:
-			fetched = ecu.read_memory_by_address(offset=address, size=at_a_time)
-		except KWPNegativeResponseException as e:
-			logger.warning('Negative KWP response at offset %s! Filling requested section with 0xF. %s', hex(address), e)
-			fetched = []
-		except GKBusTimeoutException:
-			logger.warning('Timeout at Offset %s! Trying again...', hex(address))
-			continue
+		if (readable):
+			try:
+				fetched = ecu.read_memory_by_address(offset=address, size=size)
+			except KWPNegativeResponseException as e:
+				logger.warning('Negative KWP response at offset %s! Filling requested section with 0xF. %s', hex(address), e)
+				fetched = []
+			except GKBusTimeoutException:
+				logger.warning('Timeout at Offset %s! Trying again...', hex(address))
+				continue
+		else:
+			logger.warning('Skipping restricted range %s - %s, filling it with 0xFF', hex(address), hex(address+size))
+			fetched = [] # known restricted range, stays 0xFF
 
 		payload_start = address-address_start
 		payload_stop = payload_start+len(fetched)
 		payload[payload_start:payload_stop] = fetched
 
-		address += at_a_time
-
 		if (progress_callback):
-			progress_callback(at_a_time)
+			progress_callback(size)
 
-		if (address >= address_stop):
-			break
+		if (region_map.version != plan_version):
+			# learnt something new about this ECU, plan the rest of the page around it
+			plan, plan_version = plan_reads(address+size, address_stop, region_map, at_a_time), region_map.version
+			index = 0
+		else:
+			index += 1
+
+	region_map.save()
 	return payload
 
 
+class UploadRejectedException (Exception):
+	pass
+
+# negative responses to RequestUpload meaning the ECU doesn't do uploads at all:
+# serviceNotSupported, uploadNotAccepted, improperUploadType
+upload_rejections = ['0x11', '0x50', '0x51']
+
+def upload_range (ecu, address: int, size: int) -> list:
+	'''
+	Read address - address+size with a single RequestUpload, as many TransferData 
+	requests as the ECU needs to send it and RequestTransferExit
+	'''
+	try:
+		ecu.bus.execute(RequestUpload(offset=ecu.calculate_memory_offset(address), size=size, compression_type=CompressionType.UNCOMPRESSED, encryption_type=EncryptionType.UNENCRYPTED))
+	except KWPNegativeResponseException as e:
+		if any(code in str(e) for code in upload_rejections):
+			raise UploadRejectedException(str(e))
+		raise
+
+	data = []
+	try:
+		while len(data) < size:
+			fetched = ecu.bus.execute(TransferData([])).get_data()
+			if (len(fetched) == 0):
+				raise TransferDataException('Empty TransferData response at offset {}'.format(hex(address+len(data))))
+			data += fetched
+	finally:
+		try:
+			ecu.bus.execute(RequestTransferExit())
+		except (KWPNegativeResponseException, GKBusTimeoutException) as e:
+			logger.info('RequestTransferExit after upload from %s failed. %s', hex(address), e)
+
+	return data[:size]
+
+def read_page_upload (ecu, offset, progress_callback=False):
+	address_start = offset
+	address_stop = offset+page_size_b
+
+	payload = [0xFF]*(address_stop-address_start)
+
+	# one upload per readable range of the page, restricted ranges stay 0xFF
+	for address, size, readable in plan_reads(address_start, address_stop, ecu.get_region_map(), page_size_b):
+		if (readable):
+			fetched = upload_range(ecu, address, size)
+			payload[address-address_start:address-address_start+len(fetched)] = fetched
+		else:
+			logger.warning('Skipping restricted range %s - %s, filling it with 0xFF', hex(address), hex(address+size))
+
+	if (progress_callback):
+		progress_callback(address_stop-address_start)
+
+	return payload
+
+read_modes = ['rmba', 'upload']
+read_page_functions = {'rmba': read_page_16kib, 'upload': read_page_upload}
+
+# calibration zone start, readable on every known ECU
+benchmark_address = 0x090000
+benchmark_size = 0x400
+
+def load_read_mode (ecu_name: str):
+	entry = load_cache('read_modes').get(ecu_name, {})
+	# uploads are only trusted once their bytes were checked against ReadMemoryByAddress
+	if (entry.get('mode') == 'upload' and not entry.get('validated')):
+		return None
+	return entry.get('mode')
+
+def save_read_mode (ecu_name: str, mode: str, throughput: dict = None) -> None:
+	entry = {'mode': mode, 'throughput': throughput or {}, 'validated': True}
+	update_cache('read_modes', lambda read_modes_cache: read_modes_cache.update({ecu_name: entry}))
+
+def measure_read_mode (ecu, mode: str) -> tuple[float, list]:
+	'''
+	:return: bytes per second reading benchmark_size bytes with the given mode, and the bytes read
+	'''
+	started = time.time()
+	if (mode == 'upload'):
+		data = upload_range(ecu, benchmark_address, benchmark_size)
+	else:
+		data = [0xFF]*benchmark_size
+		for address, size, readable in plan_reads(benchmark_address, benchmark_address+benchmark_size, ecu.get_region_map()):
+			if (readable):
+				data[address-benchmark_address:address-benchmark_address+size] = ecu.read_memory_by_address(offset=address, size=size)
+	return benchmark_size/max(time.time()-started, 0.001), list(data)
+
+def choose_read_mode (ecu, read_mode: str = 'auto') -> str:
+	'''
+	Resolve 'auto' to the faster read mode of this ECU type. ReadMemoryByAddress is the 
+	default, uploads are only chosen when they return the same bytes. The choice is remembered 
+	in ~/.gkflasher, so only the first dump of an ECU type measures both modes
+	'''
+	if (read_mode != 'auto'):
+		return read_mode
+	if (getattr(ecu, 'read_mode', None)):
+		return ecu.read_mode
+
+	mode = load_read_mode(ecu.get_name())
+	if (mode in read_modes):
+		ecu.read_mode = mode
+		return mode
+
+	throughput, data, conclusive = {}, {}, True
+	for mode in read_modes:
+		try:
+			throughput[mode], data[mode] = measure_read_mode(ecu, mode)
+		except UploadRejectedException as e:
+			logger.info('ECU rejected RequestUpload. %s', e)
+		except (KWPNegativeResponseException, GKBusTimeoutException, TransferDataException) as e:
+			logger.warning('Measuring %s read mode failed. %s', mode, e)
+			conclusive = False
+
+	if ('upload' in data and data['upload'] != data.get('rmba')):
+		if ('rmba' in data):
+			logger.warning('Uploaded bytes differ from ReadMemoryByAddress, not using uploads on %s', ecu.get_name())
+		else:
+			conclusive = False # nothing to check the upload against
+		del throughput['upload']
+
+	ecu.read_mode = max(throughput, key=throughput.get) if throughput else 'rmba'
+	logger.info('Read mode of %s: %s (%s)', ecu.get_name(), ecu.read_mode, ', '.join('{} {:.0f} B/s'.format(key, value) for key, value in throughput.items()))
+	if (conclusive and throughput):
+		save_read_mode(ecu.get_name(), ecu.read_mode, {key: round(value) for key, value in throughput.items()})
+	return ecu.read_mode
+
+def read_page (ecu, offset, read_mode, progress_callback=False):
+	'''
+	Read a page with the given mode. Uploads falling apart are retried with 
+	ReadMemoryByAddress, an ECU rejecting uploads switches the mode for good
+
+	:return: (page, read mode to use for the next page)
+	'''
+	if (read_mode == 'upload'):
+		try:
+			return read_page_upload(ecu, offset, progress_callback), read_mode
+		except UploadRejectedException as e:
+			logger.warning('ECU rejected RequestUpload, reading with ReadMemoryByAddress instead. %s', e)
+			ecu.read_mode = 'rmba'
+			save_read_mode(ecu.get_name(), 'rmba')
+			read_mode = 'rmba'
+		except (KWPNegativeResponseException, GKBusTimeoutException, TransferDataException) as e:
+			logger.warning('Upload of page %s failed, reading it with ReadMemoryByAddress. %s', hex(offset), e)
+			return read_page_16kib(ecu, offset, progress_callback=progress_callback), read_mode
+
+	return read_page_16kib(ecu, offset, progress_callback=progress_callback), read_mode
+
 # read memory into a buffer
 # this function only cares about reading from address_start to address_stop. 
 # it doesn't pad the read with 0xFFs or anything. If you request to read, for example,
 # the calibration zone, from 0x090000 to 0x094000 (16364 bytes) - then you'll only
 # get 16364 bytes back. 
-def read_memory(ecu, address_start, address_stop, progress_callback=False):#, progress_callback):
+# page_callback(address, data) is called after every fetched page, so the caller
+# can checkpoint the dump (see flasher/journal.py). KeyboardInterrupt is not
+# swallowed anymore - a partial buffer would otherwise be saved as a complete dump
+# read_mode is 'rmba' (ReadMemoryByAddress), 'upload' (RequestUpload/TransferData) 
+# or 'auto' - the faster one for this ECU type, see choose_read_mode
+def read_memory(ecu, address_start, address_stop, progress_callback=False, page_callback=None, read_mode='auto'):
 	requested_size = address_stop-address_start
-	pages = int(requested_size/page_size_b) # 16kib per page 
+	pages = ceil(requested_size/page_size_b) # 16kib per page 
 	buffer = [0xFF]*requested_size
 	address = address_start
+	read_mode = choose_read_mode(ecu, read_mode)
 
-	try:
-		page = 0
-		while True:
-			if (progress_callback):
-				progress_callback.title('Page {}/{}, offset {}'.format(page+1, pages, hex(address)))
+	page = 0
+	while True:
+		if (progress_callback):
+			progress_callback.title('Page {}/{}, offset {}'.format(page+1, pages, hex(address)))
 
-			fetched = read_page_16kib(ecu, offset=address, progress_callback=progress_callback)
-			
-			buffer_start = (address-address_start)
-			buffer_end = buffer_start + len(fetched)
-			buffer[buffer_start:buffer_end] = fetched
-			
-			address += page_size_b # 16kib per page 
-			
-			if (address >= address_stop):
-				break
+		fetched, read_mode = read_page(ecu, address, read_mode, progress_callback=progress_callback)
+		
+		buffer_start = (address-address_start)
+		buffer_end = buffer_start + len(fetched)
+		buffer[buffer_start:buffer_end] = fetched
 
-			page +=1
+		if (page_callback):
+			page_callback(address, fetched)
+		
+		address += page_size_b # 16kib per page 
+		
+		if (address >= address_stop):
+			break
 
-	except KeyboardInterrupt:
-		pass
+		page +=1
 
 	return buffer
 
-def write_memory(ecu, payload, flash_start, flash_size, progress_callback=False):
-	ecu.bus.execute(RequestDownload(offset=flash_start, size=flash_size, compression_type=CompressionType.UNCOMPRESSED, encryption_type=EncryptionType.UNENCRYPTED))
-
-	packets_to_write = int(flash_size/254)
-	packets_written = 0
-
-#Workaround to prevent progress bar overrun if flash_size is divisible by 254
-	if (flash_size%254==0) :
-			while packets_to_write > packets_written:
-				if (progress_callback):
-					progress_callback.title('Packet {}/{}'.format(packets_written+1, packets_to_write))
-
-				payload_packet_start = packets_written*254
-				payload_packet_end = payload_packet_start+254
-				payload_packet = payload[payload_packet_start:payload_packet_end]
-
-				while True:
-					try:
-						ecu.bus.execute(TransferData(list(payload_packet)))
-						break
-					except (GKBusTimeoutException):
-						logger.warning('Timeout at Block %s! Trying again...', packets_written)
-						continue
-			
-				packets_written += 1
-				
-				if (progress_callback):
-					progress_callback(len(payload_packet))
-	else:
-			while packets_to_write >= packets_written:
-				if (progress_callback):
-					progress_callback.title('Packet {}/{}'.format(packets_written, packets_to_write))
-
-				payload_packet_start = packets_written*254
-				payload_packet_end = payload_packet_start+254
-				payload_packet = payload[payload_packet_start:payload_packet_end]
-
-				while True:
-					try:
-						ecu.bus.execute(TransferData(list(payload_packet)))
-						break
-					except (GKBusTimeoutException):
-						logger.warning('Timeout at Block %s! Trying again...', packets_written)
-						continue
-
-				packets_written += 1
-				
-				if (progress_callback):
-					progress_callback(len(payload_packet))
+class TransferDataException (Exception):
+	pass
+
+@dataclass
+class TransferStats:
+	bytes_sent: int = 0
+	blocks_sent: int = 0
+	retries: int = 0
+	stall_time: float = 0 # seconds lost to timeouts, busy responses and backoff
+	block_times: list = field(default_factory=list)
+	started: float = field(default_factory=time.time)
+	finished: float = None
+
+	def elapsed (self) -> float:
+		return (self.finished or time.time()) - self.started
+
+	def throughput (self) -> float:
+		elapsed = self.elapsed()
+		return self.bytes_sent/elapsed if elapsed > 0 else 0
+
+	def slowest_block (self) -> float:
+		return max(self.block_times, default=0)
+
+	def __str__ (self) -> str:
+		return '{} bytes in {:.1f}s ({:.0f} B/s), {} retries, {:.1f}s stalled, slowest block {:.3f}s'.format(
+			self.bytes_sent, self.elapsed(), self.throughput(), self.retries, self.stall_time, self.slowest_block())
+
+# TransferData retry policy
+transfer_retries = 5
+transfer_backoff = 0.05 # seconds, doubled after every failed attempt of the same block
+max_transfer_backoff = 1.0 # seconds, so a long busy streak keeps asking instead of sleeping through the deadline
+busy_deadline = 30 # seconds a single block may keep the ECU busy before giving up
+
+def negotiate_block_size (response: list, block_size: int) -> int:
+	# RequestDownload positive response carries maxNumberOfBlockLength, 
+	# which counts the TransferData service identifier as well
+	if (len(response) > 0 and 1 < response[0]-1 < block_size):
+		return response[0]-1
+	return block_size
+
+def await_pending_response (bus, command, index: int, deadline: float) -> None:
+	'''
+	The ECU answered 0x78 - it has the request and responds once it's done. 
+	Read that response (every read bounded by the bus timeout) instead of sending the request again
+	'''
+	with bus._execute_lock: # keep the keepalive from sending in between
+		while True:
+			if hasattr(bus, 'fetch_response'): # K-line
+				response = bus.fetch_response()
+			else: # CAN
+				response = bus.socket.recv()
+				if (response == None):
+					raise GKBusTimeoutException()
+				response = list(response.data)
+			bus._last_execution_time = time.time()
+
+			if (response[0] == command.get_command()+0x40):
+				return
+			if (response[0] != 0x7F or 0x78 not in response[2:] or time.time() >= deadline):
+				raise TransferDataException('Block {} rejected: {}'.format(index, ' '.join(hex(x) for x in response)))
+			logger.info('ECU still busy at Block %s, response pending.', index)
+
+def transfer_block (ecu, block, index: int, stats: TransferStats) -> None:
+	attempt = 0
+	backoff = transfer_backoff
+	deadline = time.time() + busy_deadline
+
+	while True:
+		command = TransferData(block.tolist())
+		try:
+			ecu.bus.execute(command)
+			return
+		except GKBusTimeoutException:
+			attempt += 1
+			logger.warning('Timeout at Block %s! Trying again... (%s/%s)', index, attempt, transfer_retries)
+			if (attempt >= transfer_retries):
+				raise TransferDataException('Block {} timed out {} times in a row'.format(index, attempt))
+		except KWPNegativeResponseException as e:
+			if ('0x78' in str(e)): # request received, response pending - the block must not be sent twice
+				logger.info('ECU busy at Block %s, waiting for the response. %s', index, e)
+				stall_started = time.time()
+				try:
+					await_pending_response(ecu.bus, command, index, deadline)
+				except GKBusTimeoutException:
+					raise TransferDataException('Block {} received, but the ECU never responded'.format(index))
+				finally:
+					stats.stall_time += time.time()-stall_started
+				return
+			# 0x21 busy - repeat request
+			if ('0x21' not in str(e)) or (time.time() >= deadline):
+				raise TransferDataException('Block {} rejected: {}'.format(index, e))
+			logger.info('ECU busy at Block %s, repeating. %s', index, e)
+
+		stall_started = time.time()
+		time.sleep(max(0, min(backoff, deadline-time.time())))
+		backoff = min(backoff*2, max_transfer_backoff)
+		stats.retries += 1
+		stats.stall_time += time.time()-stall_started
+
+def write_memory(ecu, payload, flash_start, flash_size, progress_callback=False, block_size=max_block_size, stats=None) -> TransferStats:
+	response = ecu.bus.execute(RequestDownload(offset=flash_start, size=flash_size, compression_type=CompressionType.UNCOMPRESSED, encryption_type=EncryptionType.UNENCRYPTED)).get_data()
+	block_size = negotiate_block_size(response, block_size)
+
+	payload = memoryview(bytes(payload))[:flash_size]
+	blocks = ceil(flash_size/block_size)
+	if (stats == None):
+		stats = TransferStats()
+
+	for index in range(blocks):
+		block = payload[index*block_size:(index+1)*block_size]
+
+		if (progress_callback):
+			progress_callback.title('Block {}/{}, {:.0f} B/s'.format(index+1, blocks, stats.throughput()))
+
+		block_started = time.time()
+		transfer_block(ecu, block, index, stats)
+		stats.block_times.append(time.time()-block_started)
+		stats.blocks_sent += 1
+		stats.bytes_sent += len(block)
+
+		if (progress_callback):
+			progress_callback(len(block))
 
 	ecu.bus.execute(RequestTransferExit())
+	stats.finished = time.time()
+	return stats
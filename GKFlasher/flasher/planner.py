@@ -0,0 +1,115 @@
+from flasher.cache import load_cache, update_cache
+
+# biggest ReadMemoryByAddress request, size is a single byte and the response has to fit in a KWP frame
+max_block_size = 254
+
+class RegionMap:
+	'''
+	Per ECU type map of addresses a single ReadMemoryByAddress request can't cross 
+	(EEPROM page switches) and ranges that can't be read at all (restricted areas).
+	Both are learnt at runtime from negative response 0x52 and persisted, so later dumps 
+	plan their requests around them instead of falling back to 1 byte reads every time.
+	A restricted range is skipped for the rest of the session it was found in, but only 
+	persisted once a later attempt (another dump, or another ECU of the type) finds it again - 
+	a single 0x52 may as well be a glitch, and a range skipped for good is never read again
+	'''
+	def __init__ (self, ecu_name: str, boundaries: list = None, restricted: list = None, suspected: list = None):
+		self.ecu_name = ecu_name
+		self.boundaries = sorted(boundaries) if boundaries else []
+		self.restricted = sorted(restricted) if restricted else [] # confirmed
+		self.suspected = sorted(suspected) if suspected else [] # found once, still read
+		self.found = [] # found in this session and not confirmed yet
+		self._unsaved_found = []
+		self.version, self._saved_version = 0, 0
+
+	@classmethod
+	def load (cls, ecu_name: str):
+		return cls.from_entry(ecu_name, load_cache('region_maps').get(ecu_name, {}))
+
+	@classmethod
+	def from_entry (cls, ecu_name: str, entry: dict):
+		return cls(ecu_name, entry.get('boundaries'), entry.get('restricted'), entry.get('suspected'))
+
+	def to_entry (self) -> dict:
+		return {'boundaries': self.boundaries, 'restricted': self.restricted, 'suspected': self.suspected}
+
+	def save (self) -> None:
+		if (self.version == self._saved_version):
+			return
+
+		def merge (region_maps: dict) -> None:
+			# another worker may have found the same ranges in the meantime - that confirms them
+			stored = RegionMap.from_entry(self.ecu_name, region_maps.get(self.ecu_name, {}))
+			for address in self.boundaries:
+				stored.add_boundary(address)
+			for start, stop in self.restricted:
+				stored._confirm(start, stop)
+			for start, stop in self._unsaved_found:
+				stored.add_restricted(start, stop)
+			region_maps[self.ecu_name] = stored.to_entry()
+
+		update_cache('region_maps', merge)
+		self._saved_version, self._unsaved_found = self.version, []
+
+	def add_boundary (self, address: int) -> None:
+		if address in self.boundaries:
+			return
+		self.boundaries = sorted(self.boundaries + [address])
+		self.version += 1
+
+	def _confirm (self, start: int, stop: int) -> None:
+		self.restricted = merge_ranges(self.restricted, start, stop)
+		self.suspected = [[suspected_start, suspected_stop] for suspected_start, suspected_stop in self.suspected if not (start < suspected_stop and suspected_start < stop)]
+
+	def add_restricted (self, start: int, stop: int) -> None:
+		if any(start < suspected_stop and suspected_start < stop for suspected_start, suspected_stop in self.suspected):
+			self._confirm(start, stop)
+		else:
+			self.found = merge_ranges(self.found, start, stop)
+			self.suspected = merge_ranges(self.suspected, start, stop)
+			self._unsaved_found.append([start, stop])
+		self.version += 1
+
+	def skipped (self) -> list:
+		'''
+		:return: ranges plans don't read - confirmed ones and those found in this session
+		'''
+		return sorted(self.restricted + self.found)
+
+def merge_ranges (ranges: list, start: int, stop: int) -> list:
+	merged = []
+	for range_start, range_stop in sorted(ranges + [[start, stop]]):
+		if merged and range_start <= merged[-1][1]:
+			merged[-1][1] = max(merged[-1][1], range_stop)
+		else:
+			merged.append([range_start, range_stop])
+	return merged
+
+def plan_reads (address_start: int, address_stop: int, region_map: RegionMap = None, block_size: int = max_block_size) -> list[tuple[int, int, bool]]:
+	'''
+	Split address_start - address_stop into ReadMemoryByAddress requests that never 
+	cross a known page boundary. Restricted ranges come back as a single entry with 
+	readable set to False - the caller is supposed to skip them
+
+	:return: list of (address, size, readable)
+	'''
+	boundaries, restricted = [], []
+	if region_map:
+		boundaries = [x for x in region_map.boundaries if address_start < x < address_stop]
+		restricted = [(max(start, address_start), min(stop, address_stop)) for start, stop in region_map.skipped() if start < address_stop and stop > address_start]
+
+	cuts = {address_start, address_stop, *boundaries}
+	for start, stop in restricted:
+		cuts.update((start, stop))
+	cuts = sorted(cuts)
+
+	plan = []
+	for segment_start, segment_stop in zip(cuts, cuts[1:]):
+		if any(start <= segment_start and segment_stop <= stop for start, stop in restricted):
+			plan.append((segment_start, segment_stop-segment_start, False))
+			continue
+
+		for address in range(segment_start, segment_stop, block_size):
+			plan.append((address, min(block_size, segment_stop-address), True))
+
+	return plan
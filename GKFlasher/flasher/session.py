@@ -0,0 +1,237 @@
+import gkbus, time
+from gkbus import kwp
+from ecu_definitions import BAUDRATES, ECU_IDENTIFICATION_TABLE
+from flasher.ecu import enable_security_access
+from flasher.planner import max_block_size
+from flasher.cache import load_cache, update_cache
+from flasher.timing import TimingParameters, tune_timing, read_benchmark, default_inter_request_delay
+
+def initialize_bus (protocol, protocol_config):
+	protocol_config = dict(protocol_config)
+	interface = protocol_config['interface']
+	del protocol_config['interface']
+
+	return gkbus.Bus(protocol, interface=interface, **protocol_config)
+
+def start_session (bus, desired_baudrate=None, log=print, adapter=None):
+	'''
+	:param desired_baudrate: identifier from BAUDRATES, None to stay at the bus baudrate 
+		or 'auto' to negotiate the fastest stable one (K-line only, see negotiate_baudrate)
+	:param adapter: interface the bus was initialized with, auto baudrates are remembered per adapter
+	:return: identifier of the baudrate in use, None if it wasn't switched
+	'''
+	try:
+		bus.execute(kwp.commands.StopDiagnosticSession())
+		bus.execute(kwp.commands.StopCommunication())
+	except (kwp.KWPNegativeResponseException, gkbus.GKBusTimeoutException):
+		pass
+
+	bus.init(kwp.commands.StartCommunication(), keepalive_payload=kwp.commands.TesterPresent(kwp.enums.ResponseType.REQUIRED), keepalive_timeout=1.5)
+
+	if desired_baudrate == 'auto':
+		desired_baudrate = negotiate_baudrate(bus, adapter, log)
+	elif desired_baudrate:
+		log('[*] Trying to start diagnostic session with baudrate {}'.format(BAUDRATES[desired_baudrate]))
+		bus.execute(kwp.commands.StartDiagnosticSession(kwp.enums.DiagnosticSession.FLASH_REPROGRAMMING, desired_baudrate))
+		bus.socket.socket.baudrate = BAUDRATES[desired_baudrate]
+	else:
+		log('[*] Trying to start diagnostic session')
+		bus.execute(kwp.commands.StartDiagnosticSession(kwp.enums.DiagnosticSession.FLASH_REPROGRAMMING))
+	bus.set_timeout(12)
+	return desired_baudrate
+
+# ReadMemoryByAddress requests of the link probe, all of them have to come back 
+# identical and in time for a baudrate to be considered stable
+probe_rounds = 4
+probe_max_error_rate = 0
+probe_max_latency = 0.5 # seconds per request
+# seconds without a request after which the ECU drops the session and falls back to its initial baudrate (P3max)
+session_timeout = 5.5
+
+def find_probe_block (bus) -> tuple:
+	'''
+	Find a block to probe the link with - identification block of the connected ECU, 
+	extended to a full request if it can be read that far
+
+	:return: (ECU name or None if unidentified, offset, size)
+	'''
+	found = None
+	for ecu_identifier in ECU_IDENTIFICATION_TABLE:
+		size = len(ecu_identifier['expected'][0])
+		try:
+			result = bus.execute(kwp.commands.ReadMemoryByAddress(offset=ecu_identifier['offset'], size=size)).get_data()
+		except kwp.KWPNegativeResponseException:
+			continue
+
+		if result in ecu_identifier['expected']:
+			found = (ecu_identifier['ecu']['name'], ecu_identifier['offset'], size)
+			break
+		if (found == None):
+			found = (None, ecu_identifier['offset'], size)
+
+	if (found == None):
+		raise kwp.KWPNegativeResponseException('None of the identification blocks can be read')
+
+	name, offset, size = found
+	try:
+		bus.execute(kwp.commands.ReadMemoryByAddress(offset=offset, size=max_block_size))
+		return name, offset, max_block_size
+	except kwp.KWPNegativeResponseException:
+		return name, offset, size
+
+def probe_link (bus) -> dict:
+	'''
+	Read the same block probe_rounds times and measure how many requests fail 
+	or come back different, and how long they take
+
+	:return: {'ecu', 'error_rate', 'latency' (seconds, None if nothing came back), 'stable'}
+	'''
+	enable_security_access(bus)
+	ecu_name, offset, size = find_probe_block(bus)
+
+	reference, errors, latencies = None, 0, []
+	for _ in range(probe_rounds):
+		started = time.time()
+		try:
+			data = bus.execute(kwp.commands.ReadMemoryByAddress(offset=offset, size=size)).get_data()
+		except (kwp.KWPNegativeResponseException, gkbus.GKBusTimeoutException):
+			errors += 1
+			continue
+		latencies.append(time.time()-started)
+
+		if (reference == None):
+			reference = data
+		elif (data != reference):
+			errors += 1
+
+	error_rate = errors/probe_rounds
+	latency = sum(latencies)/len(latencies) if latencies else None
+	return {
+		'ecu': ecu_name,
+		'error_rate': error_rate,
+		'latency': latency,
+		'stable': error_rate <= probe_max_error_rate and latency != None and latency <= probe_max_latency
+	}
+
+def recover_session (bus, baudrate: int) -> None:
+	# let the ECU drop the failed session, it falls back to the initial baudrate on its own
+	try:
+		bus.execute(kwp.commands.StopCommunication())
+	except (kwp.KWPNegativeResponseException, gkbus.GKBusTimeoutException):
+		pass
+	bus.socket.socket.baudrate = baudrate
+	time.sleep(session_timeout)
+	bus.init(kwp.commands.StartCommunication(), keepalive_payload=kwp.commands.TesterPresent(kwp.enums.ResponseType.REQUIRED), keepalive_timeout=1.5)
+
+def negotiate_baudrate (bus, adapter=None, log=print):
+	'''
+	Start the diagnostic session with every baudrate of BAUDRATES, fastest first, 
+	and keep the first one passing the link probe. The result is remembered per adapter 
+	and ECU, the next connection tries it before anything else
+
+	:return: identifier of the negotiated baudrate, None if only the initial one works
+	'''
+	try:
+		initial_baudrate = bus.socket.socket.baudrate
+	except AttributeError:
+		log('[!] Baudrate negotiation is only supported on K-line')
+		bus.execute(kwp.commands.StartDiagnosticSession(kwp.enums.DiagnosticSession.FLASH_REPROGRAMMING))
+		return None
+
+	known = load_cache('baudrates').get(adapter or '', {'last': None, 'ecus': {}})
+	remembered = known['ecus'].get(known['last'] or '', {}).get('identifier')
+
+	candidates = sorted([x for x in BAUDRATES if BAUDRATES[x] > initial_baudrate], key=lambda x: BAUDRATES[x], reverse=True)
+	if remembered in candidates:
+		candidates.remove(remembered)
+		candidates.insert(0, remembered)
+		log('[*] Last working baudrate with this adapter: {}'.format(BAUDRATES[remembered]))
+
+	for identifier in candidates:
+		log('[*] Trying to start diagnostic session with baudrate {}'.format(BAUDRATES[identifier]))
+		try:
+			bus.execute(kwp.commands.StartDiagnosticSession(kwp.enums.DiagnosticSession.FLASH_REPROGRAMMING, identifier))
+		except kwp.KWPNegativeResponseException as e:
+			log('[!] Rejected by the ECU: {}'.format(e)) # still at the initial baudrate
+			continue
+		except gkbus.GKBusTimeoutException:
+			pass # might have switched anyway, the probe will tell
+
+		bus.socket.socket.baudrate = BAUDRATES[identifier]
+		try:
+			probe = probe_link(bus)
+		except (kwp.KWPNegativeResponseException, gkbus.GKBusTimeoutException) as e:
+			probe = {'ecu': None, 'error_rate': 1, 'latency': None, 'stable': False}
+			log('[!] No response: {}'.format(e))
+
+		if (probe['stable']):
+			log('[*] Baudrate {} is stable, {:.0f}ms per request'.format(BAUDRATES[identifier], probe['latency']*1000))
+			ecu_name = probe['ecu'] or 'unknown'
+			known['last'] = ecu_name
+			known['ecus'][ecu_name] = {'identifier': identifier, 'error_rate': probe['error_rate'], 'latency': round(probe['latency'], 4)}
+			update_cache('baudrates', lambda baudrates: baudrates.update({adapter or '': known}))
+			return identifier
+
+		log('[!] Baudrate {} is unstable ({:.0%} errors), falling back'.format(BAUDRATES[identifier], probe['error_rate']))
+		if (identifier == remembered):
+			del known['ecus'][known['last']]
+			update_cache('baudrates', lambda baudrates: baudrates.update({adapter or '': known}))
+		recover_session(bus, initial_baudrate)
+
+	log('[!] No faster baudrate is stable, staying at {}'.format(initial_baudrate))
+	bus.execute(kwp.commands.StartDiagnosticSession(kwp.enums.DiagnosticSession.FLASH_REPROGRAMMING))
+	return None
+
+def tune_timing_parameters (bus, log=print):
+	'''
+	Find the fastest reliable timing parameters with flasher.timing.tune_timing, 
+	benchmarking with reads of the identification block. Needs security access. 
+	Only buses whose socket can pace requests itself (set_inter_request_delay, like the bridge's 
+	KLineHardware) gain anything - with the gkbus GKFlasher uses, the limits are applied as they are
+
+	:return: TimingResult, None if the ECU doesn't support AccessTimingParameters
+	'''
+	log('[*] Tuning timing parameters')
+	try:
+		ecu_name, offset, size = find_probe_block(bus)
+	except kwp.KWPNegativeResponseException:
+		log('[!] Nothing to benchmark with')
+		return set_timing_parameters(bus, log)
+
+	try:
+		result = tune_timing(
+			read_limits=lambda: TimingParameters.from_response(bus.execute(kwp.commands.AccessTimingParameters(kwp.enums.TimingParameterIdentifier.READ_LIMITS_OF_POSSIBLE_TIMING_PARAMETERS)).get_data()[1:]),
+			apply=lambda parameters: bus.execute(kwp.commands.AccessTimingParameters(kwp.enums.TimingParameterIdentifier.SET_TIMING_PARAMETERS_TO_GIVEN_VALUES, *parameters.to_list())),
+			benchmark=lambda: read_benchmark(lambda address, size: bus.execute(kwp.commands.ReadMemoryByAddress(offset=address, size=size)).get_data(), offset, size, errors=(kwp.KWPNegativeResponseException, gkbus.GKBusTimeoutException)),
+			set_inter_request_delay=getattr(bus.socket, 'set_inter_request_delay', None),
+			inter_request_delay=getattr(bus.socket, 'inter_request_delay', default_inter_request_delay/1000),
+			errors=(kwp.KWPNegativeResponseException, gkbus.GKBusTimeoutException),
+			log=log
+		)
+	except kwp.KWPNegativeResponseException:
+		log('[!] Not supported on this ECU!')
+		return None
+
+	log('[*] Timing parameters: {}'.format(result))
+	return result
+
+def set_timing_parameters (bus, log=print, tune=False):
+	if (tune):
+		return tune_timing_parameters(bus, log)
+
+	log('[*] Set timing parameters to maximum')
+	try:
+		available_timing = bus.execute(
+			kwp.commands.AccessTimingParameters(
+				kwp.enums.TimingParameterIdentifier.READ_LIMITS_OF_POSSIBLE_TIMING_PARAMETERS
+			)
+		).get_data()
+
+		bus.execute(
+			kwp.commands.AccessTimingParameters(
+				kwp.enums.TimingParameterIdentifier.SET_TIMING_PARAMETERS_TO_GIVEN_VALUES,
+				*available_timing[1:]
+			)
+		)
+	except kwp.KWPNegativeResponseException:
+		log('[!] Not supported on this ECU!')
@@ -0,0 +1,271 @@
+import json, os, queue, time, traceback, yaml
+import multiprocessing
+from datetime import datetime
+from gkbus import kwp
+from ecu_definitions import Routine
+from flasher.session import initialize_bus, start_session, set_timing_parameters
+from flasher.ecu import enable_security_access, identify_ecu
+from flasher.memory import read_memory
+from flasher.verify import verify_section, bytes_to_verify
+from flasher.journal import DumpJournal
+from flasher.flashplan import plan_flash, write_section, remember_dump
+
+read_actions = ['read', 'read_calibration', 'read_program']
+flash_actions = ['flash', 'flash_calibration', 'flash_program']
+
+# seconds between two aggregated status lines
+status_interval = 2
+
+class StationException (Exception):
+	pass
+
+def load_jobs (filename: str) -> list[dict]:
+	'''
+	Load a station job list. Every job needs an interface, an action
+	(read, read_calibration, read_program, flash, flash_calibration, flash_program) and a file.
+	protocol, desired_baudrate, read_mode, timing (tune or max), full_flash, skip_erased_gaps and verify (full or quick) are optional
+	'''
+	with open(filename) as file:
+		jobs = (yaml.safe_load(file) or {}).get('jobs') or []
+
+	for index, job in enumerate(jobs):
+		for key in ['interface', 'action', 'file']:
+			if key not in job:
+				raise StationException('Job {} is missing "{}"'.format(index, key))
+		if job['action'] not in read_actions+flash_actions:
+			raise StationException('Job {} has an unknown action "{}"'.format(index, job['action']))
+		if (job['action'] in flash_actions and not os.path.exists(job['file'])):
+			raise StationException('Job {}: {} doesn\'t exist'.format(index, job['file']))
+
+	return jobs
+
+class QueueProgress:
+	'''
+	Progress callback (same interface as alive_bar) forwarding to the station's queue
+	'''
+	def __init__ (self, events, interface: str, total: int):
+		self.events, self.interface = events, interface
+		self.done, self.total = 0, total
+		self.last_sent = 0
+		self.events.put(('progress', interface, 0, total))
+
+	def __call__ (self, value: int):
+		self.done += value
+		if (time.time()-self.last_sent >= 0.5 or self.done >= self.total):
+			self.events.put(('progress', self.interface, self.done, self.total))
+			self.last_sent = time.time()
+
+	def title (self, title: str):
+		pass
+
+def station_read (ecu, job, events, log) -> int:
+	eeprom_size = ecu.get_eeprom_size_bytes()
+	if (job['action'] == 'read_calibration'):
+		address_start = 0x090000
+		address_stop = address_start+ecu.get_calibration_size_bytes()
+	elif (job['action'] == 'read_program'):
+		address_start = ecu.get_program_section_offset()
+		address_stop = address_start+ecu.get_program_section_size()
+	else:
+		address_start = abs(ecu.bin_offset)
+		address_stop = address_start+eeprom_size
+
+	try:
+		calibration = ecu.get_calibration()
+	except kwp.KWPNegativeResponseException:
+		calibration = None
+
+	log('[*] Reading from {} to {}'.format(hex(address_start), hex(address_stop)))
+	journal = DumpJournal.create(job['file'], ecu, calibration, eeprom_size, address_start, address_stop)
+	read_memory(ecu, address_start=address_start, address_stop=address_stop, progress_callback=QueueProgress(events, job['interface'], address_stop-address_start), page_callback=journal.write, read_mode=job.get('read_mode', 'auto'))
+	journal.finalize()
+
+	with open(job['file'], 'rb') as file:
+		remember_dump(ecu, calibration, file.read(), address_start, address_stop)
+
+	log('[*] saved to {}'.format(job['file']))
+	return address_stop-address_start
+
+def station_flash (ecu, job, events, log) -> int:
+	with open(job['file'], 'rb') as file:
+		eeprom = file.read()
+
+	plan = plan_flash(ecu, eeprom,
+		flash_calibration=job['action'] in ['flash', 'flash_calibration'],
+		flash_program=job['action'] in ['flash', 'flash_program'],
+		diff=not job.get('full_flash', False),
+		skip_gaps=job.get('skip_erased_gaps', False)
+	)
+	for line in plan.summary():
+		log('[*] {}'.format(line))
+
+	if not plan.to_send():
+		return 0
+
+	progress = QueueProgress(events, job['interface'], plan.bytes_to_send())
+	for section in plan.to_send():
+		log('[*] start routine {} (erase {} section)'.format(hex(section.routine.value), section.description))
+		stats = write_section(ecu, section, progress_callback=progress)
+		log('[*] Sent {}'.format(stats))
+
+	ecu.bus.set_timeout(300)
+	log('[*] start routine 0x02 (verify blocks and mark as ready to execute)')
+	ecu.bus.execute(kwp.commands.StartRoutineByLocalIdentifier(Routine.VERIFY_BLOCKS.value)).get_data()
+	ecu.bus.set_timeout(12)
+
+	if (job.get('verify')):
+		quick = job['verify'] == 'quick'
+		for section in plan.to_send():
+			log('[*] Reading back {} section'.format(section.description))
+			result = verify_section(ecu, section, quick=quick, progress_callback=QueueProgress(events, job['interface'], bytes_to_verify(ecu, section, quick)))
+			if not result.ok():
+				raise StationException('Verification of {} section failed: {}'.format(section.description, result))
+			log('[*] Verified: {}'.format(result))
+	plan.remember()
+
+	log('[*] ecu reset')
+	ecu.bus.execute(kwp.commands.ECUReset(kwp.enums.ResetMode.POWER_ON_RESET)).get_data()
+	return plan.bytes_to_send()
+
+def run_job (config, job, events) -> dict:
+	interface = job['interface']
+	log = lambda message: events.put(('log', interface, message))
+	result = {'interface': interface, 'action': job['action'], 'file': job['file'], 'ecu': None, 'calibration': None, 'bytes': 0}
+
+	protocol = job.get('protocol', config['protocol'])
+	protocol_config = dict(config[protocol], interface=interface)
+	started = time.time()
+
+	bus = initialize_bus(protocol, protocol_config)
+	try:
+		start_session(bus, job.get('desired_baudrate'), log=log, adapter=interface)
+		enable_security_access(bus)
+		set_timing_parameters(bus, log=log, tune=job.get('timing') == 'tune')
+
+		ecu = identify_ecu(bus)
+		result['ecu'] = ecu.get_name()
+		try:
+			result['calibration'] = ecu.get_calibration()
+		except kwp.KWPNegativeResponseException:
+			pass
+		log('[*] Found! {}, calibration: {}'.format(result['ecu'], result['calibration']))
+
+		if job['action'] in read_actions:
+			result['bytes'] = station_read(ecu, job, events, log)
+		else:
+			result['bytes'] = station_flash(ecu, job, events, log)
+
+		try:
+			bus.execute(kwp.commands.StopCommunication())
+		except Exception:
+			pass
+	finally:
+		bus.shutdown()
+
+	result['elapsed'] = time.time()-started
+	result['throughput'] = result['bytes']/result['elapsed'] if result['elapsed'] > 0 else 0
+	return result
+
+def station_worker (config, jobs, events) -> None:
+	'''
+	Runs all jobs of a single adapter, one after another. A failing job
+	is reported and the worker moves on to the next one
+	'''
+	for index, job in jobs:
+		events.put(('start', job['interface'], index, job['action']))
+		try:
+			result = run_job(config, job, events)
+			result['status'] = 'ok'
+		except Exception as e:
+			events.put(('log', job['interface'], '[!] {}'.format(traceback.format_exc().strip())))
+			result = {'interface': job['interface'], 'action': job['action'], 'file': job['file'], 'status': 'failed', 'error': repr(e)}
+		events.put(('result', job['interface'], index, result))
+
+def format_status (state: dict) -> str:
+	parts = []
+	for interface, status in state.items():
+		if (status['total']):
+			elapsed = time.time()-status['started']
+			throughput = status['done']/elapsed if elapsed > 0 else 0
+			parts.append('{} {} {:.0f}% {:.0f} B/s'.format(interface, status['action'], status['done']*100/status['total'], throughput))
+		else:
+			parts.append('{} {}'.format(interface, status['action']))
+	return ' | '.join(parts)
+
+def run_station (config, jobs: list[dict], report_filename: str = None) -> dict:
+	'''
+	Run the job list with one worker process per adapter, print aggregated progress
+	and write a JSON summary report
+	'''
+	by_interface = {}
+	for index, job in enumerate(jobs):
+		by_interface.setdefault(job['interface'], []).append((index, job))
+
+	events = multiprocessing.Queue()
+	workers = {}
+	for interface, interface_jobs in by_interface.items():
+		workers[interface] = multiprocessing.Process(target=station_worker, args=(config, interface_jobs, events), daemon=True)
+
+	started = time.time()
+	for worker in workers.values():
+		worker.start()
+	print('[*] Station started: {} jobs on {} adapters'.format(len(jobs), len(workers)))
+
+	results = [None]*len(jobs)
+	state = {}
+	last_status = time.time()
+
+	while (None in results):
+		try:
+			event = events.get(timeout=0.5)
+		except queue.Empty:
+			event = None
+
+		if (event):
+			kind, interface = event[0], event[1]
+			if (kind == 'start'):
+				state[interface] = {'action': event[3], 'done': 0, 'total': 0, 'started': time.time()}
+			elif (kind == 'progress'):
+				state[interface].update(done=event[2], total=event[3])
+			elif (kind == 'log'):
+				print('[{}] {}'.format(interface, event[2]))
+			elif (kind == 'result'):
+				results[event[2]] = event[3]
+				state.pop(interface, None)
+				print('[{}] {} {}: {}'.format(interface, event[3]['action'], event[3]['file'], event[3]['status']))
+
+		if (state and time.time()-last_status >= status_interval):
+			print('[*] {}'.format(format_status(state)))
+			last_status = time.time()
+
+		# a worker that died without reporting (segfault, killed) takes only its own jobs down
+		for interface, worker in workers.items():
+			if (not worker.is_alive() and events.empty()):
+				for index, job in by_interface[interface]:
+					if (results[index] == None):
+						results[index] = {'interface': interface, 'action': job['action'], 'file': job['file'], 'status': 'failed', 'error': 'worker exited with code {}'.format(worker.exitcode)}
+
+	for worker in workers.values():
+		worker.join()
+
+	elapsed = time.time()-started
+	total_bytes = sum([result.get('bytes', 0) for result in results if result['status'] == 'ok'])
+	report = {
+		'started': datetime.fromtimestamp(started).isoformat(),
+		'elapsed': elapsed,
+		'jobs': len(results),
+		'succeeded': len([result for result in results if result['status'] == 'ok']),
+		'failed': len([result for result in results if result['status'] != 'ok']),
+		'bytes': total_bytes,
+		'throughput': total_bytes/elapsed if elapsed > 0 else 0,
+		'results': results
+	}
+
+	if (report_filename == None):
+		report_filename = 'station_report_{}.json'.format(datetime.now().strftime('%Y-%m-%d_%H%M'))
+	with open(report_filename, 'w') as file:
+		json.dump(report, file, indent='\t')
+
+	print('[*] Station done in {:.0f}s: {} succeeded, {} failed, {:.0f} B/s combined'.format(elapsed, report['succeeded'], report['failed'], report['throughput']))
+	print('[*] Report saved to {}'.format(report_filename))
+	return report
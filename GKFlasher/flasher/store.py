@@ -0,0 +1,216 @@
+import hashlib, os, re, sqlite3, time, zlib
+from datetime import datetime
+from flasher.cache import cache_directory
+from flasher.checksum import split_regions
+
+default_store_directory = os.path.join(cache_directory, 'store')
+# regions are split further into chunks of this size, so a single changed map doesn't make the whole region unique
+chunk_size = 0x4000
+
+# description_calibration_hwrevc_hwrevd_date.bin, as named by generate_dump_filename
+dump_filename_pattern = re.compile(r'^(?P<description>.*)_(?P<calibration>[^_]*)_(?P<hw_rev_c>[^_]*)_(?P<hw_rev_d>[^_]*)_(?P<date>\d{4}-\d{2}-\d{2}_\d{4})\.bin$')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS dumps (
+	id INTEGER PRIMARY KEY,
+	sha256 TEXT UNIQUE NOT NULL,
+	filename TEXT,
+	size INTEGER NOT NULL,
+	layout TEXT,
+	description TEXT,
+	calibration TEXT,
+	hw_rev_c TEXT,
+	hw_rev_d TEXT,
+	vin TEXT,
+	date TEXT,
+	added TEXT
+);
+CREATE TABLE IF NOT EXISTS chunks (
+	sha256 TEXT PRIMARY KEY,
+	size INTEGER NOT NULL,
+	stored_size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dump_chunks (
+	dump_id INTEGER NOT NULL REFERENCES dumps(id),
+	offset INTEGER NOT NULL,
+	region TEXT,
+	chunk TEXT NOT NULL REFERENCES chunks(sha256),
+	PRIMARY KEY (dump_id, offset)
+);
+CREATE INDEX IF NOT EXISTS dumps_calibration ON dumps(calibration);
+CREATE INDEX IF NOT EXISTS dumps_vin ON dumps(vin);
+CREATE INDEX IF NOT EXISTS dumps_hw_rev ON dumps(hw_rev_c, hw_rev_d);
+CREATE INDEX IF NOT EXISTS dump_chunks_chunk ON dump_chunks(chunk);
+'''
+
+class DumpStoreException (Exception):
+	pass
+
+def split_chunks (payload: bytes) -> tuple[str, list[tuple[int, str, bytes]]]:
+	'''
+	:return: layout name, list of (offset, region name, chunk)
+	'''
+	layout, regions = split_regions(payload)
+	chunks = []
+	for start, stop, name in regions:
+		for offset in range(start, stop, chunk_size):
+			chunks.append((offset, name, payload[offset:min(offset+chunk_size, stop)]))
+	return layout, chunks
+
+def parse_dump_filename (filename: str) -> dict:
+	match = dump_filename_pattern.match(os.path.basename(filename))
+	if not match:
+		return {}
+	metadata = match.groupdict()
+	metadata['date'] = datetime.strptime(metadata['date'], '%Y-%m-%d_%H%M').isoformat()
+	return metadata
+
+def read_calibration (payload: bytes, regions: list) -> str:
+	for start, stop, name in regions:
+		if (name == 'Calibration'):
+			calibration = payload[start:start+8]
+			if calibration.isalnum():
+				return calibration.decode('ascii')
+	return None
+
+class DumpStore:
+	'''
+	Content addressed store of EEPROM dumps. Dumps are split into region aligned
+	chunks, every unique chunk is kept once (zlib compressed, named by its sha256)
+	and a SQLite index maps dumps and their metadata to chunks
+	'''
+	def __init__ (self, directory: str = default_store_directory):
+		self.directory = directory
+		os.makedirs(os.path.join(directory, 'chunks'), exist_ok=True)
+		self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'))
+		self.db.row_factory = sqlite3.Row
+		self.db.executescript(schema)
+
+	def close (self) -> None:
+		self.db.close()
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *args):
+		self.close()
+
+	def chunk_filename (self, digest: str) -> str:
+		return os.path.join(self.directory, 'chunks', digest[:2], digest)
+
+	def put_chunk (self, data: bytes) -> str:
+		digest = hashlib.sha256(data).hexdigest()
+		if self.db.execute('SELECT 1 FROM chunks WHERE sha256 = ?', (digest,)).fetchone():
+			return digest
+
+		compressed = zlib.compress(data, 9)
+		filename = self.chunk_filename(digest)
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		with open(filename + '.tmp', 'wb') as file:
+			file.write(compressed)
+		os.replace(filename + '.tmp', filename)
+
+		self.db.execute('INSERT INTO chunks (sha256, size, stored_size) VALUES (?, ?, ?)', (digest, len(data), len(compressed)))
+		return digest
+
+	def get_chunk (self, digest: str) -> bytes:
+		with open(self.chunk_filename(digest), 'rb') as file:
+			data = zlib.decompress(file.read())
+		if (hashlib.sha256(data).hexdigest() != digest):
+			raise DumpStoreException('Chunk {} is corrupted'.format(digest))
+		return data
+
+	def add (self, filename: str, vin: str = None) -> tuple[int, bool]:
+		'''
+		:return: dump id, True if the dump wasn't in the store yet
+		'''
+		with open(filename, 'rb') as file:
+			payload = file.read()
+
+		digest = hashlib.sha256(payload).hexdigest()
+		existing = self.db.execute('SELECT id FROM dumps WHERE sha256 = ?', (digest,)).fetchone()
+		if existing:
+			return existing['id'], False
+
+		layout, chunks = split_chunks(payload)
+		metadata = parse_dump_filename(filename)
+		calibration = read_calibration(payload, split_regions(payload)[1]) or metadata.get('calibration')
+
+		with self.db:
+			cursor = self.db.execute(
+				'INSERT INTO dumps (sha256, filename, size, layout, description, calibration, hw_rev_c, hw_rev_d, vin, date, added) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+				(digest, os.path.basename(filename), len(payload), layout, metadata.get('description'), calibration, metadata.get('hw_rev_c'), metadata.get('hw_rev_d'), vin,
+				metadata.get('date') or datetime.fromtimestamp(os.path.getmtime(filename)).isoformat(), datetime.now().isoformat())
+			)
+			dump_id = cursor.lastrowid
+			for offset, region, data in chunks:
+				self.db.execute('INSERT INTO dump_chunks (dump_id, offset, region, chunk) VALUES (?, ?, ?, ?)', (dump_id, offset, region, self.put_chunk(data)))
+
+		return dump_id, True
+
+	def get (self, dump_id: int) -> bytes:
+		dump = self.db.execute('SELECT sha256 FROM dumps WHERE id = ?', (dump_id,)).fetchone()
+		if not dump:
+			raise DumpStoreException('No dump with id {}'.format(dump_id))
+
+		payload = b''.join([self.get_chunk(row['chunk']) for row in self.db.execute('SELECT chunk FROM dump_chunks WHERE dump_id = ? ORDER BY offset', (dump_id,))])
+		if (hashlib.sha256(payload).hexdigest() != dump['sha256']):
+			raise DumpStoreException('Dump {} doesn\'t match its hash'.format(dump_id))
+		return payload
+
+	def find (self, calibration: str = None, vin: str = None, hw_rev: str = None) -> list[dict]:
+		conditions, parameters = [], []
+		if (calibration != None):
+			conditions.append('calibration = ?')
+			parameters.append(calibration)
+		if (vin != None):
+			conditions.append('vin = ?')
+			parameters.append(vin)
+		if (hw_rev != None):
+			conditions.append('(hw_rev_c = ? OR hw_rev_d = ?)')
+			parameters += [hw_rev, hw_rev]
+
+		query = 'SELECT * FROM dumps'
+		if conditions:
+			query += ' WHERE ' + ' AND '.join(conditions)
+		return [dict(row) for row in self.db.execute(query + ' ORDER BY date', parameters)]
+
+	def stats (self) -> dict:
+		dumps, raw_size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM dumps').fetchone()
+		chunks, stored_size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(stored_size), 0) FROM chunks').fetchone()
+		return {'dumps': dumps, 'chunks': chunks, 'raw_size': raw_size, 'stored_size': stored_size}
+
+def dump_filenames (paths: list[str]) -> list[str]:
+	filenames = []
+	for path in paths:
+		if os.path.isdir(path):
+			for root, directories, files in os.walk(path):
+				filenames += [os.path.join(root, filename) for filename in sorted(files) if filename.lower().endswith('.bin')]
+		else:
+			filenames.append(path)
+	return filenames
+
+def cli_store (args) -> None:
+	with DumpStore(args.store_dir or default_store_directory) as store:
+		if (args.store_add):
+			for filename in dump_filenames(args.store_add):
+				started = time.time()
+				dump_id, added = store.add(filename, vin=args.vin)
+				print('[*] {} {} as #{} ({:.2f}s)'.format('Added' if added else 'Already stored', filename, dump_id, time.time()-started))
+
+		if (args.store_find != None):
+			dumps = store.find(calibration=args.store_find or None, vin=args.vin)
+			for dump in dumps:
+				print('    [{}] {} calibration: {}, hw: {} {}, vin: {}, date: {}, layout: {}'.format(
+					dump['id'], dump['filename'], dump['calibration'], dump['hw_rev_c'], dump['hw_rev_d'], dump['vin'], dump['date'], dump['layout']))
+			print('[*] {} dumps found'.format(len(dumps)))
+
+		if (args.store_get != None):
+			output_filename = args.output or 'store_{}.bin'.format(args.store_get)
+			with open(output_filename, 'wb') as file:
+				file.write(store.get(args.store_get))
+			print('[*] saved to {}'.format(output_filename))
+
+		stats = store.stats()
+		ratio = stats['raw_size']/stats['stored_size'] if stats['stored_size'] else 0
+		print('[*] Store: {} dumps, {} unique chunks, {} bytes of dumps in {} bytes ({:.1f}x)'.format(stats['dumps'], stats['chunks'], stats['raw_size'], stats['stored_size'], ratio))
@@ -0,0 +1,188 @@
+import math, time
+from dataclasses import dataclass, field
+
+# resolution of the AccessTimingParameters values (ISO 14230-2), in milliseconds
+p2min_resolution = 0.5
+p2max_resolution = 25
+p3min_resolution = 0.5
+p3max_resolution = 250
+p4min_resolution = 0.5
+
+# what the host waits between requests when the bus doesn't tell, in milliseconds
+default_inter_request_delay = 100
+# P3min below this isn't halved any further, the next step goes straight to the limit
+min_inter_request_delay = 1
+# P2max is kept at least this many times above the slowest response seen by the baseline benchmark
+p2max_latency_margin = 2
+# a shorter set has to be at least this much faster, in both of its benchmarks, to be worth the smaller margin
+min_step_gain = 0.02
+
+@dataclass
+class TimingParameters:
+	p2min: int
+	p2max: int
+	p3min: int
+	p3max: int
+	p4min: int
+
+	@classmethod
+	def from_response (cls, data):
+		'''
+		:param data: AccessTimingParameters response without the timing parameter identifier
+		'''
+		return cls(*list(data)[:5])
+
+	def to_list (self) -> list[int]:
+		return [self.p2min, self.p2max, self.p3min, self.p3max, self.p4min]
+
+	def p2max_ms (self) -> float:
+		return self.p2max*p2max_resolution
+
+	def p3min_ms (self) -> float:
+		return self.p3min*p3min_resolution
+
+	def __str__ (self) -> str:
+		return 'P2 {:g}-{:g}ms, P3 {:g}-{:g}ms, P4 {:g}ms'.format(
+			self.p2min*p2min_resolution, self.p2max_ms(), self.p3min_ms(), self.p3max*p3max_resolution, self.p4min*p4min_resolution)
+
+@dataclass
+class TimingBenchmark:
+	requests: int = 0
+	failures: int = 0
+	bytes_read: int = 0
+	seconds: float = 0
+	latencies: list = field(default_factory=list)
+
+	def failure_rate (self) -> float:
+		return self.failures/self.requests if self.requests else 1
+
+	def throughput (self) -> float:
+		return self.bytes_read/self.seconds if self.seconds > 0 else 0
+
+	def max_latency (self) -> float:
+		return max(self.latencies, default=0)
+
+	def __str__ (self) -> str:
+		return '{:.0f} B/s, {:.0%} failed, slowest response {:.0f}ms'.format(self.throughput(), self.failure_rate(), self.max_latency()*1000)
+
+@dataclass
+class TimingResult:
+	parameters: TimingParameters
+	inter_request_delay: float # seconds
+	benchmark: TimingBenchmark
+	baseline: TimingBenchmark
+
+	def gain (self) -> float:
+		'''
+		:return: expected throughput gain over the limits applied verbatim, 0.25 = 25% faster
+		'''
+		baseline = self.baseline.throughput()
+		return self.benchmark.throughput()/baseline-1 if baseline > 0 else 0
+
+	def __str__ (self) -> str:
+		return '{}, {:g}ms between requests, {} ({:+.0%})'.format(self.parameters, self.inter_request_delay*1000, self.benchmark, self.gain())
+
+def read_benchmark (read, address: int, size: int, rounds: int = 8, errors: tuple = (Exception,)) -> TimingBenchmark:
+	'''
+	Read the same block rounds times. Requests raising one of errors 
+	or coming back different than the first one count as failures
+
+	:param read: callable(address, size) returning the data
+	'''
+	benchmark = TimingBenchmark()
+	reference = None
+	started = time.perf_counter()
+
+	for _ in range(rounds):
+		benchmark.requests += 1
+		request_started = time.perf_counter()
+		try:
+			data = list(read(address, size))
+		except errors:
+			benchmark.failures += 1
+			continue
+		benchmark.latencies.append(time.perf_counter()-request_started)
+
+		if (reference == None):
+			reference = data
+		elif (data != reference):
+			benchmark.failures += 1
+			continue
+		benchmark.bytes_read += len(data)
+
+	benchmark.seconds = time.perf_counter()-started
+	return benchmark
+
+def timing_steps (limits: TimingParameters, max_latency: float, start_delay: float) -> list[TimingParameters]:
+	'''
+	Parameter sets from the applied delay between requests towards the limits: P3min and P2max 
+	halved every step, P3min down to its limit, P2max down to a margin above the slowest response
+
+	:param start_delay: delay between requests the host applies now, in milliseconds
+	'''
+	p3min_limit = limits.p3min_ms()
+	p2max_floor = min(max(1, math.ceil(max_latency*1000*p2max_latency_margin/p2max_resolution)), limits.p2max)
+
+	steps = []
+	delay, p2max = max(start_delay, p3min_limit), limits.p2max
+	while delay > p3min_limit:
+		delay = delay/2 if delay/2 >= max(p3min_limit, min_inter_request_delay) else p3min_limit
+		p2max = max(p2max//2, p2max_floor)
+		steps.append(TimingParameters(limits.p2min, p2max, min(round(delay/p3min_resolution), 0xFF), limits.p3max, limits.p4min))
+	return steps
+
+def tune_timing (read_limits, apply, benchmark, set_inter_request_delay=None, inter_request_delay: float = default_inter_request_delay/1000, errors: tuple = (Exception,), log=print) -> TimingResult:
+	'''
+	Instead of applying the limits of possible timing parameters as they are, step P3min 
+	(together with the host side delay between requests) and P2max down from what's applied 
+	towards them. Every set is measured with two short read benchmarks and only kept when 
+	both are faster than both of the best set so far - a single run is too noisy to tell.
+	Stepping stops at the first set the ECU rejects or a benchmark fails with. 
+	Without set_inter_request_delay the host keeps pacing requests as before, so there's nothing to gain
+
+	:param read_limits: callable returning the limits as TimingParameters
+	:param apply: callable(TimingParameters) setting them on the ECU
+	:param benchmark: callable returning a TimingBenchmark
+	:param set_inter_request_delay: callable(seconds) setting the host side delay, None if the bus can't
+	:param inter_request_delay: host side delay applied now, in seconds
+	:param errors: exceptions meaning a rejected set or a failed request
+	'''
+	def measure () -> list[TimingBenchmark]:
+		runs = [benchmark()]
+		if (not runs[0].failures):
+			runs.append(benchmark())
+		return sorted(runs, key=lambda run: run.throughput())
+
+	limits = read_limits()
+	apply(limits)
+	baseline = measure()
+	log('[*] Limits: {}, {}'.format(limits, baseline[0]))
+
+	best = TimingResult(limits, inter_request_delay, baseline[0], baseline[0])
+	best_runs = baseline
+	if (any(run.failures for run in baseline)):
+		return best
+	if (set_inter_request_delay == None):
+		log('[*] Requests are paced by the bus, keeping the limits')
+		return best
+
+	for parameters in timing_steps(limits, max(run.max_latency() for run in baseline), inter_request_delay*1000):
+		try:
+			apply(parameters)
+		except errors as e:
+			log('[!] {} rejected: {}'.format(parameters, e))
+			break
+
+		set_inter_request_delay(parameters.p3min_ms()/1000)
+		runs = measure()
+		log('[*] {}: {}'.format(parameters, runs[0]))
+		if (any(run.failures for run in runs)):
+			break
+
+		if (runs[0].throughput() > best_runs[-1].throughput()*(1+min_step_gain)):
+			best = TimingResult(parameters, parameters.p3min_ms()/1000, runs[0], baseline[0])
+			best_runs = runs
+
+	set_inter_request_delay(best.inter_request_delay)
+	apply(best.parameters)
+	return best
@@ -0,0 +1,104 @@
+import logging, queue, threading, time
+from dataclasses import dataclass
+from gkbus import GKBusTimeoutException
+from flasher.planner import plan_reads
+logger = logging.getLogger(__name__)
+
+# blocks read back in quick mode, spread evenly over the section (first and last included)
+quick_samples = 32
+read_retries = 3
+
+@dataclass
+class VerifyResult:
+	blocks_checked: int = 0
+	bytes_checked: int = 0
+	blocks_skipped: int = 0 # restricted, can't be read back
+	first_mismatch: int = None # address of the first block that differs
+	elapsed: float = 0
+
+	def ok (self) -> bool:
+		return self.first_mismatch == None
+
+	def __str__ (self) -> str:
+		if not self.ok():
+			return 'mismatch at block {} after {} matching blocks'.format(hex(self.first_mismatch), self.blocks_checked)
+		return '{} blocks ({} bytes) match, {} skipped, {:.1f}s'.format(self.blocks_checked, self.bytes_checked, self.blocks_skipped, self.elapsed)
+
+def sample_plan (plan: list, samples: int) -> list:
+	readable = [entry for entry in plan if entry[2]]
+	if (len(readable) <= samples):
+		return readable
+	return [readable[round(x*(len(readable)-1)/(samples-1))] for x in range(samples)]
+
+def plan_verify (ecu, section, quick: bool = False) -> tuple[list, int]:
+	plan = plan_reads(section.read_address, section.read_address+len(section.payload), ecu.get_region_map())
+	skipped = len([entry for entry in plan if not entry[2]])
+	if quick:
+		return sample_plan(plan, quick_samples), skipped
+	return [entry for entry in plan if entry[2]], skipped
+
+def read_block (ecu, address: int, size: int) -> bytes:
+	for attempt in range(read_retries):
+		try:
+			return bytes(ecu.read_memory_by_address(offset=address, size=size))
+		except GKBusTimeoutException:
+			logger.warning('Timeout at Offset %s! Trying again...', hex(address))
+	return bytes(ecu.read_memory_by_address(offset=address, size=size))
+
+def verify_section (ecu, section, quick: bool = False, progress_callback=False) -> VerifyResult:
+	'''
+	Read a just written section back and compare it block by block with the payload.
+	Blocks are hashed and compared on a separate thread while the next one is being
+	read, so verifying costs about as much as the raw read. Stops at the first mismatch
+
+	:param quick: only read back quick_samples blocks instead of the whole section
+	'''
+	address_start = section.read_address
+	plan, skipped = plan_verify(ecu, section, quick)
+	result = VerifyResult(blocks_skipped=skipped)
+
+	blocks = queue.Queue(maxsize=64)
+	mismatch = threading.Event()
+
+	def compare ():
+		while True:
+			block = blocks.get()
+			if (block == None):
+				return
+			address, fetched = block
+			if mismatch.is_set():
+				continue
+
+			offset = address-address_start
+			expected = section.payload[offset:offset+len(fetched)]
+			if (fetched != expected):
+				result.first_mismatch = address
+				mismatch.set()
+				continue
+
+			result.blocks_checked += 1
+			result.bytes_checked += len(fetched)
+
+	started = time.time()
+	comparer = threading.Thread(target=compare)
+	comparer.start()
+	try:
+		for index, (address, size, readable) in enumerate(plan):
+			if mismatch.is_set():
+				break
+			if (progress_callback):
+				progress_callback.title('Verifying block {}/{}'.format(index+1, len(plan)))
+
+			blocks.put((address, read_block(ecu, address, size)))
+
+			if (progress_callback):
+				progress_callback(size)
+	finally:
+		blocks.put(None)
+		comparer.join()
+
+	result.elapsed = time.time()-started
+	return result
+
+def bytes_to_verify (ecu, section, quick: bool = False) -> int:
+	return sum([size for address, size, readable in plan_verify(ecu, section, quick)[0]])
@@ -4,9 +4,16 @@ from datetime import datetime
 from alive_progress import alive_bar
 import gkbus
 from gkbus import kwp
-from flasher.memory import read_memory, write_memory, dynamic_find_end
-from flasher.ecu import ECU, identify_ecu, fetch_ecu_identification, enable_security_access, ECUIdentificationException
-from flasher.checksum import correct_checksum
+from flasher.memory import read_memory, choose_read_mode, read_modes
+from flasher.ecu import ECU, identify_ecu, fetch_ecu_identification, enable_security_access, get_ecu_by_name, ECUIdentificationException
+from flasher.flashplan import plan_flash, write_section, remember_dump
+from flasher.session import initialize_bus, start_session, set_timing_parameters
+from flasher.station import load_jobs, run_station, StationException
+from flasher.verify import verify_section, bytes_to_verify
+from flasher.diff import cli_diff
+from flasher.store import cli_store, DumpStoreException
+from flasher.journal import DumpJournal, DumpJournalException
+from flasher.checksum import correct_checksum, cli_correct_checksums, cli_classify
 from ecu_definitions import ECU_IDENTIFICATION_TABLE, BAUDRATES, Routine
 from flasher.logging import logger
 from flasher.immo import cli_immo, cli_immo_info
@@ -15,42 +22,80 @@ from flasher.lineswap import generate_sie, generate_bin
 def strip (string):
 	return ''.join(x for x in string if x.isalnum())
 
-def cli_read_eeprom (ecu, eeprom_size, address_start=None, address_stop=None, output_filename=None):
+def generate_dump_filename (ecu, address_start, address_stop):
+	try:
+		calibration = ecu.get_calibration()
+		description = ecu.get_calibration_description()
+		hw_rev_c = strip(''.join([chr(x) for x in ecu.bus.execute(kwp.commands.ReadEcuIdentification(0x8c)).get_data()[1:]]))
+		hw_rev_d = strip(''.join([chr(x) for x in ecu.bus.execute(kwp.commands.ReadEcuIdentification(0x8d)).get_data()[1:]]))
+		return "{}_{}_{}_{}_{}.bin".format(description, calibration, hw_rev_c, hw_rev_d, datetime.now().strftime('%Y-%m-%d_%H%M'))
+	except: # dirty
+		return "output_{}_to_{}.bin".format(hex(address_start), hex(address_stop))
+
+def cli_read_eeprom (ecu, eeprom_size, address_start=None, address_stop=None, output_filename=None, read_mode='auto'):
 	if (address_start == None):
 		address_start = abs(ecu.bin_offset)
 	if (address_stop == None):
 		address_stop = address_start+eeprom_size
 
-	print('[*] Reading from {} to {}'.format(hex(address_start), hex(address_stop)))
+	if (output_filename == None):
+		output_filename = generate_dump_filename(ecu, address_start, address_stop)
 
-	requested_size = address_stop-address_start
-	eeprom = [0xFF]*eeprom_size
+	try:
+		calibration = ecu.get_calibration()
+	except kwp.KWPNegativeResponseException:
+		calibration = None
 
-	with alive_bar(requested_size, unit='B') as bar:
-		fetched = read_memory(ecu, address_start=address_start, address_stop=address_stop, progress_callback=bar)
+	journal = DumpJournal.create(output_filename, ecu, calibration, eeprom_size, address_start, address_stop)
+	cli_read_journal(ecu, journal, read_mode)
 
-	eeprom_start = ecu.calculate_bin_offset(address_start)
-	eeprom_end = eeprom_start + len(fetched)
-	eeprom[eeprom_start:eeprom_end] = fetched
+def cli_resume_read_eeprom (ecu, journal, read_mode='auto'):
+	print('[*] Resuming {}, {} bytes left to read'.format(journal.output_filename, journal.bytes_missing()))
 
-	if (output_filename == None):
-		try:
-			calibration = ecu.get_calibration()
-			description = ecu.get_calibration_description()
-			hw_rev_c = strip(''.join([chr(x) for x in ecu.bus.execute(kwp.commands.ReadEcuIdentification(0x8c)).get_data()[1:]]))
-			hw_rev_d = strip(''.join([chr(x) for x in ecu.bus.execute(kwp.commands.ReadEcuIdentification(0x8d)).get_data()[1:]]))
-			output_filename = "{}_{}_{}_{}_{}.bin".format(description, calibration, hw_rev_c, hw_rev_d, datetime.now().strftime('%Y-%m-%d_%H%M'))
-		except: # dirty
-			output_filename = "output_{}_to_{}.bin".format(hex(address_start), hex(address_stop))
+	if (journal.calibration != None and ecu.get_calibration() != journal.calibration):
+		print('[!] Calibration of the connected ECU doesn\'t match the interrupted dump ({})! Aborting'.format(journal.calibration))
+		return
+
+	cli_read_journal(ecu, journal, read_mode)
+
+def cli_read_journal (ecu, journal, read_mode='auto'):
+	print('[*] Reading from {} to {}'.format(hex(journal.address_start), hex(journal.address_stop)))
+
+	read_mode = choose_read_mode(ecu, read_mode)
+	print('[*] Read mode: {}'.format({'rmba': 'ReadMemoryByAddress', 'upload': 'RequestUpload/TransferData'}[read_mode]))
+
+	try:
+		with alive_bar(journal.bytes_missing(), unit='B') as bar:
+			for address_start, address_stop in journal.missing_ranges():
+				read_memory(ecu, address_start=address_start, address_stop=address_stop, progress_callback=bar, page_callback=journal.write, read_mode=read_mode)
+	except KeyboardInterrupt:
+		print('\n[!] Interrupted! Progress is saved, continue with --resume {}'.format(journal.output_filename))
+		raise
+
+	journal.finalize()
 
-	with open (output_filename, "wb") as file:
-		file.write(bytes(eeprom))
+	with open(journal.output_filename, 'rb') as file:
+		remember_dump(ecu, journal.calibration, file.read(), journal.address_start, journal.address_stop)
 
-	print('[*] saved to {}'.format(output_filename))
+	print('[*] saved to {}'.format(journal.output_filename))
 
 	print('[*] Done!')
 
-def cli_flash_eeprom (ecu, input_filename, flash_calibration=True, flash_program=True):
+def cli_verify_flash (ecu, plan, quick=False):
+	verified = True
+	for section in plan.to_send():
+		print('[*] Reading back {} section{}'.format(section.description, ' (sampled blocks)' if quick else ''))
+		with alive_bar(bytes_to_verify(ecu, section, quick), unit='B') as bar:
+			result = verify_section(ecu, section, quick=quick, progress_callback=bar)
+
+		if result.ok():
+			print('[*] Verified: {}'.format(result))
+		else:
+			print('[!] Verification failed: {}'.format(result))
+			verified = False
+	return verified
+
+def cli_flash_eeprom (ecu, input_filename, flash_calibration=True, flash_program=True, diff=True, readback=False, verify=False, quick_verify=False, skip_gaps=False):
 	print('\n[*] Loading up {}'.format(input_filename))
 
 	with open(input_filename, 'rb') as file:
@@ -58,45 +103,35 @@ def cli_flash_eeprom (ecu, input_filename, flash_calibration=True, flash_program
 
 	print('[*] Loaded {} bytes'.format(len(eeprom)))
 
+	print('[*] Comparing with what\'s on the ECU..')
+	plan = plan_flash(ecu, eeprom, flash_calibration=flash_calibration, flash_program=flash_program, diff=diff, readback=readback, skip_gaps=skip_gaps)
+	for line in plan.summary():
+		print('[*] {}'.format(line))
+
+	if not plan.to_send():
+		print('[*] ECU already holds this file, nothing to flash!')
+		return
+
 	if (input('[?] Ready to flash! Do you wish to continue? [y/n]: ') != 'y'):
 		print('[!] Aborting!')
 		return
 
-	if flash_program:
-		print('[*] start routine 0x00 (erase program code section)')
-		ecu.bus.execute(kwp.commands.StartRoutineByLocalIdentifier(Routine.ERASE_PROGRAM.value))
-
-		flash_start = ecu.get_program_section_offset() + ecu.get_program_section_flash_memory_offset()
-		flash_size = ecu.get_program_section_flash_size()
-		payload_start = ecu.get_program_section_flash_bin_offset()
-		payload_stop = payload_start + flash_size
-		payload = eeprom[payload_start:payload_stop]
-		payload_adjusted = payload[:dynamic_find_end(payload)]
-		flash_size = len(payload_adjusted)
-
-		with alive_bar(flash_size, unit='B') as bar:
-			write_memory(ecu, payload_adjusted, flash_start, flash_size, progress_callback=bar)
-
-	if flash_calibration:
-		print('[*] start routine 0x01 (erase calibration section)')
-		ecu.bus.execute(kwp.commands.StartRoutineByLocalIdentifier(Routine.ERASE_CALIBRATION.value))
-
-		flash_start = ecu.calculate_memory_write_offset(0x090000)
-		flash_size = ecu.get_calibration_size_bytes_flash()
-		payload_start = ecu.calculate_bin_offset(0x090000)
-		payload_stop = payload_start + flash_size
-		payload = eeprom[payload_start:payload_stop]
-		payload_adjusted = payload[:dynamic_find_end(payload)]
-		flash_size = len(payload_adjusted)
-
-		with alive_bar(flash_size, unit='B') as bar:
-			write_memory(ecu, payload_adjusted, flash_start, flash_size, progress_callback=bar)
+	for section in plan.to_send():
+		print('[*] start routine {} (erase {} section)'.format(hex(section.routine.value), section.description))
+		with alive_bar(section.bytes_to_send(), unit='B') as bar:
+			stats = write_section(ecu, section, progress_callback=bar)
+		print('[*] Sent {}'.format(stats))
 
 	ecu.bus.set_timeout(300)
 	print('[*] start routine 0x02 (verify blocks and mark as ready to execute)')
 	ecu.bus.execute(kwp.commands.StartRoutineByLocalIdentifier(Routine.VERIFY_BLOCKS.value)).get_data()
 	ecu.bus.set_timeout(12)
 
+	if (verify or quick_verify) and not cli_verify_flash(ecu, plan, quick=quick_verify):
+		print('[!] ECU content doesn\'t match {}! Flash it again'.format(input_filename))
+	else:
+		plan.remember()
+
 	print('[*] ecu reset')
 	print('[*] done!')
 	ecu.bus.execute(kwp.commands.ECUReset(kwp.enums.ResetMode.POWER_ON_RESET)).get_data()
@@ -115,15 +150,26 @@ def load_arguments ():
 	parser.add_argument('-p', '--protocol', help='Protocol to use. canbus or kline')
 	parser.add_argument('-i', '--interface')
 	parser.add_argument('-b', '--baudrate', type=int)
-	parser.add_argument('--desired-baudrate', type=lambda x: int(x,0))
+	parser.add_argument('--timing', choices=['tune', 'max'], default='max', help='Apply the ECU\'s timing limits as they are (max) or benchmark shorter ones and keep the fastest reliable set (tune). Tuning only changes the ECU\'s P2/P3, requests are paced as before')
+	parser.add_argument('--desired-baudrate', type=lambda x: x if x == 'auto' else int(x,0), help='Baudrate identifier, or auto to negotiate the fastest stable one')
 	parser.add_argument('-f', '--flash', help='Filename to full flash')
 	parser.add_argument('--flash-calibration', help='Filename to flash calibration zone from')
 	parser.add_argument('--flash-program', help='Filename to flash program zone from')
+	parser.add_argument('--full-flash', action='store_true', help='Flash every section, even ones identical to what\'s on the ECU')
+	parser.add_argument('--skip-erased-gaps', action='store_true', help='Don\'t send 0xFF runs inside sections, start a new download after them')
+	parser.add_argument('--verify', action='store_true', help='Read flashed sections back and compare them with the file')
+	parser.add_argument('--verify-quick', action='store_true', help='Like --verify, but only read back sampled blocks')
+	parser.add_argument('--readback-diff', action='store_true', help='Read sections back from the ECU to find ones that don\'t need flashing')
 	parser.add_argument('-r', '--read', action='store_true')
 	parser.add_argument('--read-calibration', action='store_true')
 	parser.add_argument('--read-program', action='store_true')
+	parser.add_argument('--resume', help='Filename of an interrupted dump to continue reading')
+	parser.add_argument('--read-mode', choices=['auto']+read_modes, default='auto', help='ReadMemoryByAddress (rmba), RequestUpload (upload) or the faster one for this ECU type (auto)')
 	parser.add_argument('--id', action='store_true')
-	parser.add_argument('--correct-checksum')
+	parser.add_argument('--correct-checksum', nargs='+', help='File to correct checksums of, or several files/directories to correct without asking')
+	parser.add_argument('--checksum-dry-run', action='store_true', help='Only report checksums of --correct-checksum files/directories, don\'t save')
+	parser.add_argument('--classify', nargs='+', metavar='PATH', help='Detect checksum layout of dumps, report ambiguous and unknown ones')
+	parser.add_argument('--diff', nargs=2, metavar=('A', 'B'), help='Compare two dumps')
 	parser.add_argument('--bin-to-sie')
 	parser.add_argument('--sie-to-bin')	
 	parser.add_argument('--clear-adaptive-values', action='store_true')
@@ -134,6 +180,13 @@ def load_arguments ():
 	parser.add_argument('-c', '--config', help='Config filename', default='gkflasher.yml')
 	parser.add_argument('-v', '--verbose', action='count', default=0)
 	parser.add_argument('--immo', action='store_true')
+	parser.add_argument('--store-add', nargs='+', help='Add dumps (or directories of dumps) to the local dump store')
+	parser.add_argument('--store-find', nargs='?', const='', help='List stored dumps, optionally only those with the given calibration')
+	parser.add_argument('--store-get', type=int, help='Restore a dump from the store by its id')
+	parser.add_argument('--store-dir', help='Dump store directory (default: ~/.gkflasher/store)')
+	parser.add_argument('--vin', help='VIN to record with --store-add, or to filter --store-find by')
+	parser.add_argument('--station', help='Job list to run on multiple adapters at once')
+	parser.add_argument('--station-report', help='Filename to save the station summary report')
 	args = parser.parse_args()
 
 	logging_levels = [logging.WARNING, logging.INFO, logging.DEBUG]
@@ -150,12 +203,6 @@ def load_arguments ():
 
 	return GKFlasher_config, args
 
-def initialize_bus (protocol, protocol_config):
-	interface = protocol_config['interface']
-	del protocol_config['interface']
-
-	return gkbus.Bus(protocol, interface=interface, **protocol_config)
-
 def cli_choose_ecu ():
 	print('[!] Failed to identify your ECU!')
 	print('[*] If you know what you\'re doing (like trying to revive a soft bricked ECU), you can choose your ECU from the list below:')
@@ -189,57 +236,37 @@ def cli_identify_ecu (bus):
 	print('[*] Found! {}'.format(ecu.get_name()))
 	return ecu
 
-def main(bus, args):
-	try:
-		bus.execute(kwp.commands.StopDiagnosticSession())
-		bus.execute(kwp.commands.StopCommunication())
-	except (kwp.KWPNegativeResponseException, gkbus.GKBusTimeoutException):
-		pass
-
-	bus.init(kwp.commands.StartCommunication(), keepalive_payload=kwp.commands.TesterPresent(kwp.enums.ResponseType.REQUIRED), keepalive_timeout=1.5)
-
-	if args.desired_baudrate:
+def main(bus, args, adapter=None):
+	journal = None
+	if (args.resume):
 		try:
-			desired_baudrate = args.desired_baudrate
-		except KeyError:
-			print('[!] Selected baudrate is invalid! Available baudrates:')
-			for key, baudrate in BAUDRATES.items():
-				print('{} - {}'.format(hex(key), baudrate))
+			journal = DumpJournal.load(args.resume)
+		except DumpJournalException as e:
+			print('[!] {}'.format(e))
 			sys.exit(1)
 
-		print('[*] Trying to start diagnostic session with baudrate {}'.format(BAUDRATES[args.desired_baudrate]))
-		bus.execute(kwp.commands.StartDiagnosticSession(kwp.enums.DiagnosticSession.FLASH_REPROGRAMMING, args.desired_baudrate))
-		bus.socket.socket.baudrate = BAUDRATES[args.desired_baudrate]
-	else:
-		print('[*] Trying to start diagnostic session')
-		bus.execute(kwp.commands.StartDiagnosticSession(kwp.enums.DiagnosticSession.FLASH_REPROGRAMMING))
-		desired_baudrate = None
-	bus.set_timeout(12)
+	desired_baudrate = args.desired_baudrate
+	if (desired_baudrate and desired_baudrate != 'auto' and desired_baudrate not in BAUDRATES):
+		print('[!] Selected baudrate is invalid! Available baudrates:')
+		for key, baudrate in BAUDRATES.items():
+			print('{} - {}'.format(hex(key), baudrate))
+		sys.exit(1)
+
+	desired_baudrate = start_session(bus, desired_baudrate, adapter=adapter)
 
 	if (args.immo):
 		return cli_immo(bus, desired_baudrate)
 
-	print('[*] Set timing parameters to maximum')
-	try:
-		available_timing = bus.execute(
-			kwp.commands.AccessTimingParameters(
-				kwp.enums.TimingParameterIdentifier.READ_LIMITS_OF_POSSIBLE_TIMING_PARAMETERS
-			)
-		).get_data()
-
-		bus.execute(
-			kwp.commands.AccessTimingParameters(
-				kwp.enums.TimingParameterIdentifier.SET_TIMING_PARAMETERS_TO_GIVEN_VALUES, 
-				*available_timing[1:]
-			)
-		)
-	except kwp.KWPNegativeResponseException:
-		print('[!] Not supported on this ECU!')
-
 	print('[*] Security Access')
 	enable_security_access(bus)
 
-	ecu = cli_identify_ecu(bus)
+	set_timing_parameters(bus, tune=args.timing == 'tune')
+
+	if (journal):
+		ecu = get_ecu_by_name(bus, journal.ecu_name)
+		print('[*] Using ECU from the interrupted dump: {}'.format(ecu.get_name()))
+	else:
+		ecu = cli_identify_ecu(bus)
 
 	print('[*] Trying to find calibration..')
 	
@@ -266,20 +293,22 @@ def main(bus, args):
 		cli_immo_info(bus, desired_baudrate)
 
 	if (args.read):
-		cli_read_eeprom(ecu, eeprom_size, address_start=args.address_start, address_stop=args.address_stop, output_filename=args.output)
+		cli_read_eeprom(ecu, eeprom_size, address_start=args.address_start, address_stop=args.address_stop, output_filename=args.output, read_mode=args.read_mode)
 	if (args.read_calibration):
-		cli_read_eeprom(ecu, eeprom_size, address_start=0x090000, address_stop=0x090000+ecu.get_calibration_size_bytes(), output_filename=args.output)
+		cli_read_eeprom(ecu, eeprom_size, address_start=0x090000, address_stop=0x090000+ecu.get_calibration_size_bytes(), output_filename=args.output, read_mode=args.read_mode)
 	if (args.read_program):
 		address_start = ecu.get_program_section_offset()
 		address_stop = address_start+ecu.get_program_section_size()
-		cli_read_eeprom(ecu, eeprom_size, address_start=address_start, address_stop=address_stop, output_filename=args.output)
+		cli_read_eeprom(ecu, eeprom_size, address_start=address_start, address_stop=address_stop, output_filename=args.output, read_mode=args.read_mode)
+	if (journal):
+		cli_resume_read_eeprom(ecu, journal, args.read_mode)
 
 	if (args.flash):
-		cli_flash_eeprom(ecu, input_filename=args.flash)
+		cli_flash_eeprom(ecu, input_filename=args.flash, diff=not args.full_flash, readback=args.readback_diff, verify=args.verify, quick_verify=args.verify_quick, skip_gaps=args.skip_erased_gaps)
 	if (args.flash_calibration):
-		cli_flash_eeprom(ecu, input_filename=args.flash_calibration, flash_calibration=True, flash_program=False)
+		cli_flash_eeprom(ecu, input_filename=args.flash_calibration, flash_calibration=True, flash_program=False, diff=not args.full_flash, readback=args.readback_diff, verify=args.verify, quick_verify=args.verify_quick, skip_gaps=args.skip_erased_gaps)
 	if (args.flash_program):
-		cli_flash_eeprom(ecu, input_filename=args.flash_program, flash_program=True, flash_calibration=False)
+		cli_flash_eeprom(ecu, input_filename=args.flash_program, flash_program=True, flash_calibration=False, diff=not args.full_flash, readback=args.readback_diff, verify=args.verify, quick_verify=args.verify_quick, skip_gaps=args.skip_erased_gaps)
 
 	if (args.clear_adaptive_values):
 		cli_clear_adaptive_values(ecu, desired_baudrate)
@@ -297,7 +326,19 @@ if __name__ == '__main__':
 	GKFlasher_config, args = load_arguments()
 
 	if (args.correct_checksum):
-		correct_checksum(filename=args.correct_checksum)
+		if (len(args.correct_checksum) == 1 and not os.path.isdir(args.correct_checksum[0])):
+			success = correct_checksum(filename=args.correct_checksum[0])
+		else:
+			success = cli_correct_checksums(args.correct_checksum, patch=not args.checksum_dry_run)
+		sys.exit(0 if success else 1)
+
+	if (args.classify):
+		classified = cli_classify(args.classify)
+		sys.exit(0 if classified else 1)
+
+	if (args.diff):
+		identical = cli_diff(*args.diff)
+		sys.exit(0 if identical else 1)
 
 	if (args.bin_to_sie):
 		generate_sie(filename=args.bin_to_sie)
@@ -306,12 +347,29 @@ if __name__ == '__main__':
 	if (args.sie_to_bin):
 		generate_bin(filename=args.sie_to_bin)
 		sys.exit()
+
+	if (args.store_add or args.store_find != None or args.store_get != None):
+		try:
+			cli_store(args)
+		except DumpStoreException as e:
+			print('[!] {}'.format(e))
+			sys.exit(1)
+		sys.exit()
+
+	if (args.station):
+		try:
+			jobs = load_jobs(args.station)
+		except StationException as e:
+			print('[!] {}'.format(e))
+			sys.exit(1)
+		report = run_station(GKFlasher_config, jobs, report_filename=args.station_report)
+		sys.exit(1 if report['failed'] else 0)
 		
 	print('[*] Selected protocol: {}. Initializing..'.format(GKFlasher_config['protocol']))
 	bus = initialize_bus(GKFlasher_config['protocol'], GKFlasher_config[GKFlasher_config['protocol']])	
 
 	try:
-		main(bus, args)
+		main(bus, args, adapter=GKFlasher_config[GKFlasher_config['protocol']]['interface'])
 	except KeyboardInterrupt:
 		bus.shutdown()
 		sys.exit()
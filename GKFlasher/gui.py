@@ -1,5 +1,6 @@
 import os
 import sys
+import threading
 from datetime import datetime
 from PyQt5 import QtWidgets, uic
 from PyQt5.QtWidgets import QFileDialog, QMessageBox
@@ -10,7 +11,9 @@ from gkbus.kwp.enums import *
 from gkbus.kwp import KWPNegativeResponseException
 from gkbus.interface.kline.KLineSerial import KLineSerial
 from flasher.ecu import enable_security_access, fetch_ecu_identification, identify_ecu, ECUIdentificationException, ECU
-from flasher.memory import read_memory, write_memory, dynamic_find_end
+from flasher.memory import read_memory
+from flasher.session import negotiate_baudrate, set_timing_parameters
+from flasher.flashplan import plan_flash, write_section, remember_dump
 from flasher.checksum import *
 from flasher.immo import immo_status
 from ecu_definitions import ECU_IDENTIFICATION_TABLE, BAUDRATES, Routine
@@ -95,6 +98,7 @@ class Ui(QtWidgets.QMainWindow):
 	request_new_password_signal = pyqtSignal(object, object, str)  # For requesting the new password. Three arguments: log_callback, ecu, current_password
 	request_vin_signal = pyqtSignal(object, object)  # For requesting the Write VIN Input
 	request_vin_to_pin_signal = pyqtSignal(object)  # For requesting the VIN to PIN Input
+	request_unknown_eeprom_signal = pyqtSignal(object)  # For asking whether a BSL job goes on with an unrecognized EEPROM
 	log_signal = pyqtSignal(str)  # Define a signal for logging
 
 	def __init__(self):
@@ -115,6 +119,7 @@ class Ui(QtWidgets.QMainWindow):
 		self.request_new_password_signal.connect(self.request_new_password_from_user)
 		self.request_vin_signal.connect(self.request_vin_from_user)
 		self.request_vin_to_pin_signal.connect(self.request_vin_to_pin_from_user)
+		self.request_unknown_eeprom_signal.connect(self.request_unknown_eeprom_from_user)
 
 		# Change the working directory
 		if not os.path.exists(home):
@@ -217,6 +222,7 @@ class Ui(QtWidgets.QMainWindow):
 
 	def load_baudrates (self):
 		self.baudratesBox.addItem('Desired baudrate (default)', -1)
+		self.baudratesBox.addItem('Fastest stable (auto)', 'auto')
 		for index, baudrate in BAUDRATES.items():
 			self.baudratesBox.addItem('{} baud'.format(baudrate), index)
 
@@ -259,6 +265,8 @@ class Ui(QtWidgets.QMainWindow):
 			log_callback.emit('[*] Trying to start diagnostic session')
 			bus.execute(StartDiagnosticSession(DiagnosticSession.FLASH_REPROGRAMMING))
 			self.desired_baudrate = None  # No specific baud rate
+		elif self.baudratesBox.currentData() == 'auto':
+			self.desired_baudrate = negotiate_baudrate(bus, self.get_interface_url(), log=log_callback.emit)
 		else:
 			self.desired_baudrate = self.baudratesBox.currentData()
 			log_callback.emit('[*] Trying to start diagnostic session with baudrate {}'.format(BAUDRATES[self.desired_baudrate]))
@@ -271,26 +279,11 @@ class Ui(QtWidgets.QMainWindow):
 
 		bus.set_timeout(12)
 
-		log_callback.emit('[*] Set timing parameters to maximum')
-		try:
-			available_timing = bus.execute(
-				AccessTimingParameters(
-					TimingParameterIdentifier.READ_LIMITS_OF_POSSIBLE_TIMING_PARAMETERS
-				)
-			).get_data()
-
-			bus.execute(
-				AccessTimingParameters(
-					TimingParameterIdentifier.SET_TIMING_PARAMETERS_TO_GIVEN_VALUES, 
-					*available_timing[1:]
-				)
-			)
-		except KWPNegativeResponseException:
-			log_callback.emit('[!] Not supported on this ECU!')
-
 		log_callback.emit('[*] Security Access')
 		enable_security_access(bus)
 
+		set_timing_parameters(bus, log=log_callback.emit, tune=self.tuneTimingCheckBox.isChecked())
+
 		log_callback.emit('[*] Trying to identify ECU.. ')
 		if self.ecusBox.currentData() == -1:
 			try:
@@ -340,6 +333,11 @@ class Ui(QtWidgets.QMainWindow):
 		with open(output_filename, "wb") as file:
 			file.write(bytes(eeprom))
 
+		try:
+			remember_dump(ecu, ecu.get_calibration(), bytes(eeprom), address_start, address_stop)
+		except KWPNegativeResponseException:
+			pass
+
 		# Display user friendly path based on OS
 		if os.name == 'nt':
 			log_callback.emit('[*] saved to {}'.format(home + "\\" + output_filename))
@@ -357,40 +355,27 @@ class Ui(QtWidgets.QMainWindow):
 
 		log_callback.emit('[*] Loaded {} bytes'.format(len(eeprom)))
 
-		if flash_program:
-			log_callback.emit('[*] start routine 0x00 (erase program code section)')
-			ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.ERASE_PROGRAM.value))
-
-			flash_start = ecu.get_program_section_offset() + ecu.get_program_section_flash_memory_offset()
-			flash_size = ecu.get_program_section_size()
-			payload_start = ecu.get_program_section_flash_bin_offset()
-			payload_stop = payload_start + flash_size
-			payload = eeprom[payload_start:payload_stop]
-			payload_adjusted = payload[:dynamic_find_end(payload)]
-			flash_size = len(payload_adjusted)
-
-			log_callback.emit('[*] Uploading data to the ECU')
-			write_memory(ecu, payload_adjusted, flash_start, flash_size, progress_callback=Progress(progress_callback, flash_size))
-
-		if flash_calibration:
-			log_callback.emit('[*] start routine 0x01 (erase calibration section)')
-			ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.ERASE_CALIBRATION.value))
+		log_callback.emit('[*] Comparing with what\'s on the ECU..')
+		plan = plan_flash(ecu, eeprom, flash_calibration=flash_calibration, flash_program=flash_program, diff=not self.flashingFullFlashCheckBox.isChecked())
+		for line in plan.summary():
+			log_callback.emit('[*] {}'.format(line))
 
-			flash_start = ecu.calculate_memory_write_offset(0x090000)
-			flash_size = ecu.get_calibration_size_bytes_flash()
-			payload_start = ecu.calculate_bin_offset(0x090000)
-			payload_stop = payload_start + flash_size
-			payload = eeprom[payload_start:payload_stop]
-			payload_adjusted = payload[:dynamic_find_end(payload)]
-			flash_size = len(payload_adjusted)
+		if not plan.to_send():
+			log_callback.emit('[*] ECU already holds this file, nothing to flash!')
+			self.disconnect_ecu(ecu)
+			return
 
+		for section in plan.to_send():
+			log_callback.emit('[*] start routine {} (erase {} section)'.format(hex(section.routine.value), section.description))
 			log_callback.emit('[*] Uploading data to the ECU')
-			write_memory(ecu, payload_adjusted, flash_start, flash_size, progress_callback=Progress(progress_callback, flash_size))
+			stats = write_section(ecu, section, progress_callback=Progress(progress_callback, section.bytes_to_send()))
+			log_callback.emit('[*] Sent {}'.format(stats))
 
 		ecu.bus.set_timeout(300)
 		log_callback.emit('[*] start routine 0x02 (verify blocks and mark as ready to execute)')
 		ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.VERIFY_BLOCKS.value)).get_data()
 		ecu.bus.set_timeout(12)
+		plan.remember()
 
 		log_callback.emit('[*] ecu reset')
 		log_callback.emit('[*] Done!')
@@ -477,11 +462,10 @@ class Ui(QtWidgets.QMainWindow):
 			log_callback.emit('            [ASCII]: {}'.format(value_ascii))
 			log_callback.emit('')
 
-		if self.baudratesBox.currentData() == -1:
+		if self.desired_baudrate is None:
 			ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT))
 		else:
-			desired_baudrate = self.baudratesBox.currentData()
-			ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, desired_baudrate))
+			ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, self.desired_baudrate))
 		try:
 			immo_data = ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.QUERY_IMMO_INFO.value)).get_data()
 		except (KWPNegativeResponseException):
@@ -509,67 +493,27 @@ class Ui(QtWidgets.QMainWindow):
 			self.log('[!] Error: No such file or directory.')
 			return
 		self.log('Trying to detect type.. ')
-		cks_type = detect_offsets(payload)
-		
-		if cks_type == None:
+		try:
+			result = calculate_checksums(payload)
+		except ChecksumException:
 			self.log('[!] Error: Calibration zone not detected.')
 			return
-		self.log(cks_type['name'])
+		self.log(result['layout'])
 
-		for region in cks_type['regions']:
+		dialog_message = ''
+		for region in result['regions']:
 			self.log('[*] Calculating checksum for region {}'.format(region['name']))
-			flag_address, init_address, cks_address, bin_offset = region['flag_address'], region['init_address'], region['cks_address'], region['bin_offset']
-
-			amount_of_zones = int.from_bytes(payload[cks_address+2:cks_address+3], "big")
-			self.log('[*] Amount of zones: {}'.format(amount_of_zones))
 
-			if (amount_of_zones == 0 or amount_of_zones == 0xFF):
+			if not region['zones']:
 				self.log('[*] Skipping region {}'.format(region['name']))
 				continue
+			self.log('[*] Amount of zones: {}'.format(len(region['zones'])))
 
-			checksums = []
-
-			zone_address = cks_address
-			for zone_index in range(amount_of_zones):
-
-				self.log('[*] Trying to find addresses of zone #{}.. '.format(zone_index+1))
-				zone_start_offset = zone_address+0x04
-				zone_start = concat_3_bytes(read_and_reverse(payload, zone_start_offset, 3)) + bin_offset
-
-				zone_stop_offset = zone_address+0x08
-				zone_stop = concat_3_bytes(read_and_reverse(payload, zone_stop_offset, 3)) + bin_offset + 1
-				self.log('{} - {}'.format(hex(zone_start), hex(zone_stop)))
-
-				self.log('[*] Trying to find initial value.. ')
-				if (zone_index == 0):
-					initial_value_bytes = read_and_reverse(payload, init_address, 2)
-					initial_value = (initial_value_bytes[0]<< 8) | initial_value_bytes[1]
-				else:
-					initial_value = checksums[zone_index-1]
-				self.log(hex(initial_value))
-
-				self.log('[*] checksum of zone #{}: '.format(zone_index+1))
-				zone_cks = checksum(payload, zone_start, zone_stop, initial_value)
-				self.log(hex(zone_cks))
-				checksums.append(zone_cks)
-				zone_address += 0x08
-
-			checksum_b1 = (checksums[-1] >> 8) & 0xFF
-			checksum_b2 = (checksums[-1] & 0xFF)
-			checksum_reversed = (checksum_b2 << 8) | checksum_b1
-
-			current_checksum = int.from_bytes(payload[cks_address:cks_address+2], "big")
-			region['current_checksum'] = current_checksum
-			region['checksum'] = checksum_reversed
+			for zone_index, (zone_start, zone_stop, initial_value, zone_cks) in enumerate(region['zones']):
+				self.log('[*] Zone #{}: {} - {}, initial value: {}, checksum: {}'.format(zone_index+1, hex(zone_start), hex(zone_stop), hex(initial_value), hex(zone_cks)))
 
-			self.log('[*] OK! Current {} checksum: {}, new checksum: {}'.format(region['name'], hex(current_checksum), hex(checksum_reversed)))
-
-		dialog_message = ''
-		for region in cks_type['regions']:
-			try:
-				dialog_message += 'Current {} checksum: {}, new checksum: {}\n'.format(region['name'], hex(region['current_checksum']), hex(region['checksum']))
-			except KeyError:
-				continue
+			self.log('[*] OK! Current {} checksum: {}, new checksum: {}'.format(region['name'], hex(region['current']), hex(region['calculated'])))
+			dialog_message += 'Current {} checksum: {}, new checksum: {}\n'.format(region['name'], hex(region['current']), hex(region['calculated']))
 		dialog_message += 'Save?'
 
 		if QMessageBox.question(
@@ -581,13 +525,7 @@ class Ui(QtWidgets.QMainWindow):
 			) == QMessageBox.Yes:
 
 			self.log('[*] Saving to {}'.format(filename))
-			with open(filename, 'rb+') as file:
-				for region in cks_type['regions']:
-					file.seek(region['cks_address'])
-					try:
-						file.write(region['checksum'].to_bytes(2, "big"))
-					except KeyError:
-						continue
+			correct_checksum_file(filename, patch=True)
 
 		self.log('[*] Done!')
 
@@ -652,11 +590,10 @@ class Ui(QtWidgets.QMainWindow):
 		
 		log_callback.emit('[*] Querying additional parameters,  this might take a few seconds..')
 
-		if self.baudratesBox.currentData() == -1:
+		if self.desired_baudrate is None:
 			ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT))
 		else:
-			desired_baudrate = self.baudratesBox.currentData()
-			ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, desired_baudrate))
+			ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, self.desired_baudrate))
 		try:
 			immo_data = ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.QUERY_IMMO_INFO.value)).get_data()
 		except (KWPNegativeResponseException):
@@ -1256,6 +1193,20 @@ class Ui(QtWidgets.QMainWindow):
 
 		return user_file_path
 
+	def confirm_unknown_eeprom(self) -> bool:
+		# Called from the BSL worker thread, the dialog has to open on the main thread
+		answer = {'event': threading.Event(), 'proceed': False}
+		self.request_unknown_eeprom_signal.emit(answer)
+		answer['event'].wait()
+		return answer['proceed']
+
+	def request_unknown_eeprom_from_user(self, answer):
+		answer['proceed'] = QMessageBox.question(
+			self, 'Unknown EEPROM', 'EEPROM ID not recognized. Proceed manually?',
+			QMessageBox.Yes | QMessageBox.No, QMessageBox.No
+		) == QMessageBox.Yes
+		answer['event'].set()
+
 	def bslHwInfo(self, progress_callback=None, log_callback=None, log_callback2=None):
 		try:		
 			# BSL arguments
@@ -1264,7 +1215,7 @@ class Ui(QtWidgets.QMainWindow):
 				"-hwinfo"
 			]
 			# Pass the Progress object
-			bsl.execute_bsl(args, progress_callback=Progress(progress_callback, 100),log_callback2=log_callback2)
+			bsl.execute_bsl(args, progress_callback=Progress(progress_callback, 100), log_callback2=log_callback2, port=self.get_interface_url(), confirm_unknown=self.confirm_unknown_eeprom)
 
 		except Exception as e:
 			log_callback.emit(f"An error occurred: {str(e)}")
@@ -1285,7 +1236,7 @@ class Ui(QtWidgets.QMainWindow):
 			#log_callback.emit(f"Calling BSL with arguments: {args}")
 			
 			# Pass the Progress object
-			bsl.execute_bsl(args, progress_callback=Progress(progress_callback, 100),log_callback2=log_callback2)
+			bsl.execute_bsl(args, progress_callback=Progress(progress_callback, 100), log_callback2=log_callback2, port=self.get_interface_url(), confirm_unknown=self.confirm_unknown_eeprom)
 
 		except Exception as e:
 			log_callback.emit(f"An error occurred: {str(e)}")
@@ -1304,7 +1255,7 @@ class Ui(QtWidgets.QMainWindow):
 			]
 			
 			# Pass the Progress object
-			bsl.execute_bsl(args, progress_callback=Progress(progress_callback, 100),log_callback2=log_callback2)
+			bsl.execute_bsl(args, progress_callback=Progress(progress_callback, 100), log_callback2=log_callback2, port=self.get_interface_url(), confirm_unknown=self.confirm_unknown_eeprom)
 
 		except Exception as e:
 			log_callback.emit(f"An error occurred: {str(e)}")
@@ -1322,7 +1273,7 @@ class Ui(QtWidgets.QMainWindow):
 			]
 			
 			# Pass the Progress object
-			bsl.execute_bsl(args, progress_callback=Progress(progress_callback, 100),log_callback2=log_callback2)
+			bsl.execute_bsl(args, progress_callback=Progress(progress_callback, 100), log_callback2=log_callback2, port=self.get_interface_url(), confirm_unknown=self.confirm_unknown_eeprom)
 
 		except Exception as e:
 			log_callback.emit(f"An error occurred: {str(e)}")
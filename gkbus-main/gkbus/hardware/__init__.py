@@ -2,6 +2,7 @@
 Hardware layers - concrete implementations of devices
 '''
 
+from .adapter_profile import AdapterProfile, AdapterProfileStore
 from .can_hardware import CanFilter, CanHardware
 from .hardware_abc import (
     HardwareABC,
@@ -15,4 +16,4 @@ from .hardware_abc import (
 )
 from .kline_hardware import KLineHardware
 
-__all__ = ['CanFilter', 'CanHardware', 'HardwareABC', 'HardwareException', 'HardwarePort', 'KLineHardware', 'OpeningPortException', 'RawFrame', 'ReadingException', 'SendingException', 'TimeoutException']
+__all__ = ['AdapterProfile', 'AdapterProfileStore', 'CanFilter', 'CanHardware', 'HardwareABC', 'HardwareException', 'HardwarePort', 'KLineHardware', 'OpeningPortException', 'RawFrame', 'ReadingException', 'SendingException', 'TimeoutException']
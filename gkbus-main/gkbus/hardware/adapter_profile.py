@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+from dataclasses import dataclass
+
+import serial.tools.list_ports
+from typing_extensions import Self
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class AdapterProfile:
+	'''
+	Quirks of a K-Line adapter, learnt on the first connection and applied directly afterwards.
+	None means not known yet
+
+	:param fast_init_offset_ms: timing offset the fast init succeeded with
+	:param echo_mode: how the adapter echoes transmitted bytes back - 'echo' (all of them), 
+		'none' or 'partial' (some get lost)
+	:param leading_bytes: bytes the adapter puts in front of the fast init echo 
+		(or response, without echo)
+	:param dtr_reset: whether the adapter needs its DTR flipped before fast init works. 
+		Unknown (None) adapters get it, like every adapter did before profiles
+	'''
+	fast_init_offset_ms: int | None = None
+	echo_mode: str | None = None
+	leading_bytes: bytes | None = None
+	dtr_reset: bool | None = None
+
+	def to_dict (self) -> dict:
+		return {
+			'fast_init_offset_ms': self.fast_init_offset_ms,
+			'echo_mode': self.echo_mode,
+			'leading_bytes': self.leading_bytes.hex() if self.leading_bytes is not None else None,
+			'dtr_reset': self.dtr_reset
+		}
+
+	@classmethod
+	def from_dict (cls, data: dict) -> Self:
+		leading_bytes = data.get('leading_bytes')
+		return cls(
+			fast_init_offset_ms=data.get('fast_init_offset_ms'),
+			echo_mode=data.get('echo_mode'),
+			leading_bytes=bytes.fromhex(leading_bytes) if leading_bytes is not None else None,
+			dtr_reset=data.get('dtr_reset')
+		)
+
+class AdapterProfileStore:
+	'''
+	JSON file of adapter profiles, keyed by USB VID:PID:serial number
+	'''
+
+	def __init__ (self, path: str | None = None) -> None:
+		default_path = os.path.join(os.path.expanduser('~'), '.gkbus', 'adapter_profiles.json')
+		self.path: str = path if path is not None else default_path
+
+	def _load_all (self) -> dict:
+		try:
+			with open(self.path, 'r') as file:
+				return json.load(file)
+		except (FileNotFoundError, json.JSONDecodeError):
+			return {}
+
+	def load (self, key: str) -> AdapterProfile:
+		'''
+		:return: stored profile, or an empty one for an adapter seen for the first time
+		'''
+		return AdapterProfile.from_dict(self._load_all().get(key, {}))
+
+	def save (self, key: str, profile: AdapterProfile) -> None:
+		profiles = self._load_all()
+		profiles[key] = profile.to_dict()
+
+		try:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			with open(self.path + '.tmp', 'w') as file:
+				json.dump(profiles, file, indent='\t')
+			os.replace(self.path + '.tmp', self.path)
+		except OSError as e:
+			logger.warning('Couldn\'t save adapter profile: {}'.format(str(e)))
+
+	@staticmethod
+	def key_for_port (port: str) -> str | None:
+		'''
+		:return: VID:PID:serial number of the USB adapter behind the port, 
+			None if it's not a USB adapter
+		'''
+		for device in serial.tools.list_ports.comports():
+			if device.device == port and device.vid is not None:
+				return '{:04X}:{:04X}:{}'.format(device.vid, device.pid, device.serial_number or '')
+		return None
@@ -130,6 +130,27 @@ class HardwareABC(ABC):
 		'''
 		return self.timeout
 
+	def detect_echo_mode (self) -> str:
+		'''
+		Find out how the hardware echoes transmitted bytes back
+
+		:return: 'echo', 'none' or 'partial'
+		:rtype: str
+		'''
+		return 'none'
+
+	def reset_adapter (self) -> None:
+		'''
+		Reset the adapter, for hardware that doesn't work reliably without it
+		'''
+		pass
+
+	def save_profile (self) -> None:
+		'''
+		Remember the quirks learnt about the adapter for the next connection
+		'''
+		pass
+
 	@staticmethod
 	def available_ports () -> list[HardwarePort]:
 		'''
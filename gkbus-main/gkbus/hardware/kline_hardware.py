@@ -1,5 +1,7 @@
 import logging
 import time
+from contextlib import nullcontext
+from dataclasses import replace
 
 import serial
 import serial.tools.list_ports
@@ -13,7 +15,8 @@ from .hardware_abc import (
 	TimeoutException,
 )
 
-from ..utils import ns_to_ms, ms_to_ns
+from ..utils import ms_to_ns, ns_to_ms, raised_priority, sleep_overshoot_ns, wait_until_ns
+from .adapter_profile import AdapterProfile, AdapterProfileStore
 
 logger = logging.getLogger(__name__)
 
@@ -21,27 +24,91 @@ class KLineHardware(HardwareABC):
 	'''
 	Hardware class for serial devices, using pyserial as a backend
 	'''
-
-	def __init__ (self, port: str, baudrate: int = 10400, timeout: float = 2) -> None:
+	# TesterPresent from the tester addressed to the tester itself, sent at open 
+	# to see how the adapter echoes. No ECU answers it
+	echo_probe: bytes = bytes([0x81, 0xF1, 0xF1, 0x3E, 0xA1])
+	# W5, how long the bus has to stay idle before a fast init, in seconds
+	bus_idle_time: float = 0.3
+	# how late an adapter may pass the last echoed byte on, in seconds. Stays below
+	# P2min (25 ms), so the ECU's response never arrives in time to be taken for echo
+	echo_latency: float = 0.02
+
+	def __init__ (self, port: str, baudrate: int = 10400, timeout: float = 2, inter_request_delay: float = 0.1, profile_store: AdapterProfileStore | bool = True, fast_init_priority: bool = False) -> None:
+		'''
+		:param inter_request_delay: minimum time between the end of the last frame on the bus 
+			and the next request, in seconds (P3min). Some ECUs won't answer requests sent sooner
+		:param profile_store: where quirks of USB adapters are remembered between connections. 
+			True for the default store in the home directory, False to discover them on every connection
+		:param fast_init_priority: raise the scheduling priority for the duration of the fast init pulse, where the OS allows it
+		'''
 		self.port, self.baudrate = port, baudrate
 		self.timeout = timeout
+		self.inter_request_delay = inter_request_delay
+		self.fast_init_priority = fast_init_priority
+		self._last_activity = 0.0
+		self._rx_buffer = bytearray()
 		self._port_opened = False
+		self._echo_mode_guessed = False
 		self.socket: serial.Serial = None
 
+		self.profile_store: AdapterProfileStore | None = AdapterProfileStore() if profile_store is True else (profile_store or None)
+		self.profile_key: str | None = None
+		self.profile: AdapterProfile = AdapterProfile(dtr_reset=True)
+
 	def open (self) -> bool:
 		try:
 			self.socket = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
 			self._port_opened = True
 		except serial.serialutil.SerialException as e:
 			raise OpeningPortException(e)
-		
-		self._reset_adapter()
+
+		self._load_profile()
+		if self.profile.dtr_reset is not False:
+			self._reset_adapter()
 		self._set_kline_mode()
 
+		# kept in memory only, the transport saves it with the rest of the profile once a fast init works
+		if self.profile.echo_mode is None:
+			self.profile.echo_mode = self.detect_echo_mode()
+			logger.info('K-Line adapter echo mode: {}'.format(self.profile.echo_mode))
+
 		return True
 
+	def _load_profile (self) -> None:
+		'''
+		Look the adapter up in the profile store. Adapters without a USB identity, 
+		or with the store disabled, keep the conservative defaults (DTR reset on every open)
+		'''
+		if self.profile_store is None:
+			return
+
+		self.profile_key = AdapterProfileStore.key_for_port(self.port)
+		if self.profile_key is None:
+			return
+
+		self.profile = self.profile_store.load(self.profile_key)
+		logger.debug('Adapter {} profile: {}'.format(self.profile_key, self.profile))
+
+	def save_profile (self) -> None:
+		if self.profile_store is not None and self.profile_key is not None:
+			# a guessed echo mode is probed again on the next connection
+			echo_mode = None if self._echo_mode_guessed else self.profile.echo_mode
+			self.profile_store.save(self.profile_key, replace(self.profile, echo_mode=echo_mode))
+
+	def reset_adapter (self) -> None:
+		'''
+		Flip DTR and go back to KLine mode, for adapters that turn out to need it after opening
+		'''
+		self._reset_adapter()
+		self._set_kline_mode()
+
 	def read (self, length: int) -> RawFrame:
-		message = self.socket.read(length)
+		if (len(self._rx_buffer) < length):
+			self._rx_buffer += self.socket.read(length-len(self._rx_buffer))
+
+		message = bytes(self._rx_buffer[:length])
+		del self._rx_buffer[:length]
+		self._last_activity = time.perf_counter()
 
 		if (len(message) < length):
 			raise TimeoutException
@@ -49,26 +116,111 @@ class KLineHardware(HardwareABC):
 		return RawFrame(identifier=False, data=message)
 
 	def write (self, frame: RawFrame) -> int:
-		# @todo - this timeout is needed for now, otherwise 
-		# we'll get a timeout when trying to start diagnostic session
-		# find out _why_ is it needed - some magic value instead 
-		# of something calculated shouldnt be required here
-		time.sleep((50/1000)*2)
+		self._wait_inter_request_delay()
 		data = frame.data
+
+		if self._rx_buffer:
+			logger.debug('Discarding unread K-Line bytes: {}'.format(' '.join([hex(x) for x in self._rx_buffer])))
+			self._rx_buffer.clear()
+
+		bytes_written = self._send(data)
+
+		if self.profile.echo_mode in ['echo', None]:
+			# slow USB adapters pass the echo back late, it mustn't be left over for the response
+			self._receive(time.perf_counter() + self.timeout, length=bytes_written)
+			echo = bytes(self._rx_buffer[:bytes_written])
+			del self._rx_buffer[:bytes_written]
+			if (echo != data):
+				logger.error('K-Line echo different than sent payload! \nPayload: {}\nEcho: {}'.format(
+					' '.join([hex(x) for x in list(data)]),
+					' '.join([hex(x) for x in list(echo)])
+				))
+		elif self.profile.echo_mode == 'partial':
+			# only bytes arriving within the echo window are echo, the response comes later
+			self._receive(time.perf_counter() + self._echo_window(len(data)), until=data)
+			del self._rx_buffer[:self._partial_echo_length(data)]
+
+		self._last_activity = time.perf_counter()
+		return bytes_written
+
+	def _send (self, data: bytes) -> int:
 		bytes_written = self.socket.write(data)
 
 		while self.socket.out_waiting > 0:
 			time.sleep(0.001)
 
-		echo = self.socket.read(bytes_written)
-		if (echo != data):
-			logger.error('K-Line echo different than sent payload! \nPayload: {}\nEcho: {}'.format(
-				' '.join([hex(x) for x in list(data)]),
-				' '.join([hex(x) for x in list(echo)])
-			))
-
 		return bytes_written
 
+	def _receive (self, deadline: float, length: int | None = None, until: bytes | None = None) -> None:
+		'''
+		Move bytes the adapter has received into the buffer until deadline, until the 
+		buffer holds length bytes or until it holds the tail of the until data up to 
+		its last byte (what's left of its echo). Never blocks past the deadline
+		'''
+		while (length is None or len(self._rx_buffer) < length) and not (until and self._holds_echo_tail(until)):
+			waiting = self.socket.in_waiting
+			if waiting:
+				self._rx_buffer += self.socket.read(waiting)
+				continue
+			if time.perf_counter() >= deadline:
+				break
+			time.sleep(0.0005)
+
+	def _holds_echo_tail (self, data: bytes) -> bool:
+		return len(self._rx_buffer) > 0 and data.endswith(self._rx_buffer)
+
+	def _echo_window (self, length: int) -> float:
+		'''
+		How long the echo of length bytes may take once they were handed to the adapter - 
+		they can still be on the wire (10 bits per byte), plus the adapter's latency
+		'''
+		return length*10/self.baudrate + self.echo_latency
+
+	def _partial_echo_length (self, data: bytes) -> int:
+		'''
+		What's left of the echo in the buffer - the longest start of the buffer that 
+		matches the end of the sent data. Anything after it is the response
+		'''
+		for length in range(min(len(data), len(self._rx_buffer)), 0, -1):
+			if self._rx_buffer[:length] == data[-length:]:
+				return length
+		return 0
+
+	def detect_echo_mode (self) -> str:
+		'''
+		Send a probe frame no ECU answers to and look at what comes back. 
+		Waits out W5 afterwards, so a fast init can follow straight away
+
+		:return: 'echo', 'none' or 'partial'. 'partial' only for at least the last two bytes 
+			of the probe, anything else that doesn't contain the probe is a guess
+		'''
+		self.socket.reset_input_buffer()
+		self._rx_buffer.clear()
+
+		self._send(self.echo_probe)
+		# as long as a late echo may take, adapters without one pay for it only until their profile is saved
+		self._receive(time.perf_counter() + self.timeout, length=len(self.echo_probe))
+		received = bytes(self._rx_buffer)
+		self._rx_buffer.clear()
+		time.sleep(self.bus_idle_time)
+		self._last_activity = time.perf_counter()
+
+		logger.debug('K-Line echo probe: sent {}, received {}'.format(self.echo_probe.hex(' '), received.hex(' ')))
+		self._echo_mode_guessed = False
+		if self.echo_probe in received:
+			return 'echo'
+		if not received:
+			return 'none'
+		if len(received) >= 2 and self.echo_probe.endswith(received):
+			return 'partial'
+
+		# noise or a garbled echo - assume the echo when about as many bytes came back
+		self._echo_mode_guessed = True
+		echo_mode = 'echo' if len(received) >= len(self.echo_probe) else 'none'
+		logger.warning('K-Line echo probe inconclusive (received {}), assuming echo mode {}'.format(
+			received.hex(' '), echo_mode))
+		return echo_mode
+
 	def close (self) -> None:
 		if not self.is_open():
 			logger.info('Tried to close an already closed port')
@@ -102,6 +254,23 @@ class KLineHardware(HardwareABC):
 		self.socket.flush()
 		return self
 
+	def set_inter_request_delay (self, delay: float) -> Self:
+		'''
+		:param delay: minimum time between the end of the last frame and the next request, in seconds
+		'''
+		self.inter_request_delay = delay
+		return self
+
+	def _wait_inter_request_delay (self) -> None:
+		'''
+		Hold the next request back until inter_request_delay elapsed since the last frame 
+		on the bus. Time spent by the caller in between counts, so back to back requests 
+		only wait for what's left of it instead of a fixed delay
+		'''
+		remaining = self._last_activity + self.inter_request_delay - time.perf_counter()
+		if (remaining > 0):
+			time.sleep(remaining)
+
 	def _reset_adapter (self) -> None:
 		'''
 		Flip the Data Terminal Ready state. 
@@ -121,42 +290,39 @@ class KLineHardware(HardwareABC):
 		self.socket.setRTS(0)
 		time.sleep(0.1)
 
-	def iso14230_fast_init (self, payload: bytes, timing_offset_ms: int = 0) -> tuple[bytes, int, int]:
+	def iso14230_fast_init (self, payload: bytes, timing_offset_ms: int = 0) -> tuple[bytes, float, float]:
 		'''
-		Perform FastInit by bringing the bus down for 25ms and then up for 25ms followed by a payload
+		Perform FastInit by bringing the bus down for 25ms and then up for 25ms followed by a payload. 
+		Both are timed by sleeping most of the time and spinning only through the last bit (see utils.wait_until_ns)
 
-		:return: input buffer contents (up to 40 bytes), elapsed time in low position (ms), elapsed time in high position (ms)
+		:return: input buffer contents (up to 40 bytes), elapsed time in low position (ms), elapsed time in high position (ms), 
+			with microsecond resolution
 		'''
 
 		fastinit_time = ms_to_ns(25-timing_offset_ms)
+		sleep_overshoot_ns() # calibrate now, not in the middle of the pulse
 
-		# FastInit low
-		self.socket.break_condition = True
-		start_time = time.perf_counter_ns()
+		with raised_priority() if self.fast_init_priority else nullcontext():
+			# FastInit low
+			self.socket.break_condition = True
+			start_time = time.perf_counter_ns()
 
-		# this is commented for now, as it doesn't seem to provide anything
-		# other than messing with the timing. if it indeed doesn't solve
-		# any issue, it'll be removed completely
-		#self.socket.flush()  # Ensure the break is sent immediately
+			# this is commented for now, as it doesn't seem to provide anything
+			# other than messing with the timing. if it indeed doesn't solve
+			# any issue, it'll be removed completely
+			#self.socket.flush()  # Ensure the break is sent immediately
 
-		while (time.perf_counter_ns() - start_time) < fastinit_time:
-			pass  # Busy-wait until 25 ms has passed
-		elapsed_time_low = time.perf_counter_ns() - start_time
+			wait_until_ns(start_time + fastinit_time)
 
-		# FastInit high
-		self.socket.break_condition = False
-		start_time = time.perf_counter_ns()
+			# FastInit high
+			self.socket.break_condition = False
+			high_start_time = time.perf_counter_ns()
+			elapsed_time_low = high_start_time - start_time
 
-		# this is commented for now, as it doesn't seem to provide anything
-		# other than messing with the timing. if it indeed doesn't solve
-		# any issue, it'll be removed completely
-		#self.socket.flush()  # Ensure the break is sent immediately
+			wait_until_ns(high_start_time + fastinit_time)
+			elapsed_time_high = time.perf_counter_ns() - high_start_time
 
-		while (time.perf_counter_ns() - start_time) < fastinit_time:
-			pass  # Busy-wait until 25 ms has passed
-		elapsed_time_high = time.perf_counter_ns() - start_time
-		
-		self.socket.write(bytes(payload))
+			self.socket.write(bytes(payload))
 
 		'''
 		Sure-fire way to clear out the incoming buffer. 
@@ -178,8 +344,10 @@ class KLineHardware(HardwareABC):
 		hardware, and we want to support all of it.
 		'''
 		response = self.socket.read(40)
+		self._rx_buffer.clear()
+		self._last_activity = time.perf_counter()
 
-		return response, ns_to_ms(elapsed_time_low), ns_to_ms(elapsed_time_high)
+		return response, ns_to_ms(elapsed_time_low, 3), ns_to_ms(elapsed_time_high, 3)
 
 	@staticmethod
 	def available_ports () -> list[HardwarePort]:
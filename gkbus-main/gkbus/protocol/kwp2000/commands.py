@@ -16,7 +16,7 @@ class AccessTimingParameters(Kwp2000CommandWithSubservices): # TimingParameterId
 		return self.set_subservice_identifier(TimingParameterIdentifier.SET_TIMING_PARAMETERS_TO_DEFAULT_VALUES.value)
 
 	def read_currently_active_timing_parameters (self) -> Self:
-		return self.set_subservice_identifier(TimingParameterIdentifier.SET_TIMING_PARAMETERS_TO_GIVEN_VALUES.value)
+		return self.set_subservice_identifier(TimingParameterIdentifier.READ_CURRENTLY_ACTIVE_TIMING_PARAMETERS.value)
 
 	def set_timing_parameters_to_given_values (self,
 			p2min: int,
@@ -34,6 +34,10 @@ class Kwp2000RequestFrame:
 		return self.service_identifier.to_bytes(1, 'big') + self.data
 
 class Kwp2000Protocol (ProtocolABC):
+	# shortest time the ECU may keep answering with "response pending" before the request
+	# is given up, a longer bus timeout (e.g. set for a slow routine) extends it
+	response_pending_timeout: float = 30
+
 	def open (self) -> bool:
 		if not self.transport.hardware.is_open():
 			return self.transport.hardware.open()
@@ -86,17 +90,21 @@ class Kwp2000Protocol (ProtocolABC):
 		return response
 
 	def handle_errors (self, response: Kwp2000Response) -> Kwp2000Response:
-		if response.success():
-			return response
+		pending_timeout = max(self.response_pending_timeout, self.transport.hardware.get_timeout())
+		deadline = time.time() + pending_timeout
+		pending = Kwp2000NegativeStatusIdentifierEnum.REQUEST_CORRECTLY_RECEIVED_RESPONSE_PENDING
+
+		while not response.success():
+			if response.frame.data[1] != pending.value or time.time() >= deadline:
+				raise Kwp2000NegativeResponseException(Kwp2000NegativeStatus(identifier=response.frame.data[1]))
 
-		if response.frame.data[1] == Kwp2000NegativeStatusIdentifierEnum.REQUEST_CORRECTLY_RECEIVED_RESPONSE_PENDING.value:
 			logger.info('ECU is busy, request received, response pending.')
 
 			response_pdu = self.transport.read_pdu()
 			self._last_execution_time = time.time()
-			return self.handle_errors(Kwp2000Response(Kwp2000ResponseFrame(status=response_pdu[0], data=response_pdu[1:])))
+			response = Kwp2000Response(Kwp2000ResponseFrame(status=response_pdu[0], data=response_pdu[1:]))
 
-		raise Kwp2000NegativeResponseException(Kwp2000NegativeStatus(identifier=response.frame.data[1]))
+		return response
 
 	def _keepalive (self) -> None:
 		'''
@@ -1,6 +1,8 @@
 import logging
 import time
+from typing import ClassVar
 
+from ..hardware.adapter_profile import AdapterProfile
 from ..hardware.hardware_abc import HardwareABC, RawFrame
 from .transport_abc import PacketDirection, RawPacket, TransportABC
 
@@ -53,23 +55,93 @@ class Kwp2000OverKLineTransport (TransportABC):
 		logger.debug('K-Line success: {}'.format(' '.join([hex(x) for x in list(data)])))
 		return data
 
-	def init (self, payload: bytes) -> list[tuple[bytes, int, int]]:
+	# first byte of a fast init response most often seen, depends on the adapter
+	fast_init_leading_bytes: ClassVar[list[bytes]] = [b'\x00', b'\x81', b'\xC1']
+	fast_init_offsets_ms: ClassVar[list[int]] = [0, -2, 2]
+
+	def init (self, payload: bytes) -> list[tuple[bytes, float, float]]:
 		'''
 		Bring up the socket if not opened already and initialize the K-Line by ISO14230. 
+		Adapters with a known profile get a single fast init with their timing offset, 
+		others go through the offsets (again after a DTR reset, if their profile says 
+		they don't need one) and get their profile recorded. The echo mode is detected again 
+		whenever that fails, and only saved once a fast init works
 		'''
 		if not self.hardware.is_open():
 			self.hardware.open()
 
 		init_payload = self.build_payload(payload)
-		responses = []
-		responses.append(self.hardware.iso14230_fast_init(init_payload, timing_offset_ms=0))
-		# @todo: find out if there is some way to self-test and automatically measure the timing offset we should apply
-		if responses[0][0][0:1] not in [b'\x00', b'\x81', b'\xC1']: # most often seen responses, depends on the adapter
-			responses.append(self.hardware.iso14230_fast_init(init_payload, timing_offset_ms=-2))
-			responses.append(self.hardware.iso14230_fast_init(init_payload, timing_offset_ms=2))
+		profile = getattr(self.hardware, 'profile', None)
+
+		if profile is not None and profile.fast_init_offset_ms is not None:
+			response = self.hardware.iso14230_fast_init(
+				init_payload, timing_offset_ms=profile.fast_init_offset_ms)
+			if self._matches_profile(response[0], init_payload, profile):
+				return [response]
+			logger.info('Fast init with the adapter profile failed, looking for the quirks again')
+			self._probe_echo_mode(profile)
+
+		responses: list[tuple[bytes, float, float]] = []
+		offset = self._try_fast_init_offsets(init_payload, responses)
+		if offset is None and profile is not None and profile.dtr_reset is False:
+			logger.info('Fast init failed, trying again after resetting the adapter')
+			self.hardware.reset_adapter()
+			self._probe_echo_mode(profile)
+			offset = self._try_fast_init_offsets(init_payload, responses)
+			if offset is not None:
+				profile.dtr_reset = True
+
+		if offset is not None and profile is not None:
+			self._record_profile(profile, offset, responses[-1][0], init_payload)
+		elif profile is not None:
+			# probed without a working bus (no 12V, adapter not reset yet), don't trust it
+			self._probe_echo_mode(profile)
 
 		return responses
 
+	def _try_fast_init_offsets (
+		self, init_payload: bytes, responses: list[tuple[bytes, float, float]]
+	) -> int | None:
+		'''
+		Fast init with every offset until the adapter gives a known response
+
+		:return: working offset, None if none of them did
+		'''
+		for offset in self.fast_init_offsets_ms:
+			response = self.hardware.iso14230_fast_init(init_payload, timing_offset_ms=offset)
+			responses.append(response)
+			if responses[-1][0][0:1] in self.fast_init_leading_bytes:
+				return offset
+		return None
+
+	def _probe_echo_mode (self, profile: AdapterProfile) -> None:
+		profile.echo_mode = self.hardware.detect_echo_mode()
+		logger.info('K-Line adapter echo mode: {}'.format(profile.echo_mode))
+
+	def _echoed (self, response: bytes, init_payload: bytes) -> bool:
+		# some adapters lose the first bytes of the echo, the second half is enough to tell
+		return init_payload[len(init_payload)//2:] in response
+
+	def _matches_profile (
+		self, response: bytes, init_payload: bytes, profile: AdapterProfile
+	) -> bool:
+		if profile.leading_bytes is None or not response.startswith(profile.leading_bytes):
+			return False
+		if len(response) <= len(profile.leading_bytes):
+			return False
+		if profile.echo_mode == 'partial':
+			return True
+		return self._echoed(response, init_payload) == (profile.echo_mode == 'echo')
+
+	def _record_profile (
+		self, profile: AdapterProfile, offset: int, response: bytes, init_payload: bytes
+	) -> None:
+		echo_position = response.find(init_payload)
+		profile.fast_init_offset_ms = offset
+		profile.leading_bytes = response[:echo_position] if echo_position != -1 else response[0:1]
+		logger.debug('Recording adapter profile: {}'.format(profile))
+		self.hardware.save_profile()
+
 	def calculate_checksum (self, payload: bytes) -> int:
 		return sum(payload) & 0xFF
 
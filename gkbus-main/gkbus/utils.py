@@ -1,3 +1,8 @@
+import os
+import sys
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
 from ctypes import LittleEndianStructure
 
 
@@ -16,5 +21,82 @@ class LittleEndianBitfield(LittleEndianStructure):
 def ms_to_ns (miliseconds: int) -> int:
 	return miliseconds*1000000
 
-def ns_to_ms (nanoseconds: int) -> int:
-	return round(nanoseconds/1000000)
\ No newline at end of file
+def ns_to_ms (nanoseconds: int, ndigits: int | None = None) -> int | float:
+	'''
+	:param ndigits: decimal places to keep, None rounds to whole miliseconds
+	'''
+	return round(nanoseconds/1000000, ndigits)
+
+# the last stretch before a deadline is always spun, whatever the calibration says
+spin_margin_ns = 200000
+_sleep_overshoot_ns: int | None = None
+
+def calibrate_sleep_overshoot (samples: int = 5, sleep_ns: int = 1000000) -> int:
+	'''
+	Measure how much longer than asked time.sleep takes on this machine - 
+	around 0.1ms on Linux, up to a whole timer tick (~15.6ms) on Windows
+
+	:return: worst overshoot seen, in nanoseconds
+	'''
+	global _sleep_overshoot_ns
+	overshoots = []
+	for _ in range(samples):
+		start = time.perf_counter_ns()
+		time.sleep(sleep_ns/1000000000)
+		overshoots.append(time.perf_counter_ns()-start-sleep_ns)
+	_sleep_overshoot_ns = max(0, max(overshoots))
+	return _sleep_overshoot_ns
+
+def sleep_overshoot_ns () -> int:
+	'''
+	:return: sleep overshoot of this machine, calibrated on the first call
+	'''
+	if _sleep_overshoot_ns is None:
+		return calibrate_sleep_overshoot()
+	return _sleep_overshoot_ns
+
+def wait_until_ns (deadline_ns: int) -> None:
+	'''
+	Wait until time.perf_counter_ns() reaches deadline_ns. Sleeps for all but the 
+	calibrated sleep overshoot and spins only through the rest, so it's precise 
+	without keeping a core busy the whole time
+	'''
+	coarse_ns = deadline_ns - time.perf_counter_ns() - sleep_overshoot_ns() - spin_margin_ns
+	if coarse_ns > 0:
+		time.sleep(coarse_ns/1000000000)
+
+	while time.perf_counter_ns() < deadline_ns:
+		pass
+
+@contextmanager
+def raised_priority () -> Iterator[None]:
+	'''
+	Run the block with a higher scheduling priority (and 1ms timer resolution on Windows), 
+	where the OS allows it. Silently does nothing where it doesn't - like without root on Linux
+	'''
+	if sys.platform.startswith('win32'):
+		import ctypes
+		kernel32, winmm = ctypes.windll.kernel32, ctypes.windll.winmm
+		thread = kernel32.GetCurrentThread()
+		previous_priority = kernel32.GetThreadPriority(thread)
+		winmm.timeBeginPeriod(1)
+		kernel32.SetThreadPriority(thread, 15) # THREAD_PRIORITY_TIME_CRITICAL
+		try:
+			yield
+		finally:
+			kernel32.SetThreadPriority(thread, previous_priority)
+			winmm.timeEndPeriod(1)
+		return
+
+	try:
+		previous_policy, previous_param = os.sched_getscheduler(0), os.sched_getparam(0)
+		fifo_priority = os.sched_param(os.sched_get_priority_min(os.SCHED_FIFO))
+		os.sched_setscheduler(0, os.SCHED_FIFO, fifo_priority)
+	except (AttributeError, OSError):
+		yield
+		return
+
+	try:
+		yield
+	finally:
+		os.sched_setscheduler(0, previous_policy, previous_param)
\ No newline at end of file
@@ -23,11 +23,15 @@ if str(GKBUS_DIR) not in sys.path:
 if str(GKFLASHER_DIR) not in sys.path:
     sys.path.insert(0, str(GKFLASHER_DIR))
 
+from gkbus.hardware import TimeoutException
 from gkbus.hardware.kline_hardware import KLineHardware
 from gkbus.transport import Kwp2000OverKLineTransport
 from gkbus.protocol import kwp2000
 from gkbus.protocol.kwp2000 import commands, enums
 from ecu_definitions import ECU_IDENTIFICATION_TABLE
+from flasher.timing import TimingParameters, tune_timing, read_benchmark
+
+BUS_ERRORS = (kwp2000.Kwp2000NegativeResponseException, TimeoutException)
 
 
 DATA_SOURCES = [
@@ -132,6 +136,7 @@ class GKBusBridge:
         self.clients_lock = threading.Lock()
         self.hello_line = build_hello()
         self.bus = None
+        self.timing = None
 
     def list_ports(self):
         if not hasattr(serial, "tools"):
@@ -149,6 +154,32 @@ class GKBusBridge:
                 return p.device
         return None
 
+    def timing_info(self):
+        if not self.timing:
+            return {}
+        return {
+            "parameters": str(self.timing.parameters),
+            "values": self.timing.parameters.to_list(),
+            "inter_request_delay_ms": self.timing.inter_request_delay * 1000,
+            "throughput": round(self.timing.benchmark.throughput()),
+            "baseline_throughput": round(self.timing.baseline.throughput()),
+            "gain": round(self.timing.gain(), 3),
+        }
+
+    def tune_timing(self, bus, hardware, ecu):
+        offset = 0x090000 + (ecu["memory_offset"] if ecu else 0)
+        self.timing = tune_timing(
+            read_limits=lambda: TimingParameters.from_response(bus.execute(commands.AccessTimingParameters().read_limits_of_possible_timing_parameters()).get_data()[1:]),
+            apply=lambda parameters: bus.execute(commands.AccessTimingParameters().set_timing_parameters_to_given_values(*parameters.to_list())),
+            benchmark=lambda: read_benchmark(lambda address, size: read_memory_by_address(bus, address, size), offset, 254, errors=BUS_ERRORS),
+            set_inter_request_delay=hardware.set_inter_request_delay,
+            inter_request_delay=hardware.inter_request_delay,
+            errors=BUS_ERRORS,
+            log=lambda text: self.broadcast({"type": "log", "text": text}),
+        )
+        self.broadcast({"type": "log", "text": "Timing parameters: " + str(self.timing)})
+        self.broadcast(dict(self.timing_info(), type="timing"))
+
     def broadcast(self, payload):
         data = json.dumps(payload, ensure_ascii=False)
         with self.clients_lock:
@@ -178,16 +209,16 @@ class GKBusBridge:
                 pass
         self.bus = None
 
-    def start(self, port):
+    def start(self, port, tune=False):
         self.stop()
         self.stop_event.clear()
-        self.thread = threading.Thread(target=self._run, args=(port,), daemon=True)
+        self.thread = threading.Thread(target=self._run, args=(port, tune), daemon=True)
         self.thread.start()
 
-    def _run(self, port):
+    def _run(self, port, tune=False):
         try:
             self.broadcast({"type": "log", "text": "Serveur: demarrage GKBus sur " + port})
-            hardware = KLineHardware(port, baudrate=120000, timeout=2)
+            hardware = KLineHardware(port, baudrate=120000, timeout=2, fast_init_priority=True)
             transport = Kwp2000OverKLineTransport(hardware, tx_id=0x11, rx_id=0xF1)
             bus = kwp2000.Kwp2000Protocol(transport)
             self.bus = bus
@@ -232,6 +263,14 @@ class GKBusBridge:
             else:
                 self.broadcast({"type": "log", "text": "ECU identification failed"})
 
+            self.timing = None
+            if tune:
+                self.broadcast({"type": "log", "text": "Tuning timing parameters"})
+                try:
+                    self.tune_timing(bus, hardware, ecu)
+                except Exception:
+                    self.broadcast({"type": "log", "text": "Timing params not supported"})
+
             self.broadcast({"type": "log", "text": "Building parameter header"})
             self.broadcast({"type": "line", "text": self.hello_line})
 
@@ -281,6 +320,8 @@ class Handler(BaseHTTPRequestHandler):
             return self._send_json(BRIDGE.list_ports())
         if parsed.path == "/api/stream":
             return self._handle_stream()
+        if parsed.path == "/api/timing":
+            return self._send_json(BRIDGE.timing_info())
         return self._serve_static(parsed.path)
 
     def do_POST(self):
@@ -298,7 +339,7 @@ class Handler(BaseHTTPRequestHandler):
                         port = None
             if not port:
                 return self._send_json({"error": "missing port"}, status=HTTPStatus.BAD_REQUEST)
-            BRIDGE.start(port)
+            BRIDGE.start(port, tune=params.get("timing", [""])[0] == "tune")
             return self._send_json({"ok": True})
         if parsed.path == "/api/stop":
             BRIDGE.stop()